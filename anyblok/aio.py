@@ -0,0 +1,341 @@
+# This file is a part of the AnyBlok project
+#
+#    Copyright (C) 2018 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+""" Asyncio API of the registry
+
+The database driver stays synchronous, the calls which use the database are
+executed by an executor. Each asyncio task gets its own session and its own
+environment (pre and post commit hooks, ...)::
+
+    from anyblok.environment import EnvironmentManager, ContextEnvironment
+    from anyblok.aio import AsyncRegistry
+
+    # before loading the registries
+    EnvironmentManager.define_environment_cls(ContextEnvironment)
+
+    async def handler(db_name):
+        registry = await AsyncRegistry.get(db_name)
+        test = await registry.Test.insert(name='test')
+        tests = await registry.Test.query().filter_by(name='test').all()
+        await registry.commit()
+
+Each awaited call costs one round trip to the executor. A handler which
+does many database calls in a row is faster executed in one round trip,
+in the scope of its task::
+
+    def sync_handler(registry):
+        ...
+
+    await registry.run(sync_handler, registry.registry)
+
+``tools/benchmarks/bench_aio.py`` compares both with a thread pool.
+
+The module needs python >= 3.5 (``async`` syntax), ``AsyncRegistry``
+needs python >= 3.7 (``contextvars``).
+
+.. warning::
+
+    The lazy loading of the attributes of an instance uses the database in
+    the event loop, use ``await registry.run(getattr, instance, 'field')``
+    to load it in the executor
+"""
+import asyncio
+from functools import partial, wraps
+from weakref import WeakKeyDictionary, WeakSet
+from sqlalchemy.orm import Query
+from .environment import (EnvironmentManager, ContextEnvironment,
+                          EnvironmentException)
+from .registry import RegistryManager
+from .config import Configuration
+try:
+    from contextvars import Context, copy_context
+except ImportError:  # pragma: no cover
+    # python < 3.7
+    Context = copy_context = None
+
+
+def current_task():
+    """ Return the running asyncio task or None """
+    try:
+        if hasattr(asyncio, 'current_task'):
+            return asyncio.current_task()
+
+        # python < 3.7
+        return asyncio.Task.current_task()
+    except RuntimeError:
+        return None
+
+
+class AsyncQuery:
+    """ Wrap a ``Query``, the methods which build the query return a new
+    ``AsyncQuery``, the methods which execute the query are coroutines::
+
+        query = registry.Test.query().filter_by(name='test')
+        tests = await query.all()
+        count = await query.count()
+
+    """
+
+    executed_methods = (
+        'all', 'first', 'one', 'one_or_none', 'scalar', 'count', 'get',
+        'update', 'delete', 'dictone', 'dictfirst', 'dictall',
+        'delete_all', 'exists')
+
+    def __init__(self, registry, query):
+        self.registry = registry
+        self.query = query
+
+    def __getattr__(self, name):
+        attribute = getattr(self.query, name)
+        if name in self.executed_methods:
+            return self.registry.coroutine(attribute)
+
+        if not callable(attribute):
+            return attribute
+
+        @wraps(attribute)
+        def wrapper(*args, **kwargs):
+            result = attribute(*args, **kwargs)
+            if isinstance(result, Query):
+                return self.__class__(self.registry, result)
+
+            return result
+
+        return wrapper
+
+    def __str__(self):
+        return str(self.query)
+
+
+class AsyncModel:
+    """ Wrap a namespace or a model of the registry
+
+    * ``query`` returns an ``AsyncQuery``
+    * the namespaces and the models are wrapped
+    * the other methods are coroutines executed by the executor
+    """
+
+    def __init__(self, registry, model):
+        self.registry = registry
+        self.model = model
+
+    def query(self, *elements):
+        """ Return an ``AsyncQuery`` for the model """
+        self.registry.ensure_scope()
+        return AsyncQuery(self.registry, self.model.query(*elements))
+
+    def __getattr__(self, name):
+        attribute = getattr(self.model, name)
+        if isinstance(attribute, type):
+            return self.__class__(self.registry, attribute)
+
+        if callable(attribute):
+            return self.registry.coroutine(attribute)
+
+        return attribute
+
+
+class AsyncRegistry:
+    """ Asyncio API of a registry
+
+    * the models and the namespaces are wrapped by ``AsyncModel``
+    * the methods of the registry (``commit``, ``rollback``, ``flush``,
+      ``execute``, ...) are coroutines executed by the executor
+
+    Each task gets its own scope: its own session and environment. They are
+    released when the task is done, the transaction which is not committed
+    is rolled back
+
+    The session of a task keeps its connection between two calls, until the
+    end of the transaction. To never wait for a connection in the executor,
+    which would block the tasks owning the connections, at most
+    ``max_sessions`` tasks can have a transaction in progress, the other
+    tasks wait for the commit or the rollback of one of them
+
+    :param registry: the ``Registry`` instance
+    :param executor: ``concurrent.futures.Executor``, if None the default
+                     executor of the event loop is used
+    :param max_sessions: by default the size of the pool of connections
+                         plus its overflow
+    :exception: EnvironmentException
+    """
+
+    tasks_scope = WeakKeyDictionary()
+    async_registries = WeakKeyDictionary()
+
+    def __init__(self, registry, executor=None, max_sessions=None):
+        if copy_context is None:
+            raise EnvironmentException(
+                "The asyncio registry needs python >= 3.7")
+
+        if not issubclass(EnvironmentManager.environment, ContextEnvironment):
+            raise EnvironmentException(
+                "The environment must be a ContextEnvironment, use "
+                "EnvironmentManager.define_environment_cls before loading "
+                "the registry")
+
+        self.registry = registry
+        self.executor = executor
+        if max_sessions is None:
+            max_sessions = ((Configuration.get('db_pool_size') or 5) +
+                            (Configuration.get('db_max_overflow') or 10))
+
+        self.max_sessions = max_sessions
+        self.sessions = None
+        self.tasks_with_session = set()
+        self.tasks_watched = WeakSet()
+
+    @classmethod
+    async def get(cls, db_name, executor=None, **kwargs):
+        """ Return the ``AsyncRegistry`` of the database, the registry is
+        loaded by the executor if it is not loaded yet
+
+        :param db_name: the name of the database linked to this registry
+        :param executor: ``concurrent.futures.Executor``
+        :rtype: ``AsyncRegistry``
+        """
+        loop = asyncio.get_event_loop()
+        registry = await loop.run_in_executor(
+            executor, partial(Context().run, RegistryManager.get, db_name,
+                              **kwargs))
+        if registry not in cls.async_registries:
+            cls.async_registries[registry] = cls(registry, executor=executor)
+
+        return cls.async_registries[registry]
+
+    def ensure_scope(self):
+        """ Define the scope of the current task if it is not defined yet
+
+        A task created by another task inherits the context of its parent,
+        it gets its own scope anyway
+
+        :rtype: the scope
+        """
+        scope = ContextEnvironment.scope.get()
+        task = current_task()
+        if task is None:
+            return scope
+
+        if scope is None or self.tasks_scope.get(task) != scope:
+            scope = ContextEnvironment.new_scope()
+            self.tasks_scope[task] = scope
+            task.add_done_callback(partial(self.task_done, scope))
+
+        return scope
+
+    def task_done(self, scope, task):
+        self.release_scope(scope)
+
+    async def acquire_session(self):
+        """ Wait until the current task can use a session """
+        task = current_task()
+        if task is None or task in self.tasks_with_session:
+            return
+
+        if self.sessions is None:
+            self.sessions = asyncio.Semaphore(self.max_sessions)
+
+        await self.sessions.acquire()
+        self.tasks_with_session.add(task)
+        if task not in self.tasks_watched:
+            # the scope of the task may be defined by another registry, the
+            # session of this registry is released by its own callback
+            self.tasks_watched.add(task)
+            task.add_done_callback(self.release_session)
+
+    def release_session(self, task):
+        """ Allow another task to use a session
+
+        :param task: the task which does not use its session any more
+        """
+        if task in self.tasks_with_session:
+            self.tasks_with_session.remove(task)
+            self.sessions.release()
+
+    def release_scope(self, scope):
+        """ Release the sessions and the environment of the scope, the
+        transactions which are not committed are rolled back
+
+        :param scope: the scope to release
+        """
+
+        def release():
+            ContextEnvironment.scope.set(scope)
+            try:
+                for registry in RegistryManager.get_registries():
+                    if registry.Session is not None:
+                        registry.Session.remove()
+            finally:
+                ContextEnvironment.release_scope(scope)
+
+        asyncio.get_event_loop().run_in_executor(
+            self.executor, partial(Context().run, release))
+
+    async def run(self, function, *args, **kwargs):
+        """ Execute the function by the executor, in the scope of the
+        current task
+
+        :param function: the function to call
+        :rtype: the result of the function
+        """
+        self.ensure_scope()
+        await self.acquire_session()
+        context = copy_context()
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            self.executor, partial(context.run, function, *args, **kwargs))
+
+    async def commit(self, *args, **kwargs):
+        """ Commit the transaction of the current task """
+        try:
+            return await self.run(self.registry.commit, *args, **kwargs)
+        finally:
+            self.release_session(current_task())
+
+    async def rollback(self, *args, **kwargs):
+        """ Roll back the transaction of the current task """
+        try:
+            return await self.run(self.registry.rollback, *args, **kwargs)
+        finally:
+            self.release_session(current_task())
+
+    def coroutine(self, function):
+        """ Return a coroutine function which executes the function by the
+        executor
+
+        :param function: the function to call
+        :rtype: coroutine function
+        """
+
+        @wraps(function)
+        async def wrapper(*args, **kwargs):
+            return await self.run(function, *args, **kwargs)
+
+        return wrapper
+
+    def query(self, *elements):
+        """ Return an ``AsyncQuery`` on the session of the current task """
+        self.ensure_scope()
+        return AsyncQuery(self, self.registry.query(*elements))
+
+    def get_model(self, namespace):
+        """ Return the wrapped model
+
+        :param namespace: name of the model
+        :rtype: ``AsyncModel``
+        """
+        return AsyncModel(self, self.registry.get(namespace))
+
+    def __getattr__(self, name):
+        attribute = getattr(self.registry, name)
+        if isinstance(attribute, type):
+            return AsyncModel(self, attribute)
+
+        if callable(attribute):
+            return self.coroutine(attribute)
+
+        return attribute
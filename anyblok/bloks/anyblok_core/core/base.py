@@ -24,6 +24,14 @@ class Base:
         """
         pass
 
+    @classmethod
+    def warm_up_cache(cls):
+        """ This method is called by the warm-up of the caches at the end of
+        the load of the registry (option ``cache_warm_up``), to fill the
+        caches of the model which need arguments
+        """
+        pass
+
     @classmethod
     def fire(cls, event, *args, **kwargs):
         """ Call a specific event on the model
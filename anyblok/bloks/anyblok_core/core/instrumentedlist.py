@@ -6,6 +6,7 @@
 # v. 2.0. If a copy of the MPL was not distributed with this file,You can
 # obtain one at http://mozilla.org/MPL/2.0/.
 from anyblok import Declarations
+from collections import OrderedDict
 
 
 @Declarations.register(Declarations.Core)
@@ -26,3 +27,29 @@ class InstrumentedList:
             return wrapper
         else:
             return [getattr(x, name) for x in self]
+
+    def to_dicts(self, *fields):
+        """ Transform the records to the list of dict of value, the plan of
+        the fields is got only one time by model, see ``to_dict``. The
+        relationships of the fields are loaded by one query by level for all
+        the records, not by record
+
+        :param fields: the fields of ``to_dict``
+        :rtype: list of dict
+        """
+        models = OrderedDict()
+        for record in self:
+            models.setdefault(record.__class__, []).append(record)
+
+        plans = {}
+        for model, records in models.items():
+            try:
+                hash(fields)
+            except TypeError:
+                fields = model.freeze_to_dict_fields(fields)
+
+            plans[model] = model.get_to_dict_plan(fields)
+            model.preload_to_dict_plan(records, plans[model])
+
+        return [record.to_dict_by_plan(plans[record.__class__])
+                for record in self]
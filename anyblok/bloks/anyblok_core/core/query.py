@@ -7,7 +7,10 @@
 # obtain one at http://mozilla.org/MPL/2.0/.
 from anyblok import Declarations
 from anyblok.common import anyblok_column_prefix
+from sqlalchemy import Table, inspect
 from sqlalchemy.orm import query
+from sqlalchemy.sql.util import find_tables
+from ..exceptions import QueryException
 
 
 @Declarations.register(Declarations.Core)
@@ -15,6 +18,81 @@ class Query(query.Query):
     """ Overload the SqlAlchemy Query
     """
 
+    is_cached = False
+    cache_ttl = None
+
+    def cached(self, ttl=None):
+        """ Return a copy of the query whose rows are kept in the cache of
+        the registry (``registry.query_cache``), keyed by the compiled
+        statement and its bound parameters::
+
+            query = registry.Test.query(func.sum(registry.Test.amount))
+            total = query.cached(ttl=60).scalar()
+
+        The rows are removed when a table read by the statement is modified
+        by this process (flush, ``query.update``, ``query.delete``). The
+        modifications of the other processes are seen after the ``ttl``.
+
+        Only the rows of columns can be cached, not the instances, but the
+        ``count`` of any query can be
+
+        :param ttl: time to live in seconds, None for no expiry
+        :rtype: Query
+        """
+        query = self._clone()
+        query.is_cached = True
+        query.cache_ttl = ttl
+        return query
+
+    def __iter__(self):
+        if not self.is_cached:
+            return super(Query, self).__iter__()
+
+        return iter(self.get_cached_rows())
+
+    def get_cached_rows(self):
+        """ Return the rows of the cached query from the cache of the
+        registry, or execute it and save them
+
+        :rtype: list of rows
+        :exception: QueryException
+        """
+        if any(hasattr(x['type'], '__table__')
+               for x in self.column_descriptions):
+            raise QueryException(
+                "Only the rows of columns can be cached, not the instances "
+                "of the models: %r" % self.column_descriptions)
+
+        if self._autoflush:
+            # as the query, the pending changes of the transaction are
+            # flushed before reading, the modified tables are then known
+            self.session._autoflush()
+
+        statement = self.statement
+        compiled = statement.compile(
+            bind=self.session.get_bind(self._bind_mapper(), clause=statement))
+        key = (str(compiled), tuple(sorted(compiled.params.items())))
+        tables = frozenset(table.fullname for table in find_tables(
+            statement, include_aliases=True) if isinstance(table, Table))
+        try:
+            hash(key)
+        except TypeError:
+            return list(super(Query, self).__iter__())
+
+        if tables & self.registry.get_query_cache_modified_tables():
+            # the transaction has modified the tables, not committed yet
+            return list(super(Query, self).__iter__())
+
+        query_cache = self.registry.query_cache
+        found, rows = query_cache.get(key)
+        if not found:
+            versions = query_cache.get_versions(tables)
+            rows = list(super(Query, self).__iter__())
+            query_cache.set(key, rows, tables, ttl=self.cache_ttl,
+                            versions=versions)
+
+        return rows
+
     def all(self):
         """ Return an instrumented list of the result of the query
         """
@@ -70,3 +148,59 @@ class Query(query.Query):
             return [{x: getattr(y, z) for x, z in field2get} for y in vals]
         else:
             return vals.to_dict()
+
+    def dictiter(self, batch_size=1000):
+        """ Iterate on the dict of the rows of the query as ``dictall``,
+        without loading all the rows in memory, see ``iter_batches``. The
+        rows of columns are transformed without creating any instance
+
+        :param batch_size: number of rows read by batch
+        :rtype: generator of dict
+        """
+        field2get = self.get_field_nams_in_column_description()
+        if field2get:
+            for val in self.yield_per(batch_size):
+                yield {x: getattr(val, y) for x, y in field2get}
+        else:
+            for vals in self.iter_batches(batch_size):
+                yield from vals.to_dicts()
+
+    def iter_batches(self, size=1000):
+        """ Iterate on the rows of the query by batch, the rows are read
+        by a server side cursor (``yield_per``)::
+
+            for tests in registry.Test.query().iter_batches(500):
+                export(tests.to_dicts())
+
+        The instances of a batch which are not modified are expunged from
+        the session before reading the next batch
+
+        :param size: number of rows by batch
+        :rtype: generator of InstrumentedList
+        """
+        batch = []
+        for val in self.yield_per(size):
+            batch.append(val)
+            if len(batch) == size:
+                yield self.registry.InstrumentedList(batch)
+                self.expunge_batch(batch)
+                batch = []
+
+        if batch:
+            yield self.registry.InstrumentedList(batch)
+            self.expunge_batch(batch)
+
+    def expunge_batch(self, batch):
+        """ Expunge from the session the instances of the batch which are
+        not modified, see ``iter_batches``
+
+        :param batch: list of rows of the query
+        """
+        for val in batch:
+            for instance in (val if isinstance(val, tuple) else (val,)):
+                if not hasattr(instance, '__table__'):
+                    continue
+
+                state = inspect(instance)
+                if state.persistent and not state.modified:
+                    self.session.expunge(instance)
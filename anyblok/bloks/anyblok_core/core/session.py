@@ -6,6 +6,7 @@
 # v. 2.0. If a copy of the MPL was not distributed with this file,You can
 # obtain one at http://mozilla.org/MPL/2.0/.
 from sqlalchemy.orm import Session as SA_Session
+from sqlalchemy.sql.expression import Select
 from anyblok import Declarations
 
 
@@ -17,3 +18,54 @@ class Session(SA_Session):
     def __init__(self, *args, **kwargs):
         kwargs['query_cls'] = self.registry_query
         super(Session, self).__init__(*args, **kwargs)
+        self.pinned_to_primary = False
+        self.ro_transaction = None
+        self.ro_bind = None
+
+    def get_root_transaction(self):
+        """ Return the root transaction of the session """
+        transaction = self.transaction
+        while transaction is not None and transaction.parent is not None:
+            transaction = transaction.parent
+
+        return transaction
+
+    def get_bind(self, mapper=None, clause=None):
+        """ Overload the method to send the read queries to a read only
+        replica
+
+        A transaction uses a read only engine of the registry while it
+        only executes ``SELECT`` queries. As soon as the transaction
+        writes (flush, update, delete, select for update, textual query,
+        ...) all the queries of the transaction go to the primary until
+        the end of the transaction. A bind asked without clause (as
+        ``session.connection()``) is the primary, but the transaction
+        stays on the replica for its next reads
+
+        If ``pinned_to_primary`` is True all the queries go to the primary
+        """
+        if not self.registry.ro_engines or self.pinned_to_primary:
+            return super(Session, self).get_bind(mapper=mapper, clause=clause)
+
+        transaction = self.get_root_transaction()
+        if self.ro_transaction is not transaction:
+            # new transaction, nothing has been written yet
+            self.ro_transaction = transaction
+            self.ro_bind = self.registry.get_ro_engine()
+
+        if self.ro_bind is not None and not self._flushing:
+            if clause is None:
+                # nothing is known about what will be executed, use the
+                # primary only for this call
+                return super(Session, self).get_bind(mapper=mapper,
+                                                     clause=clause)
+
+            if (
+                isinstance(clause, Select) and
+                clause._for_update_arg is None
+            ):
+                return self.ro_bind
+
+        # the transaction writes, stay on the primary until its end
+        self.ro_bind = None
+        return super(Session, self).get_bind(mapper=mapper, clause=clause)
@@ -6,16 +6,20 @@
 # v. 2.0. If a copy of the MPL was not distributed with this file,You can
 # obtain one at http://mozilla.org/MPL/2.0/.
 from anyblok.declarations import Declarations, classmethod_cache
-from anyblok.field import FieldException
-from anyblok.column import Column
+from anyblok.field import Field, FieldException
+from anyblok.column import Column, Sequence as SequenceColumn
 from anyblok.mapper import FakeColumn, FakeRelationShip
 from anyblok.relationship import RelationShip, Many2Many
 from anyblok.common import anyblok_column_prefix
 from ..exceptions import SqlBaseException
-from sqlalchemy.orm import aliased, ColumnProperty
+from sqlalchemy.orm import aliased, ColumnProperty, Query
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.interfaces import MANYTOONE
 from sqlalchemy.sql.expression import true
-from sqlalchemy import or_, and_, inspect
+from sqlalchemy import or_, and_, inspect, bindparam, select, tuple_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy_utils.models import NO_VALUE, NOT_LOADED_REPR
+from collections import OrderedDict
 
 
 class uniquedict(dict):
@@ -128,7 +132,7 @@ class SqlMixin:
         :rtype: where clause
         :exception: SqlBaseException
         """
-        _pks = cls.get_primary_keys()
+        _pks = cls.get_mapper_primary_keys()
         for pk in _pks:
             if pk not in pks:
                 raise SqlBaseException("No primary key %s filled for %r" % (
@@ -136,20 +140,158 @@ class SqlMixin:
 
         return [getattr(cls, k) == v for k, v in pks.items()]
 
+    @classmethod
+    def get_mapper_primary_keys(cls):
+        """ return the name of the primary keys of the mapper, in the order
+        of the identity of the instances, without query
+
+        :rtype: list of the primary keys name
+        """
+        mapper = cls.__mapper__
+        res = []
+        for column in mapper.primary_key:
+            name = mapper.get_property_by_column(column).key
+            if name.startswith(anyblok_column_prefix):
+                name = name[len(anyblok_column_prefix):]
+
+            res.append(name)
+
+        return res
+
+    @classmethod
+    def get_identity_from_primary_keys(cls, **pks):
+        """ return the identity of the instance in the identity map of the
+        session
+
+        :param \*\*pks: dict {primary_key: value, ...}
+        :rtype: tuple of the values, None if a primary key is missing or if
+                another column is given
+        """
+        names = cls.get_mapper_primary_keys()
+        if len(pks) != len(names):
+            return None
+
+        try:
+            return tuple(pks[name] for name in names)
+        except KeyError:
+            return None
+
     @classmethod
     def from_primary_keys(cls, **pks):
         """ return the instance of the model from the primary keys
 
+        The instance already in the session is returned without query, else
+        it is fetched by one query. As for a query, the pending changes of
+        the session are flushed before, so a deleted entry is not returned
+
         :param \*\*pks: dict {primary_key: value, ...}
         :rtype: instance of the model
         """
-        where_clause = cls.get_where_clause_from_primary_keys(**pks)
-        query = cls.query().filter(*where_clause)
-        if query.count():
-            return query.first()
+        # the identity map must see the pending deletions and the
+        # modified primary keys, as the query did
+        cls.registry.session._autoflush()
+        identity = cls.get_identity_from_primary_keys(**pks)
+        if identity is None:
+            where_clause = cls.get_where_clause_from_primary_keys(**pks)
+            return cls.query().filter(*where_clause).first()
+
+        identity_cache = cls.get_identity_cache()
+        if identity_cache is not None:
+            return identity_cache.from_primary_keys(cls, identity)
+
+        return cls.query().get(identity)
+
+    @classmethod
+    def from_primary_keys_many(cls, pks_list):
+        """ return the instances of the model from a list of primary keys,
+        in the same order
+
+        The instances already in the session are not queried, the others
+        are fetched by one query. The pending changes of the session are
+        flushed before
+
+        :param pks_list: list of dict [{primary_key: value, ...}]
+        :rtype: list of the instances, None for the unknown primary keys
+        :exception: SqlBaseException
+        """
+        mapper = cls.__mapper__
+        session = cls.registry.session
+        session._autoflush()
+        identity_map = session.identity_map
+        identities = []
+        instances = {}
+        missing = []
+        for pks in pks_list:
+            identity = cls.get_identity_from_primary_keys(**pks)
+            if identity is None:
+                raise SqlBaseException(
+                    "The primary keys %r do not match with the primary keys "
+                    "of %r" % (pks, cls.__registry_name__))
+
+            identities.append(identity)
+            if identity in instances:
+                continue
+
+            instance = identity_map.get(
+                mapper.identity_key_from_primary_key(identity))
+            if (
+                instance is None or not isinstance(instance, cls) or
+                inspect(instance).expired
+            ):
+                missing.append(identity)
+                instance = None
+
+            instances[identity] = instance
+
+        if missing:
+            columns = [getattr(cls, name)
+                       for name in cls.get_mapper_primary_keys()]
+            if len(columns) == 1:
+                where_clause = columns[0].in_([x[0] for x in missing])
+            else:
+                where_clause = or_(*[
+                    and_(*[column == value
+                           for column, value in zip(columns, identity)])
+                    for identity in missing])
+
+            for instance in cls.query().filter(where_clause).all():
+                instances[inspect(instance).identity] = instance
+
+        return [instances[identity] for identity in identities]
+
+    @classmethod
+    def get_identity_cache(cls):
+        """ Return the identity cache of the model, if the model is
+        declared with ``identity_cache`` and if the cache can be used now
+
+        :rtype: ``anyblok.model.cache.IdentityCache`` or None
+        """
+        identity_cache = cls.registry.identity_caches.get(
+            cls.__registry_name__)
+        if identity_cache is not None and identity_cache.is_usable():
+            return identity_cache
 
         return None
 
+    @classmethod
+    def cached_filter_by(cls, **values):
+        """ return the instances of the model which have the values, served
+        by the identity cache of the model if it is declared
+
+        :param \*\*values: dict {column: value, ...}
+        :rtype: instrumented list of instances
+        """
+        identity_cache = cls.get_identity_cache()
+        if identity_cache is not None:
+            try:
+                hash(tuple(values.values()))
+            except TypeError:
+                pass
+            else:
+                return identity_cache.filter_by(cls, values)
+
+        return cls.query().filter_by(**values).all()
+
     @classmethod
     def from_multi_primary_keys(cls, *pks):
         """ return the instances of the model from the primary keys
@@ -165,12 +307,7 @@ class SqlMixin:
             return []
 
         where_clause = or_(*[and_(*x) for x in where_clause])
-
-        query = cls.query().filter(where_clause)
-        if query.count():
-            return query.all()
-
-        return []
+        return cls.query().filter(where_clause).all()
 
     def to_primary_keys(self):
         """ return the primary keys and values for this instance
@@ -193,7 +330,7 @@ class SqlMixin:
         query = query.filter(C.primary_key == true())
         return query.all().name
 
-    @classmethod_cache()
+    @classmethod_cache(shared=True, warm=True)
     def _fields_description(cls):
         """ Return the information of the Field, Column, RelationShip """
         Field = cls.registry.System.Field
@@ -214,7 +351,7 @@ class SqlMixin:
 
         return res
 
-    @classmethod_cache()
+    @classmethod_cache(warm=True)
     def get_hybrid_property_columns(cls):
         """Return the hybrid properties columns name from the Model and the
         inherited model if they come from polymorphisme
@@ -222,7 +359,7 @@ class SqlMixin:
         hybrid_property_columns = cls.hybrid_property_columns
         if 'polymorphic_identity' in cls.__mapper_args__:
             pks = cls.get_primary_keys()
-            fd = cls.fields_description(*pks)
+            fd = cls.fields_description(pks)
             for pk in pks:
                 if fd[pk].get('model'):
                     Model = cls.registry.get(fd[pk]['model'])
@@ -231,7 +368,8 @@ class SqlMixin:
 
         return hybrid_property_columns
 
-    def _format_field(self, field):
+    @classmethod
+    def _format_field(cls, field):
         related_fields = None
         if isinstance(field, (tuple, list)):
             if len(field) == 1:
@@ -255,7 +393,8 @@ class SqlMixin:
         return field, related_fields
 
     def to_dict(self, *fields):
-        """ Transform a record to the dict of value
+        """ Transform a record to the dict of value, the fields are compiled
+        only one time by model (see ``get_to_dict_plan``)
 
         :param fields: list of fields to put in dict; if not selected, fields
             then take them all. A field is either one of these:
@@ -321,44 +460,215 @@ class SqlMixin:
                  ]}
              }
         """
-        result = {}
         cls = self.__class__
-        fields = fields if fields else cls.fields_description().keys()
+        try:
+            hash(fields)
+        except TypeError:
+            fields = cls.freeze_to_dict_fields(fields)
+
+        return self.to_dict_by_plan(cls.get_to_dict_plan(fields))
+
+    def to_dict_by_plan(self, plan):
+        """ Transform a record to the dict of value with the compiled plan
+        of the fields, see ``get_to_dict_plan``
+
+        :param plan: the plan returned by ``get_to_dict_plan``
+        :rtype: dict
+        """
+        result = {}
+        for field, related_fields, uselist in plan:
+            field_value = getattr(self, field)
+            if related_fields is None or field_value is None:
+                # column, hybrid property or empty relationship
+                result[field] = field_value
+            elif uselist:
+                result[field] = [r.to_dict(*related_fields)
+                                 for r in field_value]
+            else:
+                result[field] = field_value.to_dict(*related_fields)
+
+        return result
 
+    @classmethod
+    def freeze_to_dict_fields(cls, fields):
+        """ Return the fields of ``to_dict`` with tuples in place of the
+        lists, to be used as key of the cache of ``get_to_dict_plan``
+
+        :param fields: the fields of ``to_dict``
+        :rtype: tuple
+        """
+        if isinstance(fields, (tuple, list)):
+            return tuple(cls.freeze_to_dict_fields(x) for x in fields)
+
+        return fields
+
+    @classmethod_cache()
+    def get_to_dict_plan(cls, fields):
+        """ Return the compiled plan of ``to_dict`` for the fields, the
+        fields are parsed and the relationships are resolved only one time
+        by model and fields
+
+        :param fields: tuple of the fields of ``to_dict``
+        :rtype: tuple of (field name, related fields or None for the
+                columns, uselist)
+        :exception: SqlBaseException
+        """
+        fields = fields if fields else cls.fields_description().keys()
+        plan = []
         for field in fields:
             # if field is ("relation_name", ("list", "of", "relation",
             # "fields")), deal with it.
-            field, related_fields = self._format_field(field)
-            # Get the actual data
-            field_value, field_property = getattr(self, field), None
+            field, related_fields = cls._format_field(field)
+            field_property = None
             try:
                 field_property = getattr(getattr(cls, field), 'property', None)
             except FieldException:
                 pass
 
-            # Deal with this data
-            if field_property is None:
-                # it is the case of field function (hyprid property)
-                result[field] = field_value
-            elif field_value is None or type(field_property) == ColumnProperty:
-                # If value is None, then do not go any further whatever
-                # the column property tells you.
-                result[field] = field_value
+            if (
+                field_property is None or
+                type(field_property) == ColumnProperty
+            ):
+                # column or field function (hybrid property)
+                plan.append((field, None, None))
+                continue
+
+            # it is should be RelationshipProperty
+            if related_fields is None:
+                # If there is no field list to the relation,
+                # use only primary keys
+                related_fields = field_property.mapper.entity
+                related_fields = related_fields.get_primary_keys()
+
+            # One2One, One2Many, Many2One or Many2Many ?
+            plan.append((field, cls.freeze_to_dict_fields(related_fields),
+                         field_property.uselist))
+
+        return tuple(plan)
+
+    @classmethod
+    def preload_to_dict_plan(cls, records, plan):
+        """ Load the relationships of the plan for all the records before
+        ``to_dict_by_plan``, one query by relationship and by level of the
+        fields, in place of one query by record
+
+        :param records: instances of the model
+        :param plan: the plan returned by ``get_to_dict_plan``
+        """
+        for field, related_fields, uselist in plan:
+            if related_fields is None:
+                continue
+
+            models = OrderedDict()
+            for instance in cls.load_relationship(records, field):
+                models.setdefault(instance.__class__, []).append(instance)
+
+            for model, instances in models.items():
+                model.preload_to_dict_plan(
+                    instances, model.get_to_dict_plan(related_fields))
+
+    @classmethod
+    def load_relationship(cls, records, field):
+        """ Load the relationship of all the records by one query, as the
+        ``selectin`` loading of SQLAlchemy. The records whose relationship
+        is already loaded are not queried
+
+        :param records: instances of the model
+        :param field: name of the relationship
+        :rtype: list of the related instances without duplicate
+        """
+        prop = getattr(cls, field).property
+        missing = [x for x in records if field not in inspect(x).dict]
+        if missing:
+            if prop.direction is MANYTOONE:
+                cls.load_many2one_relationship(missing, prop)
             else:
-                # it is should be RelationshipProperty
-                if related_fields is None:
-                    # If there is no field list to the relation,
-                    # use only primary keys
-                    related_fields = field_property.mapper.entity
-                    related_fields = related_fields.get_primary_keys()
-                # One2One, One2Many, Many2One or Many2Many ?
-                if field_property.uselist:
-                    result[field] = [r.to_dict(*related_fields)
-                                     for r in field_value]
-                else:
-                    result[field] = field_value.to_dict(*related_fields)
+                cls.load_x2many_relationship(missing, prop)
 
-        return result
+        res = OrderedDict()
+        for record in records:
+            values = getattr(record, field)
+            if values is None:
+                continue
+            elif not prop.uselist:
+                values = [values]
+
+            for value in values:
+                res[id(value)] = value
+
+        return list(res.values())
+
+    @classmethod
+    def load_many2one_relationship(cls, records, prop):
+        """ Load the relationship from the foreign keys of the records, see
+        ``load_relationship``
+
+        :param records: instances of the model
+        :param prop: SQLAlchemy RelationshipProperty
+        """
+        locals_ = [x for x, y in prop.local_remote_pairs]
+        remotes = [y for x, y in prop.local_remote_pairs]
+        keys = [get_column_values(record, prop.parent, locals_)
+                for record in records]
+        identities = {x for x in keys if None not in x}
+        found = {}
+        if identities:
+            Model = prop.mapper.entity
+            query = Model.query().filter(
+                get_in_clause(remotes, list(identities)))
+            found = {get_column_values(x, prop.mapper, remotes): x
+                     for x in query.all()}
+
+        for record, key in zip(records, keys):
+            set_committed_value(record, prop.key, found.get(key))
+
+    @classmethod
+    def load_x2many_relationship(cls, records, prop):
+        """ Load the One2Many, the Many2Many and the backref of the One2One
+        of the records, see ``load_relationship``
+
+        :param records: instances of the model
+        :param prop: SQLAlchemy RelationshipProperty
+        """
+        Model = prop.mapper.entity
+        if prop.secondary is None:
+            locals_ = [x for x, y in prop.local_remote_pairs]
+            remotes = [y for x, y in prop.local_remote_pairs]
+            query = Model.query()
+        else:
+            locals_ = [x for x, y in prop.synchronize_pairs]
+            remotes = [y for x, y in prop.synchronize_pairs]
+            query = Model.query(Model, *remotes).join(
+                prop.secondary, prop.secondaryjoin)
+
+        records = [(record, get_column_values(record, prop.parent, locals_))
+                   for record in records]
+        # the pending records have not got yet their keys
+        records = [(record, key) for record, key in records
+                   if None not in key]
+        if not records:
+            return
+
+        query = query.filter(get_in_clause(
+            remotes, list({key for record, key in records})))
+        if prop.order_by:
+            query = query.order_by(*prop.order_by)
+
+        found = {}
+        if prop.secondary is None:
+            for instance in query.all():
+                found.setdefault(get_column_values(
+                    instance, prop.mapper, remotes), []).append(instance)
+        else:
+            for row in query:
+                found.setdefault(tuple(row[1:]), []).append(row[0])
+
+        for record, key in records:
+            values = found.get(key, [])
+            if not prop.uselist:
+                values = values[0] if values else None
+
+            set_committed_value(record, prop.key, values)
 
     @classmethod
     def getFieldType(cls, name):
@@ -394,6 +704,31 @@ def get_model_information(registry, registry_name):
     return model
 
 
+def get_column_values(instance, mapper, columns):
+    """ Return the values of the columns for the instance
+
+    :param instance: instance of the mapper
+    :param mapper: SQLAlchemy mapper
+    :param columns: the columns of the table of the mapper
+    :rtype: tuple of values
+    """
+    return tuple(getattr(instance, mapper.get_property_by_column(x).key)
+                 for x in columns)
+
+
+def get_in_clause(columns, identities):
+    """ Return the clause ``IN`` of the values of the columns
+
+    :param columns: list of the columns
+    :param identities: list of tuple of values
+    :rtype: SQLAlchemy clause
+    """
+    if len(columns) == 1:
+        return columns[0].in_([x[0] for x in identities])
+
+    return tuple_(*columns).in_(identities)
+
+
 @Declarations.register(Declarations.Core)
 class SqlBase(SqlMixin):
     """ this class is inherited by all the SQL model
@@ -597,3 +932,813 @@ class SqlBase(SqlMixin):
             cls.registry.flush()
 
         return instances
+
+    @classmethod
+    def has_orm_events(cls, eventtype):
+        """ Return True if SQLAlchemy listeners are defined for the event
+        of the instances of the model (``before_insert_orm_event``, ...)
+
+        :param eventtype: ``insert``, ``update`` or ``delete``
+        :rtype: Boolean
+        """
+        dispatch = cls.__mapper__.dispatch
+        return bool(getattr(dispatch, 'before_' + eventtype) or
+                    getattr(dispatch, 'after_' + eventtype))
+
+    @classmethod
+    def get_bulk_columns(cls):
+        """ Return the columns of the table of the model by field name
+
+        :rtype: dict {field name: (column key, field)}
+        """
+        mapper = cls.__mapper__
+        fields = get_model_information(cls.registry, cls.__registry_name__)
+        res = {}
+        for prop in mapper.column_attrs:
+            column = prop.columns[0]
+            if column.table is not mapper.local_table:
+                continue
+
+            name = prop.key
+            if name.startswith(anyblok_column_prefix):
+                name = name[len(anyblok_column_prefix):]
+
+            res[name] = (column.key, fields.get(name))
+
+        return res
+
+    @classmethod
+    def format_bulk_rows(cls, rows):
+        """ Return the rows for the table, the keys are the keys of the
+        columns, the values are formated as by the setter of the fields
+
+        :param rows: list of dict {field name: value}
+        :rtype: list of dict {column key: value}
+        :exception: SqlBaseException
+        """
+        columns = cls.get_bulk_columns()
+        formaters = {
+            name: field.setter_format_value
+            for name, (key, field) in columns.items()
+            if isinstance(field, Column) and (
+                type(field).setter_format_value is not
+                Field.setter_format_value)}
+        res = []
+        for row in rows:
+            if not isinstance(row, dict):
+                raise SqlBaseException("bulk method wait list of dict")
+
+            values = {}
+            for name, value in row.items():
+                if name not in columns:
+                    raise SqlBaseException(
+                        "%r is not a column of %r" % (
+                            name, cls.__registry_name__))
+
+                if name in formaters:
+                    value = formaters[name](value)
+
+                values[columns[name][0]] = value
+
+            res.append(values)
+
+        return res
+
+    @classmethod
+    def fill_bulk_insert_rows(cls, rows, columns):
+        """ Fill the sequences, by one query by sequence, and the
+        polymorphic identity of the rows to insert
+
+        :param rows: list of dict {column key: value}
+        :param columns: the columns by field name, see
+                        ``get_bulk_columns``
+        """
+        for name, (key, field) in columns.items():
+            if not isinstance(field, SequenceColumn):
+                continue
+
+            missing = [values for values in rows if key not in values]
+            if missing:
+                code = field.get_code(cls.__registry_name__, name)
+                nextvals = cls.registry.System.Sequence.nextvalsBy(
+                    len(missing), code=code)
+                for values, nextval in zip(missing, nextvals):
+                    values[key] = nextval
+
+        mapper = cls.__mapper__
+        if mapper.polymorphic_on is not None:
+            key = mapper.polymorphic_on.key
+            for values in rows:
+                values.setdefault(key, mapper.polymorphic_identity)
+
+    @classmethod
+    def group_bulk_rows(cls, rows):
+        """ Group the rows by filled columns, a multi rows statement needs
+        the same columns in all its rows
+
+        :param rows: list of dict
+        :rtype: list of tuple (indexes of the rows, rows)
+        """
+        groups = OrderedDict()
+        for index, row in enumerate(rows):
+            indexes, group = groups.setdefault(tuple(sorted(row)), ([], []))
+            indexes.append(index)
+            group.append(row)
+
+        return list(groups.values())
+
+    @classmethod
+    def bulk_insert(cls, rows, return_instances=False, chunk_size=1000,
+                    orm_events=True):
+        """ Insert in the table many entries of the model, without creating
+        the instances::
+
+            MyModel.bulk_insert([{...}, ...])
+
+        The entries are inserted by multi rows ``INSERT ... RETURNING``, one
+        query by chunk of rows with the same columns, or one query by row
+        if the database does not support ``RETURNING``. The default values
+        of the columns are applied as by ``insert``
+
+        .. warning::
+
+            The SQLAlchemy ORM events are not called, if ``orm_events`` is
+            True and the model listens the insert events, ``multi_insert``
+            is used. The relationships already loaded in the session are not
+            refreshed
+
+        :param rows: list of dict {field name: value}
+        :param return_instances: if True return the instances, else the
+                                 primary keys
+        :param chunk_size: max number of rows by query
+        :param orm_events: if False the ORM events are always skipped
+        :rtype: list of dict {primary key: value} or InstrumentedList
+        :exception: SqlBaseException
+        """
+        mapper = cls.__mapper__
+        if len(mapper.tables) > 1 or (
+            orm_events and cls.has_orm_events('insert')
+        ):
+            instances = cls.multi_insert(*rows)
+            if return_instances:
+                return instances
+
+            return [x.to_primary_keys() for x in instances]
+
+        cls.registry.flush()
+        rows = cls.format_bulk_rows(rows)
+        columns = cls.get_bulk_columns()
+        cls.fill_bulk_insert_rows(rows, columns)
+        pks = cls.get_mapper_primary_keys()
+        table = mapper.local_table
+        returning = [table.c[columns[pk][0]] for pk in pks]
+        implicit_returning = cls.registry.engine.dialect.implicit_returning
+        res = []
+        for start in range(0, len(rows), chunk_size):
+            chunk_res = [None] * len(rows[start:start + chunk_size])
+            for indexes, group in cls.group_bulk_rows(
+                rows[start:start + chunk_size]
+            ):
+                if implicit_returning:
+                    query = table.insert().values(group).returning(
+                        *returning)
+                    inserted = cls.registry.execute(query).fetchall()
+                else:
+                    # without RETURNING, one insert by row to get its keys
+                    inserted = [
+                        cls.registry.execute(
+                            table.insert(), values).inserted_primary_key
+                        for values in group]
+
+                for index, row in zip(indexes, inserted):
+                    chunk_res[index] = dict(zip(pks, row))
+
+            res.extend(chunk_res)
+
+        if res:
+            cls.registry.add_cache_dependencies([cls])
+            cls.registry.track_query_cache([cls])
+
+        if not return_instances:
+            return res
+
+        return cls.get_bulk_instances(res, chunk_size)
+
+    @classmethod
+    def get_bulk_instances(cls, pks_list, chunk_size):
+        """ Return the instances of the primary keys, by one query by chunk
+
+        :param pks_list: list of dict {primary key: value}
+        :param chunk_size: max number of instances by query
+        :rtype: InstrumentedList
+        """
+        instances = cls.registry.InstrumentedList()
+        for start in range(0, len(pks_list), chunk_size):
+            instances.extend(cls.from_primary_keys_many(
+                pks_list[start:start + chunk_size]))
+
+        return instances
+
+    @classmethod
+    def split_bulk_update_rows(cls, rows):
+        """ Split the rows to update in identity and values
+
+        :param rows: list of dict {primary key: value, field name: value}
+        :rtype: list of tuple (identity, dict {field name: value})
+        :exception: SqlBaseException
+        """
+        pks = cls.get_mapper_primary_keys()
+        res = []
+        for row in rows:
+            if not isinstance(row, dict):
+                raise SqlBaseException("bulk method wait list of dict")
+
+            values = dict(row)
+            try:
+                identity = tuple(values.pop(pk) for pk in pks)
+            except KeyError:
+                raise SqlBaseException(
+                    "The primary keys %r must be filled in %r" % (pks, row))
+
+            res.append((identity, values))
+
+        return res
+
+    @classmethod
+    def get_instances_from_session(cls, identities):
+        """ Return the instances of the identity map of the session, without
+        query
+
+        :param identities: list of tuple of primary key values
+        :rtype: list of the instances in the session
+        """
+        mapper = cls.__mapper__
+        session = cls.registry.session
+        session._autoflush()
+        identity_map = session.identity_map
+        res = []
+        for identity in identities:
+            instance = identity_map.get(
+                mapper.identity_key_from_primary_key(identity))
+            if instance is not None:
+                res.append(instance)
+
+        return res
+
+    @classmethod
+    def bulk_update(cls, rows, chunk_size=1000, orm_events=True):
+        """ Update many entries of the model with different values, without
+        loading the instances::
+
+            MyModel.bulk_update([{'id': 1, 'name': 'foo'}, ...])
+
+        The rows are grouped by updated columns, each group is updated by
+        executemany ``UPDATE ... WHERE`` on the primary keys. Only the
+        updated attributes of the instances in the session are expired
+
+        .. warning::
+
+            The SQLAlchemy ORM events are not called, if ``orm_events`` is
+            True and the model listens the update events, the instances are
+            loaded and updated
+
+        :param rows: list of dict {primary key: value, field name: value}
+        :param chunk_size: max number of rows by executemany
+        :param orm_events: if False the ORM events are always skipped
+        :rtype: number of updated entries
+        :exception: SqlBaseException
+        """
+        mapper = cls.__mapper__
+        pks = cls.get_mapper_primary_keys()
+        entries = cls.split_bulk_update_rows(rows)
+        if len(mapper.tables) > 1 or (
+            orm_events and cls.has_orm_events('update')
+        ):
+            instances = cls.from_primary_keys_many(
+                [dict(zip(pks, identity)) for identity, values in entries])
+            count = 0
+            for instance, (identity, values) in zip(instances, entries):
+                if instance is not None and values:
+                    instance.update(**values)
+                    count += 1
+
+            cls.registry.flush()
+            return count
+
+        cls.registry.flush()
+        groups = OrderedDict()
+        for identity, values in entries:
+            if values:
+                groups.setdefault(tuple(sorted(values)), []).append(
+                    (identity, values))
+
+        count = 0
+        for names, group in groups.items():
+            count += cls.bulk_update_group(names, group, chunk_size)
+
+        if count:
+            cls.registry.add_cache_dependencies([cls])
+            cls.registry.track_query_cache([cls])
+
+        return count
+
+    @classmethod
+    def bulk_update_group(cls, names, entries, chunk_size):
+        """ Update the entries with the same updated fields and expire the
+        instances of the session, see ``bulk_update``
+
+        :param names: the updated field names
+        :param entries: list of tuple (identity, dict {field name: value})
+        :param chunk_size: max number of rows by executemany
+        :rtype: number of updated entries
+        """
+        table = cls.__mapper__.local_table
+        columns = cls.get_bulk_columns()
+        pks = cls.get_mapper_primary_keys()
+        where_clause = [table.c[columns[pk][0]] == bindparam('_bulk_pk_' + pk)
+                        for pk in pks]
+        rows = cls.format_bulk_rows([values for identity, values in entries])
+        query = table.update().where(and_(*where_clause)).values({
+            key: bindparam('_bulk_value_' + key) for key in rows[0]})
+        params = [
+            dict([('_bulk_pk_' + pk, value)
+                  for pk, value in zip(pks, identity)] +
+                 [('_bulk_value_' + key, value)
+                  for key, value in row.items()])
+            for (identity, values), row in zip(entries, rows)]
+
+        instances = cls.get_instances_from_session(
+            [identity for identity, values in entries])
+        mappers = cls.find_remote_attribute_to_expire(*names)
+        for instance in instances:
+            instance.expire_relationship_mapped(mappers)
+
+        count = 0
+        for start in range(0, len(params), chunk_size):
+            count += cls.registry.execute(
+                query, params[start:start + chunk_size]).rowcount
+
+        cls.expire_bulk_updated_instances(instances, names)
+        return count
+
+    @classmethod
+    def expire_bulk_updated_instances(cls, instances, names):
+        """ Expire the updated attributes of the instances and the
+        relationships linked with them
+
+        :param instances: the instances of the session
+        :param names: the updated field names
+        """
+        if not instances or not names:
+            return
+
+        fields = cls.find_relationship(*names)
+        mappers = cls.find_remote_attribute_to_expire(*names)
+        for instance in instances:
+            cls.registry.expire(instance, fields)
+            instance.expire_relationship_mapped(mappers)
+
+    @classmethod
+    def upsert(cls, rows, conflict_fields=None, update_fields=None,
+               return_instances=False, chunk_size=1000, orm_events=True):
+        """ Insert the entries or update them if they already exist::
+
+            MyModel.upsert([{'code': 'foo', 'name': 'Foo'}, ...],
+                           conflict_fields=['code'])
+
+        On PostgreSQL, the rows are saved by multi rows
+        ``INSERT ... ON CONFLICT DO UPDATE``, one query by chunk of rows with
+        the same columns, the ``onupdate`` values of the columns are applied
+        to the updated entries. If a ``Sequence`` column is not filled, the
+        existing entries are first found by one query by chunk and updated
+        by ``bulk_update``, so no sequence value is drawn for them. Else the
+        existing entries are found by one query by chunk and saved by
+        ``bulk_update`` and ``bulk_insert``
+
+        .. warning::
+
+            The conflict fields must be the primary keys or the columns of
+            an unique constraint, a chunk can not have twice the same
+            conflict values
+
+        :param rows: list of dict {field name: value}
+        :param conflict_fields: fields to find the existing entries, by
+                                default the primary keys
+        :param update_fields: fields to update on the existing entries, by
+                              default the filled fields except the conflict
+                              fields and the primary keys
+        :param return_instances: if True return the instances, else the
+                                 primary keys
+        :param chunk_size: max number of rows by query
+        :param orm_events: if False the ORM events are always skipped
+        :rtype: list of dict {primary key: value} or InstrumentedList
+        :exception: SqlBaseException
+        """
+        rows = list(rows)
+        if conflict_fields is None:
+            conflict_fields = cls.get_mapper_primary_keys()
+
+        if (
+            cls.registry.engine.dialect.name != 'postgresql' or
+            len(cls.__mapper__.tables) > 1 or (
+                orm_events and (cls.has_orm_events('insert') or
+                                cls.has_orm_events('update')))
+        ):
+            res = cls.upsert_by_query(rows, conflict_fields, update_fields,
+                                      chunk_size, orm_events)
+        else:
+            res = cls.upsert_on_conflict(rows, conflict_fields, update_fields,
+                                         chunk_size)
+
+        if not return_instances:
+            return res
+
+        return cls.get_bulk_instances(res, chunk_size)
+
+    @classmethod
+    def get_upsert_update_fields(cls, names, conflict_fields, update_fields):
+        """ Return the fields to update for the rows with the filled fields
+        ``names``, see ``upsert``
+
+        :rtype: list of field names
+        """
+        if update_fields is not None:
+            return [x for x in update_fields if x in names]
+
+        excluded = set(conflict_fields) | set(cls.get_mapper_primary_keys())
+        return [x for x in names if x not in excluded]
+
+    @classmethod
+    def upsert_on_conflict(cls, rows, conflict_fields, update_fields,
+                           chunk_size):
+        """ Save the rows by ``INSERT ... ON CONFLICT DO UPDATE``, only for
+        PostgreSQL, see ``upsert``
+
+        :rtype: list of dict {primary key: value}
+        """
+        mapper = cls.__mapper__
+        table = mapper.local_table
+        cls.registry.flush()
+        columns = cls.get_bulk_columns()
+        pks = cls.get_mapper_primary_keys()
+        index_elements = [columns[x][0] for x in conflict_fields]
+        returning = [table.c[columns[pk][0]] for pk in pks]
+        updated = set()
+        res = []
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            chunk_res = [None] * len(chunk)
+            if cls.has_missing_sequences(chunk, columns):
+                # the existing entries are updated without insert, no
+                # sequence value is drawn for them
+                cls.upsert_existing_entries(
+                    chunk, chunk_res, conflict_fields, update_fields,
+                    chunk_size)
+
+            pending = [index for index, row_res in enumerate(chunk_res)
+                       if row_res is None]
+            for indexes, group in cls.group_bulk_rows(
+                [chunk[index] for index in pending]
+            ):
+                fields = cls.get_upsert_update_fields(
+                    sorted(group[0]), conflict_fields, update_fields)
+                # without field to update, the conflict column is updated
+                # by itself to return the primary keys of the entry
+                updated.update(fields)
+                keys = [columns[x][0] for x in fields]
+                set_ = cls.get_upsert_onupdate_values(keys) if keys else {}
+                updated.update(name for name, (key, field) in columns.items()
+                               if key in set_)
+                keys = keys or index_elements[:1]
+                values = cls.format_bulk_rows(group)
+                cls.fill_bulk_insert_rows(values, columns)
+                query = pg_insert(table).values(values)
+                set_.update({key: query.excluded[key] for key in keys})
+                query = query.on_conflict_do_update(
+                    index_elements=index_elements, set_=set_,
+                ).returning(*returning)
+                for index, row in zip(indexes, cls.registry.execute(query)):
+                    chunk_res[pending[index]] = dict(zip(pks, row))
+
+            res.extend(chunk_res)
+
+        if res:
+            cls.registry.add_cache_dependencies([cls])
+            cls.registry.track_query_cache([cls])
+            cls.expire_bulk_updated_instances(
+                cls.get_instances_from_session(
+                    [tuple(x[pk] for pk in pks) for x in res]),
+                tuple(sorted(updated)))
+
+        return res
+
+    @classmethod
+    def get_upsert_existing_entries(cls, rows, conflict_fields):
+        """ Return the conflict values of the rows and the primary keys of
+        the existing entries, found by one query, see ``upsert``
+
+        :param rows: list of dict {field name: value}
+        :param conflict_fields: fields to find the existing entries
+        :rtype: (list of tuple of conflict values by row,
+                 dict {conflict values: dict {primary key: value}})
+        :exception: SqlBaseException
+        """
+        table = cls.__mapper__.local_table
+        columns = cls.get_bulk_columns()
+        pks = cls.get_mapper_primary_keys()
+        conflict_columns = [table.c[columns[x][0]] for x in conflict_fields]
+        try:
+            keys = [tuple(row[x] for x in conflict_fields) for row in rows]
+        except KeyError:
+            raise SqlBaseException(
+                "The conflict fields %r must be filled" % (conflict_fields,))
+
+        cls.registry.flush()
+        query = select(conflict_columns + [
+            table.c[columns[pk][0]] for pk in pks]).where(or_(*[
+                and_(*[column == value
+                       for column, value in zip(conflict_columns, key)])
+                for key in set(keys)]))
+        existing = {
+            tuple(row[:len(conflict_columns)]): dict(
+                zip(pks, row[len(conflict_columns):]))
+            for row in cls.registry.execute(query)}
+        return keys, existing
+
+    @classmethod
+    def get_upsert_onupdate_values(cls, keys):
+        """ Return the ``onupdate`` values of the columns which are not
+        updated by the rows, ``ON CONFLICT DO UPDATE`` does not apply them.
+        A callable is called without execution context
+
+        :param keys: the keys of the updated columns
+        :rtype: dict {column key: value or SQL expression}
+        """
+        res = {}
+        for column in cls.__mapper__.local_table.columns:
+            onupdate = column.onupdate
+            if onupdate is None or column.key in keys:
+                continue
+
+            if onupdate.is_callable:
+                res[column.key] = onupdate.arg(None)
+            else:
+                res[column.key] = onupdate.arg
+
+        return res
+
+    @classmethod
+    def has_missing_sequences(cls, rows, columns):
+        """ Return True if a sequence column is not filled by one of the
+        rows, its value would be drawn for the row even if it is updated
+
+        :param rows: list of dict {field name: value}
+        :param columns: the columns by field name, see
+                        ``get_bulk_columns``
+        :rtype: boolean
+        """
+        names = [name for name, (key, field) in columns.items()
+                 if isinstance(field, SequenceColumn)]
+        return any(name not in row for row in rows for name in names)
+
+    @classmethod
+    def upsert_existing_entries(cls, rows, rows_res, conflict_fields,
+                                update_fields, chunk_size):
+        """ Update by ``bulk_update`` the rows whose entry exists and fill
+        their primary keys in ``rows_res``, see ``upsert_on_conflict``
+
+        :param rows: list of dict {field name: value}
+        :param rows_res: list of the primary keys by row, filled
+        """
+        # without all the conflict fields, the row can only be inserted
+        indexes = [index for index, row in enumerate(rows)
+                   if all(x in row for x in conflict_fields)]
+        if not indexes:
+            return
+
+        keys, existing = cls.get_upsert_existing_entries(
+            [rows[index] for index in indexes], conflict_fields)
+        updates = []
+        for index, key in zip(indexes, keys):
+            if key in existing:
+                row = rows[index]
+                rows_res[index] = existing[key]
+                fields = cls.get_upsert_update_fields(
+                    row, conflict_fields, update_fields)
+                updates.append(dict(
+                    existing[key], **{x: row[x] for x in fields}))
+
+        cls.bulk_update(updates, chunk_size=chunk_size, orm_events=False)
+
+    @classmethod
+    def upsert_by_query(cls, rows, conflict_fields, update_fields,
+                        chunk_size, orm_events):
+        """ Find the existing entries by one query by chunk, and save the
+        rows by ``bulk_update`` and ``bulk_insert``, see ``upsert``
+
+        :rtype: list of dict {primary key: value}
+        """
+        res = []
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            keys, existing = cls.get_upsert_existing_entries(
+                chunk, conflict_fields)
+            updates = []
+            inserts = []
+            for row, key in zip(chunk, keys):
+                if key in existing:
+                    fields = cls.get_upsert_update_fields(
+                        row, conflict_fields, update_fields)
+                    updates.append(dict(
+                        existing[key], **{x: row[x] for x in fields}))
+                else:
+                    inserts.append(row)
+
+            cls.bulk_update(updates, chunk_size=chunk_size,
+                            orm_events=orm_events)
+            inserted = iter(cls.bulk_insert(
+                inserts, chunk_size=chunk_size, orm_events=orm_events))
+            res.extend(existing[key] if key in existing else next(inserted)
+                       for key in keys)
+
+        return res
+
+    @classmethod
+    def bulk_delete(cls, query_or_pks, return_primary_keys=False,
+                    chunk_size=1000, orm_events=True):
+        """ Delete many entries of the model, without loading them::
+
+            MyModel.bulk_delete(MyModel.query().filter(...))
+            MyModel.bulk_delete([{'id': 1}, {'id': 2}])
+
+        The entries are deleted by one ``DELETE ... WHERE ... RETURNING``
+        for the query, or by chunk of primary keys. If the database does
+        not support ``RETURNING`` the primary keys are selected before the
+        delete. The deleted instances
+        of the session are expunged and the relationships of the remote
+        instances linked with them are expired only one time
+
+        .. warning::
+
+            The SQLAlchemy ORM events are not called, if ``orm_events`` is
+            True and the model listens the delete events, the instances are
+            loaded and deleted by the ORM. As ``delete(byquery=True)`` the
+            entries of the Many2Many tables are not removed
+
+        :param query_or_pks: query of the model or list of dict
+                             {primary key: value}
+        :param return_primary_keys: if True return the primary keys of the
+                                    deleted entries, else their number
+        :param chunk_size: max number of primary keys by query
+        :param orm_events: if False the ORM events are always skipped
+        :rtype: number of deleted entries or list of dict {primary key: value}
+        :exception: SqlBaseException
+        """
+        mapper = cls.__mapper__
+        pks = cls.get_mapper_primary_keys()
+        if len(mapper.tables) > 1 or (
+            orm_events and cls.has_orm_events('delete')
+        ):
+            if isinstance(query_or_pks, Query):
+                instances = query_or_pks.all()
+            else:
+                instances = [
+                    x for x in cls.from_primary_keys_many(query_or_pks)
+                    if x is not None]
+
+            res = []
+            for instance in instances:
+                if instance not in cls.registry.session.deleted:
+                    res.append(instance.to_primary_keys())
+                    instance.delete(flush=False)
+
+            cls.registry.flush()
+            return res if return_primary_keys else len(res)
+
+        cls.registry.flush()
+        table = mapper.local_table
+        columns = cls.get_bulk_columns()
+        pk_columns = [table.c[columns[pk][0]] for pk in pks]
+        if isinstance(query_or_pks, Query):
+            # the query selects the same table as the delete, it must not
+            # be correlated with it
+            where_clauses = [cls.get_bulk_delete_where_clause(
+                pk_columns, query_or_pks.with_entities(
+                    *pk_columns).statement.correlate(None))]
+        else:
+            identities = cls.get_bulk_delete_identities(query_or_pks)
+            where_clauses = [
+                cls.get_bulk_delete_where_clause(
+                    pk_columns, identities[start:start + chunk_size])
+                for start in range(0, len(identities), chunk_size)]
+
+        implicit_returning = cls.registry.engine.dialect.implicit_returning
+        deleted = []
+        for where_clause in where_clauses:
+            if implicit_returning:
+                query = table.delete().where(where_clause).returning(
+                    *pk_columns)
+                deleted.extend(
+                    tuple(row) for row in cls.registry.execute(query))
+                continue
+
+            # without RETURNING, select the primary keys then delete them
+            query = select(pk_columns).where(where_clause)
+            identities = [tuple(row) for row in cls.registry.execute(query)]
+            for start in range(0, len(identities), chunk_size):
+                chunk = identities[start:start + chunk_size]
+                cls.registry.execute(table.delete().where(
+                    cls.get_bulk_delete_where_clause(pk_columns, chunk)))
+                deleted.extend(chunk)
+
+        if deleted:
+            cls.registry.add_cache_dependencies([cls])
+            cls.registry.track_query_cache([cls])
+            cls.expunge_bulk_deleted_instances(
+                cls.get_instances_from_session(deleted))
+
+        if return_primary_keys:
+            return [dict(zip(pks, identity)) for identity in deleted]
+
+        return len(deleted)
+
+    @classmethod
+    def get_bulk_delete_identities(cls, pks_list):
+        """ Return the identities of the primary keys without duplicate,
+        see ``bulk_delete``
+
+        :param pks_list: list of dict {primary key: value}
+        :rtype: list of tuple of primary key values
+        :exception: SqlBaseException
+        """
+        res = []
+        for pks in pks_list:
+            identity = cls.get_identity_from_primary_keys(**pks)
+            if identity is None:
+                raise SqlBaseException(
+                    "The primary keys %r do not match with the primary keys "
+                    "of %r" % (pks, cls.__registry_name__))
+
+            if identity not in res:
+                res.append(identity)
+
+        return res
+
+    @classmethod
+    def get_bulk_delete_where_clause(cls, pk_columns, identities):
+        """ Return the where clause of the entries to delete, see
+        ``bulk_delete``
+
+        :param pk_columns: the primary key columns of the table
+        :param identities: list of tuple of primary key values or select
+                           of the primary key columns
+        :rtype: SQLAlchemy clause
+        """
+        if len(pk_columns) == 1:
+            if isinstance(identities, list):
+                identities = [x[0] for x in identities]
+
+            return pk_columns[0].in_(identities)
+
+        return tuple_(*pk_columns).in_(identities)
+
+    @classmethod
+    def expunge_bulk_deleted_instances(cls, instances):
+        """ Expire the relationships of the remote instances linked with
+        the deleted instances, only one time by remote instance, and
+        expunge the deleted instances from the session
+
+        Only the relationships already loaded by the deleted instances are
+        read, the others are never loaded
+
+        :param instances: the deleted instances of the session
+        """
+        if not instances:
+            return
+
+        model = cls.registry.loaded_namespaces_first_step[
+            cls.__registry_name__]
+        mappers = cls.find_remote_attribute_to_expire(*model.keys())
+        remotes = OrderedDict()
+        for instance in instances:
+            # only the loaded relationships, loading the others would
+            # execute one query by instance and relationship
+            loaded = inspect(instance).dict
+            for field_name, rfields in mappers.items():
+                if field_name not in loaded:
+                    continue
+
+                values = loaded[field_name]
+                if not isinstance(values, list):
+                    values = [values]
+
+                for value in values:
+                    if value is not None:
+                        remotes.setdefault(id(value), (value, set()))[
+                            1].update(rfields)
+
+        for value, rfields in remotes.values():
+            value.expire(*rfields)
+
+        for instance in instances:
+            instance.expunge()
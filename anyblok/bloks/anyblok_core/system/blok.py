@@ -240,11 +240,17 @@ class Blok:
         if bloks:
             bloks.load()
 
-    @classmethod_cache()
+    @classmethod_cache(shared=True)
     def is_installed(cls, blok_name):
         return cls.query().filter_by(name=blok_name,
                                      state='installed').count() != 0
 
+    @classmethod
+    def warm_up_cache(cls):
+        super(Blok, cls).warm_up_cache()
+        for blok_name in BlokManager.ordered_bloks:
+            cls.is_installed(blok_name)
+
     @listen('Model.System.Blok', 'Update installed blok')
     def listen_update_installed_blok(cls):
         cls.registry.System.Cache.invalidate(
@@ -5,11 +5,16 @@
 # This Source Code Form is subject to the terms of the Mozilla Public License,
 # v. 2.0. If a copy of the MPL was not distributed with this file,You can
 # obtain one at http://mozilla.org/MPL/2.0/.
+from sqlalchemy import select, func
+from uuid import uuid4
+from logging import getLogger
 from anyblok.declarations import Declarations
+from anyblok.environment import EnvironmentManager
 from anyblok.column import String, Integer
 from ..exceptions import CacheException
 
 
+logger = getLogger(__name__)
 register = Declarations.register
 System = Declarations.Model.System
 
@@ -19,6 +24,9 @@ class Cache:
 
     last_cache_id = None
     lrus = {}
+    incarnation_key = 'anyblok.database.incarnation'
+    query_cache_method = '__query_cache__'
+    compact_marker = '__compact__'
 
     id = Integer(primary_key=True)
     registry_name = String(nullable=False)
@@ -40,47 +48,173 @@ class Cache:
         """
         super(Cache, cls).initialize_model()
         cls.last_cache_id = cls.get_last_id()
+        registry = cls.registry
+        if registry.shared_cache_options is not None:
+            registry.open_shared_cache(cls.get_database_incarnation())
+            registry.shared_cache.check_version(cls.last_cache_id)
+            # the invalidations of a method can be removed by ``compact``,
+            # the last id is greater than all of them
+            registry.cache_version_floor = cls.last_cache_id
+            registry.cache_versions = cls.get_versions()
 
     @classmethod
-    def invalidate_all(cls):
-        res = []
-        for registry_name, methods in cls.registry.caches.items():
-            for method in methods.keys():
-                res.append(dict(registry_name=registry_name, method=method))
+    def get_database_incarnation(cls):
+        """ Return the uuid of the database, saved in **System.Parameter**
+        the first time, a recreated database gets another uuid
 
-        if res:
-            cls.multi_insert(*res)
+        :rtype: str
+        """
+        Parameter = cls.registry.System.Parameter
+        if Parameter.is_exist(cls.incarnation_key):
+            return Parameter.get(cls.incarnation_key)
+
+        incarnation = uuid4().hex
+        Parameter.set(cls.incarnation_key, incarnation)
+        return incarnation
 
-        cls.clear_invalidate_cache()
+    @classmethod
+    def get_versions(cls):
+        """ Return the id of the last invalidation of each method
+
+        :rtype: dict {(namespace, method): id}
+        """
+        table = cls.__table__
+        query = select(
+            [table.c.registry_name, table.c.method, func.max(table.c.id)]
+        ).group_by(table.c.registry_name, table.c.method)
+        return {(registry_name, method): id_
+                for registry_name, method, id_ in cls.registry.execute(query)}
+
+    @classmethod
+    def invalidate_all(cls):
+        cls.add_invalidations(
+            (registry_name, method)
+            for registry_name, methods in cls.registry.caches.items()
+            for method in methods.keys())
 
     @classmethod
     def invalidate(cls, registry_name, method):
         """ Call the invalidation for a specific method cached on a model
 
+        The cache is cleared at once in this process, the invalidation is
+        saved at the commit for the other processes
+
         :param registry_name: namespace of the model
         :param method: name of the method on the model
         :exception: CacheException
         """
         caches = cls.registry.caches
+        if hasattr(registry_name, '__registry_name__'):
+            registry_name = registry_name.__registry_name__
+
+        if registry_name not in caches:
+            raise CacheException(
+                "Unknown cached model %r" % registry_name)
+
+        if method not in caches[registry_name]:
+            raise CacheException("Unknown cached method %r" % method)
+
+        cls.add_invalidations([(registry_name, method)])
+
+    @classmethod
+    def add_invalidations(cls, invalidations):
+        """ Clear the caches in this process and keep the invalidations,
+        without duplicate, to save them at the commit of the transaction
+        (see ``apply_invalidations``)
+
+        :param invalidations: iterable of (namespace, method)
+        """
+        pending = cls.get_pending_invalidations()
+        caches = cls.registry.caches
+        bypass = cls.registry.cache_bypass
+        for registry_name, method in invalidations:
+            if (registry_name, method) not in pending:
+                pending.add((registry_name, method))
+                bypass[(registry_name, method)] = bypass.get(
+                    (registry_name, method), 0) + 1
+
+            for cache in caches[registry_name][method]:
+                cache.cache_clear()
+
+    @classmethod
+    def get_pending_invalidations(cls):
+        """ Return the invalidations of the transaction, saved at the
+        commit
+
+        :rtype: set of (namespace, method)
+        """
+        pending = EnvironmentManager.get('_cache_invalidations')
+        if pending is None:
+            pending = set()
+            EnvironmentManager.set('_cache_invalidations', pending)
 
-        def insert(registry_name=None, method=None):
-            if registry_name in caches:
-                if method in caches[registry_name]:
-                    cls.insert(registry_name=registry_name, method=method)
-                else:
-                    raise CacheException(
-                        "Unknown cached method %r" % method)
-            else:
-                raise CacheException(
-                    "Unknown cached model %r" % registry_name)
+        return pending
 
-        if isinstance(registry_name, str):
-            insert(registry_name=registry_name, method=method)
-        elif hasattr(registry_name, '__registry_name__'):
-            insert(registry_name=registry_name.__registry_name__,
-                   method=method)
+    @classmethod
+    def add_query_cache_invalidations(cls, models):
+        """ Keep the models modified by the transaction, at the commit the
+        other processes are told to remove their rows of ``Query.cached``
+        which read the tables of these models
 
-        cls.clear_invalidate_cache()
+        :param models: the assembled models modified in the transaction
+        """
+        pending = cls.get_pending_invalidations()
+        for model in models:
+            pending.add((model.__registry_name__, cls.query_cache_method))
+
+    @classmethod
+    def invalidate_query_cache(cls, invalidations):
+        """ Remove the rows of ``Query.cached`` which read the tables of
+        the models modified by the other processes
+
+        :param invalidations: iterable of (namespace, method)
+        """
+        registry = cls.registry
+        tables = {
+            table.fullname
+            for registry_name, method in invalidations
+            if (method == cls.query_cache_method and
+                registry_name in registry.loaded_namespaces)
+            for table in registry.get(registry_name).__mapper__.tables}
+        if tables:
+            registry.query_cache.invalidate_tables(tables)
+
+    @classmethod
+    def apply_invalidations(cls):
+        """ Save the invalidations of the transaction with one insert, called
+        by the commit of the registry before the commit of the session
+        """
+        invalidations = EnvironmentManager.get('_cache_invalidations')
+        if not invalidations:
+            return
+
+        EnvironmentManager.set('_cache_invalidations', set())
+        invalidations = tuple(sorted(invalidations))
+        cls.registry.execute(cls.__table__.insert().values([
+            dict(registry_name=registry_name, method=method)
+            for registry_name, method in invalidations]))
+        cls.postcommit_hook('notify_invalidation')
+        cls.postcommit_hook('release_invalidations', invalidations,
+                            call_only_if='always')
+
+    @classmethod
+    def notify_invalidation(cls):
+        """ Notify the registries of the other processes, by the cache
+        invalidation transport, that they must check the invalidations
+        """
+        cls.registry.publish_cache_invalidation()
+
+    @classmethod
+    def release_invalidations(cls, invalidations):
+        """ The shared cache can be used again for the invalidated methods
+        once their new version is known, called after the commit
+
+        :param invalidations: tuple of (namespace, method)
+        """
+        if cls.registry.shared_cache is not None:
+            cls.clear_invalidate_cache()
+
+        cls.registry.release_cache_bypass(invalidations)
 
     @classmethod
     def detect_invalidation(cls):
@@ -90,18 +224,87 @@ class Cache:
         """
         return cls.last_cache_id < cls.get_last_id()
 
+    @classmethod
+    def get_new_invalidations(cls, connection=None):
+        """ Return the invalidations saved since the last known id and move
+        the last known id, the detection and the fetch are done by the same
+        query
+
+        :param connection: SQLAlchemy connection, by default the session
+        :rtype: set of (namespace, method)
+        """
+        table = cls.__table__
+        query = select(
+            [table.c.id, table.c.registry_name, table.c.method]
+        ).where(table.c.id > cls.last_cache_id)
+        if connection is None:
+            connection = cls.registry
+
+        rows = connection.execute(query).fetchall()
+        invalidations = set()
+        if cls.has_lost_invalidations(rows):
+            invalidations.update(cls.clear_all_caches(
+                max(row[0] for row in rows)))
+
+        versions = cls.registry.cache_versions
+        for id_, registry_name, method in rows:
+            if registry_name == cls.compact_marker:
+                cls.last_cache_id = max(cls.last_cache_id, id_)
+                continue
+
+            invalidations.add((registry_name, method))
+            cls.last_cache_id = max(cls.last_cache_id, id_)
+            versions[(registry_name, method)] = max(
+                versions.get((registry_name, method), 0), id_)
+
+        return invalidations
+
+    @classmethod
+    def has_lost_invalidations(cls, rows):
+        """ Return True if ``compact`` has removed invalidations not read
+        yet by this process, the marker saved by ``compact`` gives the
+        last id removed
+
+        :param rows: the new rows (id, registry_name, method)
+        :rtype: boolean
+        """
+        return any(
+            registry_name == cls.compact_marker and
+            int(method) > cls.last_cache_id
+            for id_, registry_name, method in rows)
+
+    @classmethod
+    def clear_all_caches(cls, last_id):
+        """ Forget all the caches of this process, used when some
+        invalidations have been lost
+
+        :param last_id: the last id of the invalidations, the version of
+                        the methods in the shared cache
+        :rtype: set of (namespace, method) of all the cached methods
+        """
+        registry = cls.registry
+        logger.warning("Invalidations have been removed by compact before "
+                       "being read, clear all the caches of %r",
+                       registry.db_name)
+        registry.query_cache.clear()
+        # the versions known by this process may be too old
+        registry.cache_versions = {}
+        registry.cache_version_floor = last_id
+        return {(registry_name, method)
+                for registry_name, methods in registry.caches.items()
+                for method in methods.keys()}
+
     @classmethod
     def get_invalidation(cls):
         """ Return the pointer of the method to invalidate
         """
         res = []
-        if cls.detect_invalidation():
-            caches = cls.registry.caches
-            for i in cls.query().filter(cls.id > cls.last_cache_id).all():
-                res.extend(caches[i.registry_name][i.method])
-
-            cls.last_cache_id = cls.get_last_id()
+        caches = cls.registry.caches
+        invalidations = cls.get_new_invalidations()
+        for registry_name, method in invalidations:
+            res.extend(caches.get(registry_name, {}).get(method, []))
 
+        cls.invalidate_query_cache(invalidations)
         return res
 
     @classmethod
@@ -110,3 +313,54 @@ class Cache:
         """
         for cache in cls.get_invalidation():
             cache.cache_clear()
+
+    @classmethod
+    def check_invalidation(cls, connection):
+        """ Clear the caches invalidated since the last check
+
+        The query is executed by the connection to be usable during the
+        beginning of a transaction of the session
+
+        :param connection: SQLAlchemy connection
+        :rtype: Boolean, True if caches have been invalidated
+        """
+        caches = cls.registry.caches
+        invalidations = cls.get_new_invalidations(connection=connection)
+        for registry_name, method in invalidations:
+            for cache in caches.get(registry_name, {}).get(method, []):
+                cache.cache_clear()
+
+        cls.invalidate_query_cache(invalidations)
+        return bool(invalidations)
+
+    @classmethod
+    def compact(cls, consumed_id=None):
+        """ Remove the invalidations which are useless for every process
+
+        * an invalidation followed by a newer invalidation of the same
+          method: a process which has not read the older one will read
+          the newer one
+        * the invalidations until ``consumed_id``, if the caller knows
+          that all the living processes have read them, except the last
+          one: the last id must never go backwards (see
+          ``anyblok.shared_cache``). A marker saves ``consumed_id``, a
+          process which had not read until it clears all its caches
+
+        :param consumed_id: id of the last invalidation read by all the
+                            processes
+        :rtype: number of removed invalidations
+        """
+        table = cls.__table__
+        last_ids = select([func.max(table.c.id)]).group_by(
+            table.c.registry_name, table.c.method)
+        where = ~table.c.id.in_(last_ids)
+        if consumed_id is not None:
+            last_id = select([func.max(table.c.id)]).as_scalar()
+            where |= (table.c.id <= consumed_id) & (table.c.id < last_id)
+
+        count = cls.registry.execute(table.delete().where(where)).rowcount
+        if consumed_id is not None:
+            cls.registry.execute(table.insert().values(
+                registry_name=cls.compact_marker, method=str(consumed_id)))
+
+        return count
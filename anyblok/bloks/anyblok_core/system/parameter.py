@@ -35,11 +35,7 @@ class Parameter:
         else:
             multi = True
 
-        if cls.is_exist(key):
-            param = cls.from_primary_keys(key=key)
-            param.update(value=value, multi=multi)
-        else:
-            cls.insert(key=key, value=value, multi=multi)
+        cls.upsert([dict(key=key, value=value, multi=multi)])
 
     @classmethod
     def is_exist(cls, key):
@@ -48,8 +44,7 @@ class Parameter:
         :param key: key to check
         :rtype: Boolean, True if exist
         """
-        query = cls.query().filter(cls.key == key)
-        return True if query.count() else False
+        return cls.from_primary_keys(key=key) is not None
 
     @classmethod
     def get(cls, key):
@@ -59,11 +54,11 @@ class Parameter:
         :rtype: return value
         :exception: ExceptionParameter
         """
-        if not cls.is_exist(key):
+        param = cls.from_primary_keys(key=key)
+        if param is None:
             raise ParameterException(
                 "unexisting key %r" % key)
 
-        param = cls.from_primary_keys(key=key)
         if param.multi:
             return param.value
 
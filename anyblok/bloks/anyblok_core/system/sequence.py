@@ -6,7 +6,7 @@
 # v. 2.0. If a copy of the MPL was not distributed with this file,You can
 # obtain one at http://mozilla.org/MPL/2.0/.
 from anyblok import Declarations
-from sqlalchemy import Sequence as SQLASequence
+from sqlalchemy import Sequence as SQLASequence, select, func
 from anyblok.column import Integer, String
 
 
@@ -79,6 +79,21 @@ class Sequence:
         self.update(number=nextval)
         return self.formater.format(code=self.code, seq=nextval, id=self.id)
 
+    def nextvals(self, count):
+        """ return the ``count`` next values of the sequence, by one query
+
+        :param count: number of values
+        :rtype: list of the formated values
+        """
+        query = select([func.nextval(self.seq_name)]).select_from(
+            func.generate_series(1, count))
+        values = [x[0] for x in self.registry.execute(query)]
+        if values:
+            self.update(number=values[-1])
+
+        return [self.formater.format(code=self.code, seq=x, id=self.id)
+                for x in values]
+
     @classmethod
     def nextvalBy(cls, **kwargs):
         """ Get the first sequence filtering by entries and return the next
@@ -90,3 +105,20 @@ class Sequence:
             return seq.nextval()
 
         return None
+
+    @classmethod
+    def nextvalsBy(cls, count, **kwargs):
+        """ Get the first sequence filtering by entries and return the
+        ``count`` next values """
+        filters = [getattr(cls, k) == v for k, v in kwargs.items()]
+        seq = cls.query().filter(*filters).first()
+        if seq is None:
+            return [None] * count
+
+        return seq.nextvals(count)
+
+    @classmethod
+    def bulk_insert(cls, rows, **kwargs):
+        """ Overwrite bulk_insert """
+        res = [cls.create_sequence(dict(x)) for x in rows]
+        return super(Sequence, cls).bulk_insert(res, **kwargs)
@@ -111,3 +111,46 @@ class TestQuery(BlokTestCase):
         dictall = query.dictall()
         for i in range(2):
             self.assertIn(to_dict(models[i]), dictall)
+
+    def test_dictiter(self):
+        query = self.registry.System.Model.query().order_by(
+            self.registry.System.Model.name)
+        self.assertEqual(list(query.dictiter(batch_size=2)), query.dictall())
+
+    def test_dictiter_on_some_column(self):
+        M = self.registry.System.Model
+        query = M.query('name', M.table.label('t2')).order_by(M.name)
+        self.assertEqual(list(query.dictiter(batch_size=2)), query.dictall())
+
+    def test_iter_batches(self):
+        Model = self.registry.System.Model
+        query = Model.query().order_by(Model.name)
+        names = query.all().name
+        self.registry.expunge_all()
+        batches = []
+        for batch in query.iter_batches(2):
+            self.assertIsInstance(batch, self.registry.InstrumentedList)
+            self.assertLessEqual(len(batch), 2)
+            batches.append(batch)
+
+        self.assertEqual([x for batch in batches for x in batch.name], names)
+
+    def test_iter_batches_expunge_the_previous_batch(self):
+        Model = self.registry.System.Model
+        query = Model.query().order_by(Model.name)
+        self.registry.expunge_all()
+        batches = list(query.iter_batches(2))
+        self.assertGreater(len(batches), 1)
+        self.assertNotIn(batches[0][0], self.registry.session)
+
+    def test_iter_batches_keep_the_modified_instances(self):
+        Model = self.registry.System.Model
+        query = Model.query().order_by(Model.name)
+        self.registry.expunge_all()
+        batches = []
+        for batch in query.iter_batches(2):
+            batch[0].description = 'modified'
+            batches.append(batch)
+
+        self.assertIn(batches[0][0], self.registry.session)
+        self.assertNotIn(batches[0][1], self.registry.session)
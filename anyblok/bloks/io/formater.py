@@ -211,7 +211,7 @@ class Many2Many(IO.Formater):
                 "All values in %r for %r must be dict" % (
                     value, self.__registry_name__))
 
-        return [Model.from_primary_keys(**x) for x in pks if x]
+        return Model.from_primary_keys_many([x for x in pks if x])
 
     def externalIdStr2value(self, values, model):
         if not values:
@@ -104,13 +104,32 @@ class Mapping:
         """
         query = cls.query()
         query = query.filter(cls.filter_by_model_and_key(model, key))
-        if query.count():
-            pks = query.first().primary_key
+        mapping = query.first()
+        if mapping is not None:
+            pks = mapping.primary_key
             cls.check_primary_keys(model, *pks.keys())
             return pks
 
         return None
 
+    @classmethod
+    def exist_in_database(cls, model, key):
+        """ return True if the linked entry exists in the database, the
+        instances of the session are not used because the entry may have
+        been removed by another way than the session
+
+        :param model: model of the mapping
+        :param key: string of the key
+        :rtype: Boolean
+        """
+        pks = cls.get_mapping_primary_keys(model, key)
+        if pks is None:
+            return False
+
+        Model = cls.get_model(model)
+        where_clause = Model.get_where_clause_from_primary_keys(**pks)
+        return Model.query().filter(*where_clause).count() > 0
+
     @classmethod
     def check_primary_keys(cls, model, *pks):
         """ check if the all the primary keys match with primary keys of the
@@ -245,7 +264,7 @@ class Mapping:
             for model in models:
                 query = cls.query().filter_by(blokname=blokname, model=model)
                 for key in query.all().key:
-                    if cls.get(model, key) is None:
+                    if not cls.exist_in_database(model, key):
                         cls.delete(model, key)
                         removed += 1
 
@@ -0,0 +1,197 @@
+# This file is a part of the AnyBlok project
+#
+#    Copyright (C) 2018 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+""" Transports which notify the registries of the other processes that
+caches have been invalidated
+
+The invalidations are always saved in the table of **Model.System.Cache**,
+the transport only tells the registries, which subscribe for the database,
+that they must check the table at the beginning of their next transaction,
+instead of waiting for the interval of ``cache_invalidation_interval``
+
+The transport class is defined by the plugin option
+``--cache-invalidation-transport-cls``::
+
+    anyblok_wsgi --cache-invalidation-transport-cls \\
+        anyblok.cache_invalidation:SocketTransport
+
+"""
+import os
+from glob import glob
+from logging import getLogger
+from socket import socket, AF_UNIX, SOCK_DGRAM, SHUT_RDWR
+from tempfile import gettempdir
+from threading import Thread
+from uuid import uuid4
+from .config import Configuration
+
+logger = getLogger(__name__)
+
+
+class CacheInvalidationTransport:
+    """ Base class of the transports
+
+    :meth:`publish` is called after the commit of a transaction which
+    invalidated caches, the callbacks subscribed for the same database, in
+    all the processes, are called without argument
+    """
+
+    def __init__(self):
+        self.subscriptions = []
+
+    def publish(self, db_name):
+        """ Notify the subscribers of the database
+
+        :param db_name: name of the database
+        """
+        raise NotImplementedError
+
+    def subscribe(self, db_name, callback):
+        """ Call the callback when an invalidation is published for the
+        database
+
+        :param db_name: name of the database
+        :param callback: callable without argument
+        """
+        self.subscriptions.append((db_name, callback))
+
+    def unsubscribe(self):
+        """ Release the subscriptions of this transport """
+        self.subscriptions = []
+
+    def after_fork(self):
+        """ Called in the child process after a fork, the subscriptions
+        inherited from the parent process must be replaced """
+
+
+class LocalTransport(CacheInvalidationTransport):
+    """ Notify the subscribers of the current process only """
+
+    subscribers = {}
+
+    def publish(self, db_name):
+        for callback in list(self.subscribers.get(db_name, [])):
+            callback()
+
+    def subscribe(self, db_name, callback):
+        super(LocalTransport, self).subscribe(db_name, callback)
+        self.subscribers.setdefault(db_name, []).append(callback)
+
+    def unsubscribe(self):
+        for db_name, callback in self.subscriptions:
+            callbacks = self.subscribers.get(db_name, [])
+            if callback in callbacks:
+                callbacks.remove(callback)
+
+        super(LocalTransport, self).unsubscribe()
+
+
+class SocketTransport(CacheInvalidationTransport):
+    """ Notify the subscribers of all the processes of the host by the
+    local (unix) datagram sockets
+
+    Each subscription binds a socket in the directory of the database, a
+    daemon thread waits for the notifications. The sockets of the dead
+    processes are removed by the next publication
+
+    :param directory: by default the option ``cache_invalidation_socket_dir``
+                      or a directory in the temporary directory
+    """
+
+    def __init__(self, directory=None):
+        super(SocketTransport, self).__init__()
+        if directory is None:
+            directory = Configuration.get('cache_invalidation_socket_dir')
+
+        if directory is None:
+            directory = os.path.join(gettempdir(),
+                                     'anyblok-cache-invalidation')
+
+        self.directory = directory
+        self.sockets = []
+
+    def get_directory(self, db_name):
+        return os.path.join(self.directory, db_name)
+
+    def publish(self, db_name):
+        sock = socket(AF_UNIX, SOCK_DGRAM)
+        sock.setblocking(False)
+        try:
+            for path in glob(os.path.join(self.get_directory(db_name),
+                                          '*.sock')):
+                try:
+                    sock.sendto(b'1', path)
+                except ConnectionRefusedError:
+                    # nobody listens to this socket any more
+                    self.remove_socket_file(path)
+                except (BlockingIOError, FileNotFoundError):
+                    # the subscriber has already got notifications to
+                    # read, or it has just unsubscribed
+                    pass
+        finally:
+            sock.close()
+
+    def subscribe(self, db_name, callback):
+        super(SocketTransport, self).subscribe(db_name, callback)
+        directory = self.get_directory(db_name)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(
+            directory, '%d-%s.sock' % (os.getpid(), uuid4().hex[:16]))
+        sock = socket(AF_UNIX, SOCK_DGRAM)
+        sock.bind(path)
+        self.sockets.append((sock, path))
+        thread = Thread(target=self.listen, args=(sock, callback),
+                        daemon=True)
+        thread.start()
+
+    def listen(self, sock, callback):
+        while True:
+            try:
+                data = sock.recv(64)
+            except OSError:
+                return
+
+            if not data:
+                # the socket has been shut down by unsubscribe
+                return
+
+            try:
+                callback()
+            except Exception:
+                logger.exception("Cache invalidation notification failed")
+
+    @staticmethod
+    def remove_socket_file(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def unsubscribe(self):
+        for sock, path in self.sockets:
+            self.remove_socket_file(path)
+            try:
+                sock.shutdown(SHUT_RDWR)
+            except OSError:
+                pass
+
+            sock.close()
+
+        self.sockets = []
+        super(SocketTransport, self).unsubscribe()
+
+    def after_fork(self):
+        # the listening threads do not exist in the child process and the
+        # socket files belong to the parent process
+        for sock, path in self.sockets:
+            sock.close()
+
+        self.sockets = []
+        subscriptions = self.subscriptions
+        self.subscriptions = []
+        for db_name, callback in subscriptions:
+            self.subscribe(db_name, callback)
@@ -939,13 +939,17 @@ class Sequence(String):
         res['formater'] = self.formater
         return res
 
+    def get_code(self, namespace, fieldname):
+        """ Return the code of the **Model.System.Sequence** """
+        return self.code if self.code else "%s=>%s" % (namespace, fieldname)
+
     def wrap_default(self, registry, namespace, fieldname, properties):
         if not hasattr(registry, '_need_sequence_to_create_if_not_exist'):
             registry._need_sequence_to_create_if_not_exist = []
         elif registry._need_sequence_to_create_if_not_exist is None:
             registry._need_sequence_to_create_if_not_exist = []
 
-        code = self.code if self.code else "%s=>%s" % (namespace, fieldname)
+        code = self.get_code(namespace, fieldname)
         registry._need_sequence_to_create_if_not_exist.append(
             {'code': code, 'formater': self.formater})
 
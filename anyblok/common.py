@@ -6,8 +6,12 @@
 # v. 2.0. If a copy of the MPL was not distributed with this file,You can
 # obtain one at http://mozilla.org/MPL/2.0/.
 import sys
-from functools import lru_cache
+from collections import OrderedDict
+from functools import lru_cache, partial
+from threading import Lock
+from time import monotonic
 from sqlalchemy.schema import ForeignKeyConstraint
+from .shared_cache import shared_cache_method
 
 
 """Define the prefixe for the mapper attribute for the column"""
@@ -99,10 +103,289 @@ class TypeList(list):
             super(TypeList, self).extend(newbases)
 
 
+def get_size(value, seen=None):
+    """ Return the approximative size in bytes of the value, the items of
+    the built-in containers are counted
+
+    :param value: the value to measure
+    :rtype: int
+    """
+    if seen is None:
+        seen = set()
+
+    if id(value) in seen:
+        return 0
+
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for key, item in value.items():
+            size += get_size(key, seen) + get_size(item, seen)
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        for item in value:
+            size += get_size(item, seen)
+
+    return size
+
+
+def lru_cache_statistics(wrapper):
+    """ Return the statistics of a ``functools.lru_cache`` wrapper """
+    info = wrapper.cache_info()
+    return dict(hits=info.hits, misses=info.misses, maxsize=info.maxsize,
+                currsize=info.currsize)
+
+
+class ExpiringLRUCache:
+    """ LRU mapping with a time to live and a memory bound, used by
+    ``expiring_lru_cache``
+
+    :param maxsize: max number of entries, None for unbounded
+    :param ttl: the entries expire after ``ttl`` seconds
+    :param maxbytes: max size of the entries (see ``get_size``), a value
+                     bigger than this size is not saved
+    """
+
+    def __init__(self, maxsize=128, ttl=None, maxbytes=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.misses = self.expired = self.bytes = 0
+
+    def get(self, key):
+        """ Return a tuple (found, value) """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                value, expire_at, size = entry
+                if expire_at is None or expire_at > monotonic():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return True, value
+
+                del self.entries[key]
+                self.bytes -= size
+                self.expired += 1
+
+            self.misses += 1
+            return False, None
+
+    def set(self, key, value):
+        size = get_size(value) if self.maxbytes else 0
+        if self.maxbytes and size > self.maxbytes:
+            return
+
+        expire_at = monotonic() + self.ttl if self.ttl else None
+        with self.lock:
+            if key in self.entries:
+                self.bytes -= self.entries.pop(key)[2]
+
+            self.entries[key] = (value, expire_at, size)
+            self.bytes += size
+            while self.entries and self.is_full():
+                self.bytes -= self.entries.popitem(last=False)[1][2]
+
+    def is_full(self):
+        if self.maxsize is not None and len(self.entries) > self.maxsize:
+            return True
+
+        return bool(self.maxbytes) and self.bytes > self.maxbytes
+
+    def statistics(self):
+        with self.lock:
+            return dict(hits=self.hits, misses=self.misses,
+                        expired=self.expired, bytes=self.bytes,
+                        maxsize=self.maxsize, currsize=len(self.entries),
+                        ttl=self.ttl, maxbytes=self.maxbytes)
+
+
+class QueryCache:
+    """ Rows of the queries cached by ``Query.cached``, keyed by the
+    compiled statement and its bound parameters
+
+    Each entry knows the tables read by its statement, the entries of a
+    table are removed when the table is modified (``invalidate_tables``).
+    The least recently used entries are evicted beyond ``maxsize`` entries
+    or ``maxbytes`` bytes
+
+    :param maxsize: maximum number of entries
+    :param maxbytes: maximum size of the rows, measured by ``get_size``
+    """
+
+    def __init__(self, maxsize=256, maxbytes=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.entries = OrderedDict()
+        self.tables = {}
+        self.versions = {}
+        self.lock = Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.tables.clear()
+            self.hits = self.misses = self.expired = self.bytes = 0
+            self.invalidations = 0
+
+    def remove(self, key):
+        rows, expire_at, tables, size = self.entries.pop(key)
+        self.bytes -= size
+        for table in tables:
+            keys = self.tables.get(table)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tables[table]
+
+    def get(self, key):
+        """ Return a tuple (found, rows) """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[1] is None or entry[1] > monotonic():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return True, entry[0]
+
+                self.remove(key)
+                self.expired += 1
+
+            self.misses += 1
+            return False, None
+
+    def get_versions(self, tables):
+        """ Return the versions of the tables, to give to ``set``
+
+        :param tables: the names of the tables read by the statement
+        """
+        with self.lock:
+            return tuple(self.versions.get(table, 0) for table in tables)
+
+    def set(self, key, rows, tables, ttl=None, versions=None):
+        """ Save the rows of the statement
+
+        :param key: compiled statement and bound parameters
+        :param rows: list of rows
+        :param tables: the names of the tables read by the statement
+        :param ttl: time to live in seconds, None for no expiry
+        :param versions: versions of the tables before the execution of
+                         the statement, the rows are not saved if one of
+                         the tables has been modified since
+        """
+        size = get_size(rows) if self.maxbytes else 0
+        if not self.maxsize or (self.maxbytes and size > self.maxbytes):
+            return
+
+        expire_at = monotonic() + ttl if ttl else None
+        with self.lock:
+            if versions is not None and versions != tuple(
+                self.versions.get(table, 0) for table in tables
+            ):
+                return
+
+            if key in self.entries:
+                self.remove(key)
+
+            self.entries[key] = (rows, expire_at, tables, size)
+            self.bytes += size
+            for table in tables:
+                self.tables.setdefault(table, set()).add(key)
+
+            while self.entries and self.is_full():
+                self.remove(next(iter(self.entries)))
+
+    def is_full(self):
+        if len(self.entries) > self.maxsize:
+            return True
+
+        return bool(self.maxbytes) and self.bytes > self.maxbytes
+
+    def invalidate_tables(self, tables):
+        """ Remove the rows which have been read in the tables
+
+        :param tables: names of the modified tables
+        """
+        with self.lock:
+            for table in tables:
+                self.versions[table] = self.versions.get(table, 0) + 1
+                for key in list(self.tables.get(table, ())):
+                    self.remove(key)
+                    self.invalidations += 1
+
+    def statistics(self):
+        with self.lock:
+            return dict(hits=self.hits, misses=self.misses,
+                        expired=self.expired, bytes=self.bytes,
+                        invalidations=self.invalidations,
+                        maxsize=self.maxsize, currsize=len(self.entries),
+                        maxbytes=self.maxbytes)
+
+
+def expiring_lru_cache(maxsize=128, ttl=None, maxbytes=None):
+    """ Decorator like ``functools.lru_cache`` with a time to live and a
+    memory bound, see ``ExpiringLRUCache``
+    """
+
+    def decorating(method):
+        cache = ExpiringLRUCache(maxsize=maxsize, ttl=ttl, maxbytes=maxbytes)
+
+        def wrapper(*args, **kwargs):
+            key = args
+            if kwargs:
+                key += (None,) + tuple(sorted(kwargs.items()))
+
+            found, value = cache.get(key)
+            if not found:
+                value = method(*args, **kwargs)
+                cache.set(key, value)
+
+            return value
+
+        wrapper.cache_clear = cache.clear
+        wrapper.cache_statistics = cache.statistics
+        wrapper.__wrapped__ = method
+        return wrapper
+
+    return decorating
+
+
+def register_cache(registry, namespace, attr, method, wrapper):
+    """ Save the wrapper of the cached method in the registry, with its
+    dependencies and its warm-up
+
+    :param registry: the current  registry
+    :param namespace: the namespace of the model
+    :param attr: name of the attibute
+    :param method: method pointer
+    :param wrapper: the cache of the method
+    """
+    wrapper.indentify = (namespace, attr)
+    registry.caches.setdefault(namespace, {}).setdefault(attr, []).append(
+        wrapper)
+    if method.is_cache_classmethod and getattr(method, 'warm', False):
+        registry.caches_warm_up.setdefault(namespace, set()).add(attr)
+
+    for depends_on in getattr(method, 'depends_on', ()):
+        registry.caches_depends_on.setdefault(depends_on, set()).add(
+            (namespace, attr))
+
+
 def apply_cache(attr, method, registry, namespace, base, properties):
     """ Find the cached methods in the base to apply the real cache
     decorator
 
+    Without ``ttl`` and ``maxbytes`` the cache is a ``functools.lru_cache``
+    else ``expiring_lru_cache``, in both cases the wrapper has got the
+    methods ``cache_clear`` and ``cache_statistics``. The shared classmethods
+    also use the shared store of the registry (``shared_cache_method``)
+
     :param attr: name of the attibute
     :param method: method pointer
     :param registry: the current  registry
@@ -112,17 +395,29 @@ def apply_cache(attr, method, registry, namespace, base, properties):
     :rtype: new base
     """
     if hasattr(method, 'is_cache_method') and method.is_cache_method is True:
-        if namespace not in registry.caches:
-            registry.caches[namespace] = {attr: []}
-        elif attr not in registry.caches[namespace]:
-            registry.caches[namespace][attr] = []
+        function = method
+        if (
+            method.is_cache_classmethod and getattr(method, 'shared', False) and
+            getattr(registry, 'shared_cache_options', None) is not None
+        ):
+            function = shared_cache_method(method, registry, namespace, attr)
+
+        ttl = getattr(method, 'ttl', None)
+        maxbytes = getattr(method, 'maxbytes', None)
+        if ttl or maxbytes:
+            decorator = expiring_lru_cache(maxsize=method.size, ttl=ttl,
+                                           maxbytes=maxbytes)
+        else:
+            decorator = lru_cache(maxsize=method.size)
 
-        @lru_cache(maxsize=method.size)
+        @decorator
         def wrapper(*args, **kwargs):
-            return method(*args, **kwargs)
+            return function(*args, **kwargs)
+
+        if not hasattr(wrapper, 'cache_statistics'):
+            wrapper.cache_statistics = partial(lru_cache_statistics, wrapper)
 
-        wrapper.indentify = (namespace, attr)
-        registry.caches[namespace][attr].append(wrapper)
+        register_cache(registry, namespace, attr, method, wrapper)
         if method.is_cache_classmethod:
             return {attr: classmethod(wrapper)}
         else:
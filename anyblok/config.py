@@ -104,6 +104,32 @@ def get_url(db_name=None):
                port=port, database=database)
 
 
+def get_ro_urls(db_name=None):
+    """ Return the sqlalchemy URLs of the read only replicas of the database
+
+    The URLs are defined by the option ``db_ro_urls``, the name of the
+    database is replaced by the ``db_name`` parameter if it is filled::
+
+        # db_ro_urls = 'postgresql://replica1/db, postgresql://replica2/db'
+        get_ro_urls()
+        ==> ['postgresql://replica1/db', 'postgresql://replica2/db']
+        get_ro_urls(db_name='Mydb')
+        ==> ['postgresql://replica1/Mydb', 'postgresql://replica2/Mydb']
+
+    :param db_name: Name of the database
+    :rtype: list of SqlAlchemy URL
+    """
+    urls = []
+    for url in Configuration.get('db_ro_urls', None) or []:
+        url = make_url(url)
+        if db_name is not None:
+            url.database = db_name
+
+        urls.append(url)
+
+    return urls
+
+
 class ConfigurationException(LookupError):
     """ Simple Exception for Configuration"""
 
@@ -700,6 +726,16 @@ def add_plugins(group):
                        type=AnyBlokPlugin,
                        default='anyblok.config:get_url',
                        help="get_url function to use")
+    group.add_argument('--get-ro-urls-fnct', dest='get_ro_urls',
+                       type=AnyBlokPlugin,
+                       default='anyblok.config:get_ro_urls',
+                       help="get_ro_urls function to use")
+    group.add_argument('--cache-invalidation-transport-cls',
+                       dest='CacheInvalidationTransport',
+                       type=AnyBlokPlugin,
+                       help="Transport class which notifies the other "
+                            "processes of the cache invalidations, ex: "
+                            "anyblok.cache_invalidation:SocketTransport")
 
 
 @Configuration.add('config')
@@ -708,6 +744,18 @@ def add_configuration_file(parser):
                         help="Relative path of the config file")
     parser.add_argument('--without-auto-migration', dest='withoutautomigration',
                         action='store_true')
+    parser.add_argument('--registry-fingerprint', dest='registry_fingerprint',
+                        action='store_true',
+                        help="Skip the migration and the refresh of the "
+                             "System models if the bloks and the tables did "
+                             "not change since the last load. The database "
+                             "side is checked by the states of the bloks and "
+                             "the columns of the tables, a constraint or an "
+                             "index modified outside AnyBlok is not seen")
+    parser.add_argument('--registries-max-size', type=int,
+                        help="Maximum number of registries kept in memory, "
+                             "the least recently used registry is closed "
+                             "when the limit is reached")
     parser.add_argument('--isolation-level',
                         default="READ_COMMITTED",
                         choices=["SERIALIZABLE", "REPEATABLE_READ",
@@ -728,6 +776,11 @@ def add_database(group):
     group.add_argument('--db-url',
                        default=os.environ.get('ANYBLOK_DATABASE_URL'),
                        help="Complete URL for connection with the database")
+    group.add_argument('--db-ro-urls', nargs="+",
+                       default=os.environ.get('ANYBLOK_DATABASE_RO_URLS'),
+                       help="Complete URLs of the read only replicas, the "
+                            "queries of the transactions which have not "
+                            "written yet are sent to one of them")
     group.add_argument('--db-driver-name',
                        default=os.environ.get('ANYBLOK_DATABASE_DRIVER'),
                        help="the name of the database backend. This name "
@@ -751,6 +804,53 @@ def add_database(group):
     group.add_argument('--db-echo-pool', action="store_true", default=False)
     group.add_argument('--db-max-overflow', type=int, default=10)
     group.add_argument('--db-pool-size', type=int, default=5)
+    group.add_argument('--db-pool-metrics', action="store_true",
+                       help="Collect the statistics of the connection "
+                            "pools, see Registry.pool_statistics")
+    group.add_argument('--db-pool-metrics-log-interval', type=int,
+                       default=0,
+                       help="Log the statistics of the connection pools at "
+                            "most once by interval (in seconds)")
+    group.add_argument('--db-sql-profiler', action="store_true",
+                       help="Profile the SQL statements by method of model, "
+                            "see Registry.sql_profiler")
+    group.add_argument('--db-sql-profiler-slowest', type=int, default=10,
+                       help="Number of slowest statements kept by the SQL "
+                            "profiler")
+    group.add_argument('--db-sql-profiler-statements', type=int,
+                       default=1000,
+                       help="Number of distinct statements counted by the "
+                            "SQL profiler")
+    group.add_argument('--cache-invalidation-interval', type=float,
+                       help="Check the cache invalidations saved by the "
+                            "other processes at the beginning of the "
+                            "transactions, at most once by interval (in "
+                            "seconds), 0 to check at each transaction")
+    group.add_argument('--cache-invalidation-socket-dir',
+                       help="Directory of the sockets of "
+                            "anyblok.cache_invalidation:SocketTransport")
+    group.add_argument('--cache-shared-slots', type=int, default=0,
+                       help="Number of slots of the cache shared by the "
+                            "processes of the host for the classmethods "
+                            "cached with shared=True, 0 to disable it")
+    group.add_argument('--cache-shared-slot-size', type=int, default=65536,
+                       help="Size in bytes of a slot of the shared cache")
+    group.add_argument('--cache-shared-path',
+                       help="File of the shared cache, by default in "
+                            "/dev/shm")
+    group.add_argument('--cache-warm-up', action='store_true',
+                       default=False,
+                       help="Fill the cached classmethods declared with "
+                            "warm=True at the end of the load of the "
+                            "registry")
+    group.add_argument('--cache-warm-up-workers', type=int, default=0,
+                       help="Number of threads of the warm-up of the caches")
+    group.add_argument('--query-cache-size', type=int, default=256,
+                       help="Maximum number of queries cached by "
+                            "Query.cached, 0 to disable it")
+    group.add_argument('--query-cache-maxbytes', type=int,
+                       help="Maximum size in bytes of the rows of the "
+                            "queries cached by Query.cached")
     group.add_argument('--default-encrypt-key',
                        default=os.environ.get('ANYBLOK_ENCRYPT_KEY'),
                        help=("Default ey definition to encrypt column with "
@@ -137,32 +137,81 @@ class Declarations:
             return wrapper
 
 
-def cache(size=128):
+def define_cache_method(method, autodoc, classmethod, size=128, ttl=None,
+                        maxsize=None, maxbytes=None, depends_on=None,
+                        shared=False, warm=False):
+    if maxsize is not None:
+        size = maxsize
+
+    depends_on = tuple(depends_on or ())
+    options = ['size=%s' % size]
+    if ttl:
+        options.append('ttl=%s' % ttl)
+    if maxbytes:
+        options.append('maxbytes=%s' % maxbytes)
+    if depends_on:
+        options.append('depends_on=%s' % ', '.join(depends_on))
+    if shared:
+        options.append('shared')
+    if warm:
+        options.append('warm')
+
+    add_autodocs(method, autodoc % dict(options=', '.join(options)))
+    method.is_cache_method = True
+    method.is_cache_classmethod = classmethod
+    method.size = size
+    method.ttl = ttl
+    method.maxbytes = maxbytes
+    method.depends_on = depends_on
+    method.shared = shared
+    method.warm = warm
+    return method
+
+
+def cache(size=128, ttl=None, maxsize=None, maxbytes=None, depends_on=None):
+    """ Cache the result of the method
+
+    :param size: max number of results kept, None for unbounded
+    :param ttl: the results expire after ``ttl`` seconds
+    :param maxsize: alias of ``size``
+    :param maxbytes: max size in bytes of the results kept
+    :param depends_on: namespaces of the models read by the method, the
+                       cache is invalidated at the commit of a transaction
+                       which has inserted, updated or deleted one of them
+    """
     autodoc = """
-    **Cached method** with size=%(size)s
-    """ % dict(size=size)
+    **Cached method** with %(options)s
+    """
 
     def wrapper(method):
-        add_autodocs(method, autodoc)
-        method.is_cache_method = True
-        method.is_cache_classmethod = False
-        method.size = size
-        return method
+        return define_cache_method(method, autodoc, False, size=size,
+                                   ttl=ttl, maxsize=maxsize,
+                                   maxbytes=maxbytes, depends_on=depends_on)
 
     return wrapper
 
 
-def classmethod_cache(size=128):
+def classmethod_cache(size=128, ttl=None, maxsize=None, maxbytes=None,
+                      depends_on=None, shared=False, warm=False):
+    """ Cache the result of the classmethod, see ``cache``
+
+    :param shared: if True, the results are also saved in the cache shared
+                   by the processes of the host (see ``anyblok.shared_cache``),
+                   the arguments and the results must be picklable and must
+                   not be linked to a session
+    :param warm: if True, the classmethod is called without argument by the
+                 warm-up of the caches at the end of the load of the
+                 registry (option ``cache_warm_up``)
+    """
     autodoc = """
-    **Cached classmethod** with size=%(size)s
-    """ % dict(size=size)
+    **Cached classmethod** with %(options)s
+    """
 
     def wrapper(method):
-        add_autodocs(method, autodoc)
-        method.is_cache_method = True
-        method.is_cache_classmethod = True
-        method.size = size
-        return method
+        return define_cache_method(method, autodoc, True, size=size,
+                                   ttl=ttl, maxsize=maxsize,
+                                   maxbytes=maxbytes, depends_on=depends_on,
+                                   shared=shared, warm=warm)
 
     return wrapper
 
@@ -7,6 +7,12 @@
 # obtain one at http://mozilla.org/MPL/2.0/.
 import threading
 from inspect import ismethod
+from uuid import uuid4
+try:
+    from contextvars import ContextVar
+except ImportError:  # pragma: no cover
+    # python < 3.7
+    ContextVar = None
 
 
 class EnvironmentException(AttributeError):
@@ -115,4 +121,82 @@ class ThreadEnvironment:
         return cls.values[str(threading.current_thread())].get(key, default)
 
 
+class ContextEnvironment:
+    """ Use the scope of the context (``contextvars``) to get the
+    environment, and the thread if no scope is defined in the context
+
+    Each asyncio task has its own context, a scope defined by a task is
+    not seen by the other tasks::
+
+        EnvironmentManager.define_environment_cls(ContextEnvironment)
+
+    .. warning::
+
+        Needs python >= 3.7
+    """
+
+    scope = (ContextVar('anyblok_environment_scope', default=None)
+             if ContextVar else None)
+    values = {}
+
+    @classmethod
+    def get_scope(cls):
+        """ Return the scope of the current context
+
+        :rtype: the scope defined in the context or the thread identifier
+        """
+        scope = cls.scope.get() if cls.scope else None
+        if scope is None:
+            return threading.get_ident()
+
+        return scope
+
+    @classmethod
+    def scoped_function_for_session(cls):
+        """ The session is scoped by the scope of the context """
+        return cls.get_scope()
+
+    @classmethod
+    def new_scope(cls):
+        """ Define a new scope in the current context
+
+        :rtype: the new scope
+        :exception: EnvironmentException
+        """
+        if cls.scope is None:
+            raise EnvironmentException(
+                "The context environment needs python >= 3.7")
+
+        scope = uuid4().hex
+        cls.scope.set(scope)
+        return scope
+
+    @classmethod
+    def release_scope(cls, scope):
+        """ Remove all the values saved for the scope
+
+        :param scope: the scope to release
+        """
+        cls.values.pop(scope, None)
+
+    @classmethod
+    def setter(cls, key, value):
+        """ Save the value of the key in the environment
+
+        :param key: the key of the value to save
+        :param value: the value to save
+        """
+        cls.values.setdefault(cls.get_scope(), {})[key] = value
+
+    @classmethod
+    def getter(cls, key, default):
+        """ Get the value of the key in the environment
+
+        :param key: the key of the value to retrieve
+        :param default: return this value if no value loaded for the key
+        :rtype: the value of the key
+        """
+        return cls.values.get(cls.get_scope(), {}).get(key, default)
+
+
 EnvironmentManager.define_environment_cls(ThreadEnvironment)
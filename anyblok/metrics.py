@@ -0,0 +1,392 @@
+# This file is a part of the AnyBlok project
+#
+#    Copyright (C) 2018 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+import sys
+from collections import OrderedDict
+from logging import getLogger
+from threading import Lock, get_ident
+from time import perf_counter, time
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError
+
+logger = getLogger(__name__)
+
+
+class PoolMetrics:
+    """ Statistics of the connection pool of one engine
+
+    The counters are fed by the pool events, the checkout latency is
+    measured by the pool class returned by ``get_pool_class``::
+
+        metrics = PoolMetrics('primary')
+        engine = create_engine(
+            url, poolclass=metrics.get_pool_class(QueuePool))
+        metrics.listen(engine)
+        metrics.get_statistics()
+
+    :param name: name of the engine in the statistics
+    :param log_interval: if filled, the statistics are logged at most once
+                         by interval (in seconds), when a connection is
+                         checked in
+    """
+
+    checkout_time_buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+    """ Upper bounds (in seconds) of the checkout latency histogram """
+
+    counters = ('connect', 'checkout', 'checkin', 'close', 'invalidate',
+                'soft_invalidate', 'timeout')
+
+    def __init__(self, name, log_interval=None):
+        self.name = name
+        self.log_interval = log_interval
+        self.engine = None
+        self.lock = Lock()
+        self.last_log = time()
+        self.reset()
+
+    def reset(self):
+        """ Reset the counters and the histograms """
+        with self.lock:
+            self.values = {counter: 0 for counter in self.counters}
+            self.checkout_time_histogram = [
+                0 for x in range(len(self.checkout_time_buckets) + 1)]
+            self.checkout_time_sum = 0
+            self.checkout_time_max = 0
+            self.lifetime_count = 0
+            self.lifetime_sum = 0
+            self.lifetime_max = 0
+
+    def get_pool_class(self, poolclass):
+        """ Return a subclass of the pool class, which measures the time to
+        check out a connection
+
+        :param poolclass: SQLAlchemy pool class
+        :rtype: pool class
+        """
+        metrics = self
+
+        def _do_get(pool):
+            start = perf_counter()
+            try:
+                return poolclass._do_get(pool)
+            except TimeoutError:
+                metrics.increment('timeout')
+                raise
+            finally:
+                metrics.add_checkout_time(perf_counter() - start)
+
+        return type('Metrics' + poolclass.__name__, (poolclass,),
+                    {'_do_get': _do_get})
+
+    def listen(self, engine):
+        """ Feed the counters with the events of the pool of the engine
+
+        :param engine: SQLAlchemy engine
+        """
+        self.engine = engine
+
+        @event.listens_for(engine, 'connect')
+        def connect(dbapi_connection, connection_record):
+            connection_record.info['metrics_connect_time'] = time()
+            self.increment('connect')
+
+        @event.listens_for(engine, 'checkout')
+        def checkout(dbapi_connection, connection_record, connection_proxy):
+            self.increment('checkout')
+
+        @event.listens_for(engine, 'checkin')
+        def checkin(dbapi_connection, connection_record):
+            self.increment('checkin')
+            self.log_statistics_if_needed()
+
+        @event.listens_for(engine, 'close')
+        def close(dbapi_connection, connection_record):
+            self.increment('close')
+            connect_time = connection_record.info.get('metrics_connect_time')
+            if connect_time is not None:
+                self.add_lifetime(time() - connect_time)
+
+        @event.listens_for(engine, 'invalidate')
+        def invalidate(dbapi_connection, connection_record, exception):
+            self.increment('invalidate')
+
+        @event.listens_for(engine, 'soft_invalidate')
+        def soft_invalidate(dbapi_connection, connection_record, exception):
+            self.increment('soft_invalidate')
+
+    def increment(self, counter):
+        with self.lock:
+            self.values[counter] += 1
+
+    def add_checkout_time(self, duration):
+        index = len(self.checkout_time_buckets)
+        for i, bucket in enumerate(self.checkout_time_buckets):
+            if duration <= bucket:
+                index = i
+                break
+
+        with self.lock:
+            self.checkout_time_histogram[index] += 1
+            self.checkout_time_sum += duration
+            self.checkout_time_max = max(self.checkout_time_max, duration)
+
+    def add_lifetime(self, duration):
+        with self.lock:
+            self.lifetime_count += 1
+            self.lifetime_sum += duration
+            self.lifetime_max = max(self.lifetime_max, duration)
+
+    def get_pool_statistics(self):
+        """ Return the live state of the pool """
+        if self.engine is None:
+            return {}
+
+        pool = self.engine.pool
+        statistics = {}
+        for key in ('size', 'checkedin', 'checkedout', 'overflow'):
+            if hasattr(pool, key):
+                statistics[key] = getattr(pool, key)()
+
+        return statistics
+
+    def get_statistics(self):
+        """ Return the statistics of the pool
+
+        :rtype: dict
+        """
+        with self.lock:
+            checkouts = sum(self.checkout_time_histogram)
+            statistics = dict(
+                self.values,
+                checkout_time_histogram=list(zip(
+                    self.checkout_time_buckets + (None,),
+                    self.checkout_time_histogram)),
+                checkout_time_avg=(
+                    self.checkout_time_sum / checkouts if checkouts else 0),
+                checkout_time_max=self.checkout_time_max,
+                lifetime_avg=(self.lifetime_sum / self.lifetime_count
+                              if self.lifetime_count else 0),
+                lifetime_max=self.lifetime_max,
+            )
+
+        statistics.update(self.get_pool_statistics())
+        return statistics
+
+    def log_statistics_if_needed(self):
+        if not self.log_interval:
+            return
+
+        now = time()
+        with self.lock:
+            if now - self.last_log < self.log_interval:
+                return
+
+            self.last_log = now
+
+        logger.info("Pool statistics of %r: %r", self.name,
+                    self.get_statistics())
+
+
+class SQLProfiler:
+    """ Profile the SQL statements executed by engines, each statement is
+    attributed to the method of the model which has executed it::
+
+        profiler = SQLProfiler()
+        profiler.listen(engine)
+        ...
+        profiler.remove()
+        profiler.get_report()
+
+    The method of the model is the nearest method, in the call stack, whose
+    ``self`` or ``cls`` is a model (the cores, as the query and the session,
+    are skipped), the statements executed outside any model are attributed
+    to ``None``
+
+    :param slowest: number of slowest statements kept in the report
+    :param max_statements: number of distinct statements kept to count the
+                           repeated statements, the least recently executed
+                           statement is forgotten beyond it
+    :param thread: if filled, only the statements executed by this thread
+                   (``threading.get_ident``) are profiled
+    """
+
+    def __init__(self, slowest=10, max_statements=1000, thread=None):
+        self.slowest = slowest
+        self.max_statements = max_statements
+        self.thread = thread
+        self.engines = []
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        """ Forget the profiled statements """
+        with self.lock:
+            self.count = 0
+            self.total_time = 0
+            self.rows = 0
+            self.methods = {}
+            self.statements = OrderedDict()
+            self.slowest_statements = []
+
+    def listen(self, engine):
+        """ Profile the statements executed by the engine
+
+        :param engine: SQLAlchemy engine
+        """
+        event.listen(engine, 'before_cursor_execute',
+                     self.before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute',
+                     self.after_cursor_execute)
+        self.engines.append(engine)
+
+    def remove(self):
+        """ Stop to profile the statements of the engines """
+        for engine in self.engines:
+            event.remove(engine, 'before_cursor_execute',
+                         self.before_cursor_execute)
+            event.remove(engine, 'after_cursor_execute',
+                         self.after_cursor_execute)
+
+        self.engines = []
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters,
+                              context, executemany):
+        if context is None:
+            return
+
+        if self.thread is not None and self.thread != get_ident():
+            return
+
+        starts = context.__dict__.setdefault('sql_profiler_starts', {})
+        starts[id(self)] = perf_counter()
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters,
+                             context, executemany):
+        if context is None:
+            return
+
+        start = context.__dict__.get('sql_profiler_starts', {}).pop(
+            id(self), None)
+        if start is None:
+            return
+
+        duration = perf_counter() - start
+        rows = max(cursor.rowcount, 0)
+        namespace, method = self.get_caller()
+        self.add_statement(namespace, method, statement, parameters,
+                           duration, rows)
+
+    @staticmethod
+    def get_caller():
+        """ Return the namespace and the name of the nearest method of a
+        model in the call stack
+
+        :rtype: (namespace, method) or (None, None)
+        """
+        frame = sys._getframe(1)
+        while frame is not None:
+            code = frame.f_code
+            if code.co_argcount and code.co_varnames[0] in ('self', 'cls'):
+                first = frame.f_locals.get(code.co_varnames[0])
+                # never call the ``__getattr__`` of the instance, it may
+                # execute a query
+                owner = first if isinstance(first, type) else type(first)
+                namespace = getattr(owner, '__registry_name__', None)
+                if (
+                    isinstance(namespace, str) and
+                    namespace.startswith('Model.')
+                ):
+                    return namespace, code.co_name
+
+            frame = frame.f_back
+
+        return None, None
+
+    def add_statement(self, namespace, method, statement, parameters,
+                      duration, rows):
+        with self.lock:
+            self.count += 1
+            self.total_time += duration
+            self.rows += rows
+
+            key = (namespace, method)
+            values = self.methods.setdefault(
+                key, {'count': 0, 'total_time': 0, 'rows': 0})
+            values['count'] += 1
+            values['total_time'] += duration
+            values['rows'] += rows
+
+            key = (namespace, method, statement)
+            values = self.statements.setdefault(
+                key, {'count': 0, 'total_time': 0})
+            values['count'] += 1
+            values['total_time'] += duration
+            self.statements.move_to_end(key)
+            while len(self.statements) > self.max_statements:
+                self.statements.popitem(last=False)
+
+            if self.slowest:
+                self.slowest_statements.append(
+                    (duration, rows, namespace, method, statement,
+                     parameters))
+                self.slowest_statements.sort(key=lambda x: x[0],
+                                             reverse=True)
+                del self.slowest_statements[self.slowest:]
+
+    def get_report(self):
+        """ Return the report of the profiled statements::
+
+            {
+                'count': 120, 'total_time': 0.052, 'rows': 310,
+                'methods': [
+                    {'namespace': 'Model.Test', 'method': 'to_dict',
+                     'count': 100, 'total_time': 0.041, 'rows': 100},
+                    ...
+                ],
+                'slowest': [
+                    {'namespace': 'Model.Test', 'method': 'to_dict',
+                     'statement': 'SELECT ...', 'parameters': {...},
+                     'duration': 0.002, 'rows': 1},
+                    ...
+                ],
+                'repeated': [
+                    {'namespace': 'Model.Test', 'method': 'to_dict',
+                     'statement': 'SELECT ...', 'count': 100,
+                     'total_time': 0.040},
+                    ...
+                ],
+            }
+
+        ``methods`` are sorted by total time, ``repeated`` lists the
+        statements executed several times by the same method (N+1 queries)
+        sorted by count
+
+        :rtype: dict
+        """
+        with self.lock:
+            methods = [
+                dict(values, namespace=namespace, method=method)
+                for (namespace, method), values in self.methods.items()]
+            slowest = [
+                dict(duration=duration, rows=rows, namespace=namespace,
+                     method=method, statement=statement,
+                     parameters=parameters)
+                for (duration, rows, namespace, method, statement,
+                     parameters) in self.slowest_statements]
+            repeated = [
+                dict(values, namespace=namespace, method=method,
+                     statement=statement)
+                for (namespace, method, statement), values in (
+                    self.statements.items())
+                if values['count'] > 1]
+            report = dict(count=self.count, total_time=self.total_time,
+                          rows=self.rows)
+
+        methods.sort(key=lambda x: x['total_time'], reverse=True)
+        repeated.sort(key=lambda x: x['count'], reverse=True)
+        report.update(methods=methods, slowest=slowest, repeated=repeated)
+        return report
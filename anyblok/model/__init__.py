@@ -604,6 +604,11 @@ class Model:
         for Model in registry.loaded_namespaces.values():
             Model.initialize_model()
 
+        if registry.fingerprint_unchanged:
+            # nothing change since the last load, the System models are
+            # already up to date
+            return False
+
         Blok = registry.System.Blok
         if not registry.withoutautomigration:
             Model = registry.System.Model
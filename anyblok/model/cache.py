@@ -5,16 +5,202 @@
 # This Source Code Form is subject to the terms of the Mozilla Public License,
 # v. 2.0. If a copy of the MPL was not distributed with this file,You can
 # obtain one at http://mozilla.org/MPL/2.0/.
+from collections import OrderedDict
+from copy import deepcopy
+from threading import Lock
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient_to_detached
 from .plugins import ModelPluginBase
 from anyblok.common import apply_cache
 
 
+class IdentityCache:
+    """ Keep in the process the column values of the instances of a model,
+    keyed by primary key, and the primary keys found by the simple equality
+    filters of the model
+
+    The cache is declared by the model::
+
+        @register(Model, identity_cache=True)
+        class MyModel:
+            ...
+
+    ``identity_cache`` can also be the maximum number of instances kept.
+    The cache is saved in the registry as the cached method
+    ``identity_cache`` of the model, so it is cleared by the flushes on the
+    model in this process and by the invalidations of **System.Cache** in
+    the other processes
+
+    :param registry: the current registry
+    :param namespace: the namespace of the model
+    :param maxsize: maximum number of instances, and of filters, kept
+    """
+
+    method = 'identity_cache'
+    default_maxsize = 1024
+
+    def __init__(self, registry, namespace, maxsize=None):
+        self.registry = registry
+        self.identity = (namespace, self.method)
+        self.maxsize = maxsize or self.default_maxsize
+        self.lock = Lock()
+        self.instances = OrderedDict()
+        self.filters = OrderedDict()
+        self.generation = 0
+        self.hits = self.misses = 0
+
+    def is_usable(self):
+        """ The cache is not used while the registry is loading, nor while
+        an invalidation of the model, done by this process, is not
+        committed """
+        return (not self.registry.loading and
+                self.identity not in self.registry.cache_bypass)
+
+    def get_instance(self, model, key):
+        """ Return the instance of the session, or build it from the cached
+        values without query, None if the instance is unknown
+
+        :param model: the assembled model
+        :param key: identity of the primary keys
+        """
+        session = self.registry.session
+        instance = session.identity_map.get(
+            model.__mapper__.identity_key_from_primary_key(key))
+        if instance is not None:
+            return instance
+
+        with self.lock:
+            entry = self.instances.get(key)
+            if entry is None:
+                return None
+
+            self.instances.move_to_end(key)
+
+        class_, values = entry
+        instance = class_.__mapper__.class_manager.new_instance()
+        # the values can be mutable (json), they must not be shared
+        inspect(instance).dict.update(deepcopy(values))
+        make_transient_to_detached(instance)
+        session.add(instance)
+        return instance
+
+    def set_instance(self, instance, generation):
+        """ Keep the column values of the instance loaded from the database
+
+        :param instance: instance in the session
+        :param generation: generation of the cache before the query, the
+                           values are not kept if the cache has been cleared
+                           since
+        """
+        state = inspect(instance)
+        if state.key is None or state.modified:
+            return
+
+        values = {prop.key: state.dict[prop.key]
+                  for prop in state.mapper.column_attrs
+                  if prop.key in state.dict}
+        key = state.key[1]
+        with self.lock:
+            if generation != self.generation:
+                return
+
+            self.instances[key] = (type(instance), deepcopy(values))
+            self.instances.move_to_end(key)
+            while len(self.instances) > self.maxsize:
+                self.instances.popitem(last=False)
+
+    def set_filter(self, key, pks, generation):
+        with self.lock:
+            if generation != self.generation:
+                return
+
+            self.filters[key] = pks
+            self.filters.move_to_end(key)
+            while len(self.filters) > self.maxsize:
+                self.filters.popitem(last=False)
+
+    def count(self, hit):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def from_primary_keys(self, model, key):
+        """ Return the instance from the cache or from the database
+
+        :param model: the assembled model
+        :param key: identity of the primary keys, see
+                    ``get_identity_from_primary_keys``
+        """
+        generation = self.generation
+        instance = self.get_instance(model, key)
+        self.count(instance is not None)
+        if instance is None:
+            instance = model.query().get(key)
+            if instance is not None:
+                self.set_instance(instance, generation)
+
+        return instance
+
+    def filter_by(self, model, values):
+        """ Return the instances which have the values, from the cache or
+        from the database
+
+        :param model: the assembled model
+        :param values: dict {column: value, ...}
+        :rtype: instrumented list of instances
+        """
+        # the values modified in the session must be seen by the filter
+        self.registry.flush()
+        key = tuple(sorted(values.items()))
+        generation = self.generation
+        with self.lock:
+            pks = self.filters.get(key)
+
+        if pks is not None:
+            instances = [self.get_instance(model, pk) for pk in pks]
+            if None not in instances:
+                self.count(True)
+                return self.registry.InstrumentedList(instances)
+
+        self.count(False)
+        instances = model.query().filter_by(**values).all()
+        for instance in instances:
+            self.set_instance(instance, generation)
+
+        self.set_filter(
+            key, [inspect(instance).key[1] for instance in instances],
+            generation)
+        return instances
+
+    def cache_clear(self):
+        with self.lock:
+            self.instances.clear()
+            self.filters.clear()
+            self.generation += 1
+
+    def cache_statistics(self):
+        with self.lock:
+            return dict(hits=self.hits, misses=self.misses,
+                        currsize=len(self.instances), maxsize=self.maxsize)
+
+
 class CachePlugin(ModelPluginBase):
 
     def __init__(self, registry):
         if not hasattr(registry, 'caches'):
             registry.caches = {}
 
+        if not hasattr(registry, 'caches_depends_on'):
+            registry.caches_depends_on = {}
+
+        if not hasattr(registry, 'identity_caches'):
+            registry.identity_caches = {}
+
+        if not hasattr(registry, 'caches_warm_up'):
+            registry.caches_warm_up = {}
+
         super(CachePlugin, self).__init__(registry)
 
     def transform_base_attribute(self, attr, method, namespace, base,
@@ -33,3 +219,25 @@ class CachePlugin(ModelPluginBase):
         new_type_properties.update(apply_cache(
             attr, method, self.registry, namespace, base,
             transformation_properties))
+
+    def after_model_construction(self, base, namespace,
+                                 transformation_properties):
+        """ Declare the identity cache of the model, if the model is
+        declared with ``identity_cache``
+
+        :param base: the Model class
+        :param namespace: the namespace of the model
+        :param transformation_properties: the properties of the model
+        """
+        size = getattr(base, 'identity_cache', None)
+        if not size or base.is_sql_view:
+            return
+
+        identity_cache = IdentityCache(
+            self.registry, namespace,
+            maxsize=None if size is True else size)
+        self.registry.identity_caches[namespace] = identity_cache
+        self.registry.caches.setdefault(namespace, {})[
+            IdentityCache.method] = [identity_cache]
+        self.registry.caches_depends_on.setdefault(namespace, set()).add(
+            identity_cache.identity)
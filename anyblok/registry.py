@@ -7,22 +7,35 @@
 # v. 2.0. If a copy of the MPL was not distributed with this file,You can
 # obtain one at http://mozilla.org/MPL/2.0/.
 from os.path import join
-from os import walk
+from os import walk, getpid
+from itertools import count
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from collections import OrderedDict
+from threading import RLock, get_ident
+from weakref import WeakValueDictionary
 from logging import getLogger
+from hashlib import sha256
+from time import time, perf_counter
 import nose
 
 from sqlalchemy import create_engine, event, MetaData
+from sqlalchemy.schema import CreateTable, CreateIndex
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import sessionmaker, scoped_session, configure_mappers
 from sqlalchemy.exc import (ProgrammingError, OperationalError,
-                            InvalidRequestError)
+                            InvalidRequestError, DisconnectionError)
 from sqlalchemy_utils.functions import database_exists
-from .config import Configuration, get_url
+from .config import Configuration, get_url, get_ro_urls
+from .metrics import PoolMetrics, SQLProfiler
+from .shared_cache import SharedMemoryStore
 from .migration import Migration
 from .blok import BlokManager
 from .environment import EnvironmentManager
 from .authorization.query import QUERY_WITH_NO_RESULTS, PostFilteredQuery
-from anyblok.common import anyblok_column_prefix, naming_convention
+from anyblok.common import (anyblok_column_prefix, naming_convention,
+                            QueryCache)
 from pkg_resources import iter_entry_points
 from .logging import log
 logger = getLogger(__name__)
@@ -47,6 +60,50 @@ def return_list(entry):
     return entry
 
 
+def session_proxy(name):
+    """ Return a method which delegates the call to the session of the
+    current scope
+
+    ``Registry.__getattr__`` resolves the session and checks the attribute
+    on each access, the proxies skip these steps for the most used
+    methods of the session
+
+    :param name: name of the method on the session
+    :rtype: function
+    """
+
+    def proxy(self, *args, **kwargs):
+        return getattr(self.Session(), name)(*args, **kwargs)
+
+    proxy.__name__ = name
+    proxy.__doc__ = "Call ``%s`` on the session of the current scope" % name
+    return proxy
+
+
+def add_engine_pid_protection(engine):
+    """ Forbid the use of a connection opened by another process
+
+    After a fork, the child process gets a copy of the connections of the
+    pool. If one of them is checked out, the connection is invalidated
+    without closing it, because the socket is owned by the parent process
+
+    :param engine: SQLAlchemy engine
+    """
+
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        connection_record.info['pid'] = getpid()
+
+    @event.listens_for(engine, 'checkout')
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        pid = getpid()
+        if connection_record.info['pid'] != pid:
+            connection_record.connection = connection_proxy.connection = None
+            raise DisconnectionError(
+                "Connection record belongs to pid %s, attempting to check "
+                "out in pid %s" % (connection_record.info['pid'], pid))
+
+
 class RegistryManager:
     """ Manage the global registry
 
@@ -70,6 +127,9 @@ class RegistryManager:
 
         registry = RegistryManager.get('my database')
 
+    The number of registries kept in memory can be limited by the option
+    ``registries_max_size``, the least recently used registry is closed
+    when the limit is reached
     """
 
     loaded_bloks = {}
@@ -79,8 +139,14 @@ class RegistryManager:
     callback_assemble_entries = {}
     callback_initialize_entries = {}
     callback_unload_entries = {}
-    registries = {}
+    registries = OrderedDict()
+    registries_lock = RLock()
+    # a loading lock lives only while a thread holds or waits for it
+    registries_loading_locks = WeakValueDictionary()
+    registries_statistics = {'hit': 0, 'miss': 0, 'eviction': 0}
+    evicted_registries = []
     needed_bloks = []
+    callback_post_fork = []
 
     @classmethod
     def has_blok(cls, blok):
@@ -95,7 +161,11 @@ class RegistryManager:
     @classmethod
     def clear(cls):
         """ Clear the registry dict to force the creation of new registry """
-        registries = [r for r in cls.registries.values()]
+        with cls.registries_lock:
+            registries = list(cls.registries.values())
+            registries.extend(cls.evicted_registries)
+            cls.evicted_registries = []
+
         for registry in registries:
             registry.close()
 
@@ -106,6 +176,58 @@ class RegistryManager:
             logger.info('Unload: %r' % entry)
             unload_callback()
 
+    @classmethod
+    def declare_post_fork_callback(cls, callback):
+        """ Add a callback called for each registry in the child process
+        by ``RegistryManager.after_fork``
+
+        ::
+
+            def callback(registry):
+                ...
+
+            RegistryManager.declare_post_fork_callback(callback)
+
+        :param callback: function which takes the registry
+        """
+        if callback not in cls.callback_post_fork:
+            cls.callback_post_fork.append(callback)
+
+    @classmethod
+    def undeclare_post_fork_callback(cls, callback):
+        if callback in cls.callback_post_fork:
+            cls.callback_post_fork.remove(callback)
+
+    @classmethod
+    def before_fork(cls):
+        """ Prepare all the registries to be shared with forked processes
+
+        The registries are loaded once by the master process of a prefork
+        server, then the children get the assembled models in copy on write
+        memory::
+
+            # in the master process
+            registry = anyblok.start('my application')
+            RegistryManager.before_fork()
+            # fork the workers
+            ...
+            # in each worker, just after the fork
+            RegistryManager.after_fork()
+
+        """
+        for registry in cls.get_registries():
+            registry.before_fork()
+
+    @classmethod
+    def after_fork(cls):
+        """ Give new connection pools to all the registries of the child
+        process and call the post fork callbacks
+        """
+        for registry in cls.get_registries():
+            registry.after_fork()
+            for callback in cls.callback_post_fork:
+                callback(registry)
+
     @classmethod
     def get(cls, db_name, loadwithoutmigration=False, **kwargs):
         """ Return an existing Registry
@@ -117,18 +239,135 @@ class RegistryManager:
         :rtype: ``Registry``
         """
         EnvironmentManager.set('db_name', db_name)
-        if db_name in cls.registries:
-            if loadwithoutmigration:
-                logger.warning("loadwithoutmigration can not be used because "
-                               "the registry for %r is already load" % db_name)
-            return cls.registries[db_name]
-
-        _Registry = Configuration.get('Registry', Registry)
-        registry = _Registry(
-            db_name, loadwithoutmigration=loadwithoutmigration, **kwargs)
-        cls.registries[db_name] = registry
+        registry = cls.get_loaded_registry(db_name, loadwithoutmigration)
+        if registry is not None:
+            return registry
+
+        # only one thread loads the registry of a database, the others
+        # wait and get the registry loaded by the first one
+        with cls.get_loading_lock(db_name):
+            registry = cls.get_loaded_registry(db_name, loadwithoutmigration)
+            if registry is not None:
+                return registry
+
+            _Registry = Configuration.get('Registry', Registry)
+            registry = _Registry(
+                db_name, loadwithoutmigration=loadwithoutmigration, **kwargs)
+            with cls.registries_lock:
+                cls.registries_statistics['miss'] += 1
+                cls.registries[db_name] = registry
+
+        cls.evict_registries()
+        return registry
+
+    @classmethod
+    def get_loaded_registry(cls, db_name, loadwithoutmigration=False):
+        """ Return the registry already loaded for the database
+
+        :param db_name: the name of the database linked to this registry
+        :rtype: ``Registry`` or None
+        """
+        with cls.registries_lock:
+            registry = cls.registries.get(db_name)
+            if registry is None:
+                return None
+
+            cls.registries.move_to_end(db_name)
+            cls.registries_statistics['hit'] += 1
+
+        if loadwithoutmigration:
+            logger.warning("loadwithoutmigration can not be used because "
+                           "the registry for %r is already load" % db_name)
+
         return registry
 
+    @classmethod
+    def get_registries(cls):
+        """ Return a snapshot of the registries kept in memory, the pool
+        may change while the snapshot is iterated
+
+        :rtype: list of ``Registry``
+        """
+        with cls.registries_lock:
+            return list(cls.registries.values())
+
+    @classmethod
+    def get_loading_lock(cls, db_name):
+        """ Return the lock used to load the registry of the database
+
+        The lock is forgotten as soon as no thread references it anymore,
+        so keep a reference on the returned lock while loading the registry
+
+        :param db_name: the name of the database linked to this registry
+        :rtype: ``threading.RLock``
+        """
+        with cls.registries_lock:
+            return cls.registries_loading_locks.setdefault(db_name, RLock())
+
+    @classmethod
+    def evict_registries(cls):
+        """ Close the least recently used registries while there are more
+        registries than the option ``registries_max_size`` allows
+
+        A registry still in use, with a connection checked out, is removed
+        from the pool but closed only once all its connections are released
+        """
+        cls.close_released_registries()
+        max_size = Configuration.get('registries_max_size')
+        if not max_size:
+            return
+
+        while True:
+            with cls.registries_lock:
+                if len(cls.registries) <= max_size:
+                    return
+
+                db_name, registry = cls.registries.popitem(last=False)
+                cls.registries_statistics['eviction'] += 1
+                if registry.is_in_use():
+                    logger.info("Evict the registry of %r, it will be "
+                                "closed once released", db_name)
+                    cls.evicted_registries.append(registry)
+                    continue
+
+            logger.info("Evict the registry of %r", db_name)
+            registry.close()
+
+    @classmethod
+    def close_released_registries(cls):
+        """ Close the evicted registries which are not in use anymore """
+        with cls.registries_lock:
+            released = [registry for registry in cls.evicted_registries
+                        if not registry.is_in_use()]
+            for registry in released:
+                cls.evicted_registries.remove(registry)
+
+        for registry in released:
+            logger.info("Close the evicted registry of %r", registry.db_name)
+            registry.close()
+
+    @classmethod
+    def get_statistics(cls):
+        """ Return the statistics of the registries kept in memory
+
+        :rtype: dict with the keys ``size``, ``max_size``, ``hit``,
+                ``miss`` and ``eviction``
+        """
+        with cls.registries_lock:
+            statistics = dict(size=len(cls.registries),
+                              max_size=Configuration.get(
+                                  'registries_max_size'),
+                              **cls.registries_statistics)
+
+        return statistics
+
+    @classmethod
+    def reset_statistics(cls):
+        """ Reset the counters of the registries statistics """
+        with cls.registries_lock:
+            for key in cls.registries_statistics:
+                cls.registries_statistics[key] = 0
+
     @classmethod
     def reload(cls):
         """ Reload the blok
@@ -137,7 +376,7 @@ class RegistryManager:
         file
 
         """
-        for registry in cls.registries.values():
+        for registry in cls.get_registries():
             registry.close_session()
             registry.Session = None
             registry.blok_list_is_loaded = False
@@ -416,6 +655,8 @@ class Registry:
         registry = Registry('My database')
     """
 
+    fingerprint_key = 'anyblok.registry.fingerprint'
+
     def __init__(self, db_name, loadwithoutmigration=False, unittest=False,
                  **kwargs):
         self.db_name = db_name
@@ -428,6 +669,9 @@ class Registry:
             'registry': self,
             'Env': EnvironmentManager})
         self.withoutautomigration = Configuration.get('withoutautomigration')
+        self.init_cache_invalidation()
+        self.init_shared_cache()
+        self.init_query_cache()
         self.ini_var()
         self.Session = None
         self.nb_query_bases = self.nb_session_bases = 0
@@ -444,6 +688,332 @@ class Registry:
             self.bind = self.engine
             self.unittest_transaction = None
 
+    def init_cache_invalidation(self):
+        """ Initialize the automatic detection of the cache invalidations
+        done by the other processes
+
+        * ``cache_invalidation_interval``: the table of **System.Cache** is
+          checked at the beginning of the transactions at most once by
+          interval
+        * ``CacheInvalidationTransport``: the transport notifies the
+          registry that the table must be checked at the beginning of the
+          next transaction
+        """
+        self.cache_invalidation_interval = Configuration.get(
+            'cache_invalidation_interval')
+        self.cache_invalidation_last_check = time()
+        self.cache_invalidation_requested = False
+        self.cache_invalidation_transport = None
+        Transport = Configuration.get('CacheInvalidationTransport')
+        if Transport is not None:
+            self.cache_invalidation_transport = Transport()
+            self.cache_invalidation_transport.subscribe(
+                self.db_name, self.request_cache_invalidation_check)
+
+    def init_shared_cache(self):
+        """ Open the store of the cache shared by the processes of the host
+        if the option ``cache_shared_slots`` is filled
+
+        ``cache_versions`` is the id of the last invalidation known by
+        method, ``cache_version_floor`` the version of the methods without
+        invalidation, and ``cache_bypass`` counts, by method, the
+        transactions of this process which have invalidated it and whose
+        invalidation has not been read back yet from **System.Cache**, see
+        ``anyblok.shared_cache``
+
+        The store is opened by **System.Cache** once the incarnation of the
+        database is known, see ``open_shared_cache``
+        """
+        self.shared_cache = None
+        self.shared_cache_options = None
+        self.shared_cache_incarnation = None
+        self.cache_versions = {}
+        self.cache_version_floor = 0
+        self.cache_bypass = {}
+        slots = Configuration.get('cache_shared_slots')
+        if slots:
+            self.shared_cache_options = dict(
+                slots=slots,
+                slot_size=Configuration.get('cache_shared_slot_size', 65536),
+                path=Configuration.get('cache_shared_path'))
+
+    def open_shared_cache(self, incarnation):
+        """ Open the store of the shared cache for this incarnation of the
+        database, see ``init_shared_cache``
+
+        :param incarnation: uuid of the database, see
+                            ``System.Cache.get_database_incarnation``
+        """
+        if self.shared_cache_options is None:
+            return
+
+        if self.shared_cache is not None:
+            if self.shared_cache_incarnation == incarnation:
+                return
+
+            self.shared_cache.close()
+
+        slots = self.shared_cache_options['slots']
+        slot_size = self.shared_cache_options['slot_size']
+        path = self.shared_cache_options['path']
+        if path is None:
+            path = SharedMemoryStore.get_default_path(
+                self.db_name, incarnation, slots, slot_size)
+
+        self.shared_cache = SharedMemoryStore(
+            path, slots=slots, slot_size=slot_size)
+        self.shared_cache_incarnation = incarnation
+
+    def init_query_cache(self):
+        """ Create the store of the rows of the queries cached by
+        ``Query.cached``, bounded by the options ``query_cache_size`` and
+        ``query_cache_maxbytes``
+        """
+        self.query_cache = QueryCache(
+            maxsize=Configuration.get('query_cache_size', 256),
+            maxbytes=Configuration.get('query_cache_maxbytes'))
+
+    def get_query_cache_modified_tables(self):
+        """ Return the tables modified by the current transaction, the
+        cache of the queries which read them is not used until the commit
+
+        :rtype: set of table names
+        """
+        return EnvironmentManager.get('_query_cache_tables') or set()
+
+    def track_query_cache(self, models):
+        """ Remove the cached rows of the tables of the models modified by
+        the transaction
+
+        :param models: the assembled models modified in the transaction
+        """
+        tables = {table.fullname
+                  for model in models
+                  for table in model.__mapper__.tables}
+        if not tables:
+            return
+
+        self.query_cache.invalidate_tables(tables)
+        modified_tables = EnvironmentManager.get('_query_cache_tables')
+        if modified_tables is None:
+            modified_tables = set()
+            EnvironmentManager.set('_query_cache_tables', modified_tables)
+
+        modified_tables.update(tables)
+        if not self.loading and self.has_cache_invalidation_check():
+            # the other processes remove their rows of these tables too
+            self.System.Cache.add_query_cache_invalidations(models)
+
+    def release_query_cache_tables(self, committed=True):
+        """ Forget the tables modified by the transaction, once committed
+        the rows read by the other transactions in the meantime are
+        removed
+
+        :param committed: True after the commit, False after the rollback
+        """
+        tables = EnvironmentManager.get('_query_cache_tables')
+        EnvironmentManager.set('_query_cache_tables', set())
+        if tables and committed:
+            self.query_cache.invalidate_tables(tables)
+
+    def get_cache_warm_up_tasks(self):
+        """ Return the cached classmethods declared with ``warm=True`` and
+        the ``warm_up_cache`` hooks of the models
+
+        :rtype: list of (namespace, method)
+        """
+        tasks = [(namespace, method)
+                 for namespace, methods in sorted(self.caches_warm_up.items())
+                 for method in sorted(methods)]
+        tasks.extend((namespace, 'warm_up_cache')
+                     for namespace in sorted(self.loaded_namespaces))
+        return tasks
+
+    def warm_up_cache_method(self, namespace, method, remove_session=False):
+        """ Call the method of the model and log its duration, the errors
+        are logged, they never stop the warm-up
+
+        :param namespace: the namespace of the model
+        :param method: name of the classmethod called without argument
+        :param remove_session: if True, the session of the current thread
+                               is removed after the call
+        :rtype: duration in seconds
+        """
+        start = perf_counter()
+        try:
+            getattr(self.get(namespace), method)()
+        except Exception:
+            logger.exception("Cache warm-up of %s.%s failed",
+                             namespace, method)
+        finally:
+            if remove_session:
+                self.Session.remove()
+
+        duration = perf_counter() - start
+        logger.info("Cache warm-up of %s.%s in %.3fs",
+                    namespace, method, duration)
+        return duration
+
+    def warm_up_caches(self, workers=None):
+        """ Configure the mappers of SQLAlchemy, then fill the cached
+        classmethods declared with ``warm=True`` and call the
+        ``warm_up_cache`` hook of each model. Called at the end of the load
+        of the registry with the option ``cache_warm_up``
+
+        :param workers: number of threads used, by default the option
+                        ``cache_warm_up_workers``. The warm-up is done by the
+                        current thread without it, or in unittest mode
+        :rtype: dict {(namespace, method): duration in seconds}
+        """
+        start = perf_counter()
+        self.cache_warm_up_pending = False
+        configure_mappers()
+        Cache = self.loaded_namespaces.get('Model.System.Cache')
+        if Cache is not None:
+            # the caches must not be cleared by the invalidations already
+            # saved once they are filled
+            Cache.clear_invalidate_cache()
+
+        if workers is None:
+            workers = Configuration.get('cache_warm_up_workers')
+
+        tasks = self.get_cache_warm_up_tasks()
+        if workers and workers > 1 and not self.unittest:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                durations = list(executor.map(
+                    lambda task: self.warm_up_cache_method(
+                        *task, remove_session=True), tasks))
+        else:
+            durations = [self.warm_up_cache_method(*task) for task in tasks]
+
+        logger.info("Cache warm-up of %d methods in %.3fs", len(tasks),
+                    perf_counter() - start)
+        return dict(zip(tasks, durations))
+
+    def warm_up_caches_after_load(self):
+        """ Warm up the caches at once, or after the next commit if the load
+        has invalidated caches: the invalidations are read back from
+        **System.Cache** after the commit
+        """
+        if EnvironmentManager.get('_cache_invalidations'):
+            self.cache_warm_up_pending = True
+        else:
+            self.warm_up_caches()
+
+    def release_cache_bypass(self, invalidations):
+        """ Decrement the counters of ``cache_bypass``
+
+        :param invalidations: iterable of (namespace, method)
+        """
+        for identity in invalidations:
+            count = self.cache_bypass.get(identity, 0) - 1
+            if count > 0:
+                self.cache_bypass[identity] = count
+            else:
+                self.cache_bypass.pop(identity, None)
+
+    def drop_cache_invalidations(self):
+        """ Forget the cache invalidations of the transaction which will
+        not be saved """
+        self.release_cache_bypass(
+            EnvironmentManager.get('_cache_invalidations') or ())
+        EnvironmentManager.set('_cache_invalidations', set())
+
+    def has_cache_invalidation_check(self):
+        """ Return True if the invalidations saved by the other processes
+        are checked, by interval or by transport
+
+        :rtype: boolean
+        """
+        return (self.cache_invalidation_interval is not None or
+                self.cache_invalidation_transport is not None)
+
+    def request_cache_invalidation_check(self):
+        """ Check the cache invalidations at the beginning of the next
+        transaction """
+        self.cache_invalidation_requested = True
+
+    def check_cache_invalidation(self, session, transaction, connection):
+        """ Clear the caches invalidated by the other processes, called
+        by the ``after_begin`` event of the session
+
+        :param session: the session which begins a transaction
+        :param transaction: the new transaction
+        :param connection: the connection used by the transaction
+        """
+        if self.loading:
+            return
+
+        if not self.cache_invalidation_requested:
+            interval = self.cache_invalidation_interval
+            if interval is None:
+                return
+
+            if time() - self.cache_invalidation_last_check < interval:
+                return
+
+        self.cache_invalidation_requested = False
+        self.cache_invalidation_last_check = time()
+        self.System.Cache.check_invalidation(connection)
+
+    def publish_cache_invalidation(self):
+        """ Notify the other processes that caches have been invalidated
+        """
+        if self.cache_invalidation_transport is not None:
+            self.cache_invalidation_transport.publish(self.db_name)
+
+    def get_dependent_caches(self, model):
+        """ Return the cached methods which depend on the model, or on the
+        models it inherits from by polymorphism
+
+        :param model: the assembled model
+        :rtype: set of (namespace, method)
+        """
+        caches = self.dependent_caches_by_model.get(model)
+        if caches is None:
+            caches = set()
+            for cls in model.__mro__:
+                namespace = cls.__dict__.get('__registry_name__')
+                caches.update(self.caches_depends_on.get(namespace, ()))
+
+            self.dependent_caches_by_model[model] = caches
+
+        return caches
+
+    def add_cache_dependencies(self, models):
+        """ Invalidate the cached methods which depend on the models, see
+        ``System.Cache.add_invalidations``
+
+        :param models: the assembled models modified in the transaction
+        """
+        if self.loading or not getattr(self, 'caches_depends_on', None):
+            return
+
+        caches = set()
+        for model in models:
+            caches.update(self.get_dependent_caches(model))
+
+        if caches:
+            self.System.Cache.add_invalidations(caches)
+
+    def track_cache_dependencies(self, session, flush_context):
+        """ ``after_flush`` event of the session, see
+        ``add_cache_dependencies`` and ``track_query_cache`` """
+        models = {
+            type(instance)
+            for instances in (session.new, session.dirty, session.deleted)
+            for instance in instances}
+        self.add_cache_dependencies(models)
+        self.track_query_cache(models)
+
+    def track_bulk_cache_dependencies(self, context):
+        """ ``after_bulk_update`` and ``after_bulk_delete`` events of the
+        session, see ``add_cache_dependencies`` and ``track_query_cache``
+        """
+        if context.mapper is not None:
+            self.add_cache_dependencies([context.mapper.class_])
+            self.track_query_cache([context.mapper.class_])
+
     def init_engine_options(self):
         """Define the options to initialize the engine"""
         return dict(
@@ -464,13 +1034,182 @@ class Registry:
         """
         kwargs = self.init_engine_options()
         url = Configuration.get('get_url', get_url)(db_name=db_name)
-        self.rw_engine = create_engine(url, **kwargs)
+        self.engines_metrics = {}
+        self.rw_engine = self.create_engine('primary', url, **kwargs)
+        self.ro_engines = []
+        if not self.unittest:
+            # In unittest mode, all the queries must use the connection
+            # of the unittest transaction
+            urls = Configuration.get('get_ro_urls', get_ro_urls)(
+                db_name=db_name)
+            for i, url in enumerate(urls):
+                self.ro_engines.append(
+                    self.create_engine('replica %d' % i, url, **kwargs))
+
+        self.ro_engines_counter = count()
+        self.sql_profiler = None
+        if Configuration.get('db_sql_profiler'):
+            self.sql_profiler = SQLProfiler(
+                slowest=Configuration.get('db_sql_profiler_slowest', 10),
+                max_statements=Configuration.get(
+                    'db_sql_profiler_statements', 1000))
+            for engine in self.engines:
+                self.sql_profiler.listen(engine)
+
+    def create_engine(self, name, url, **kwargs):
+        """ Create an engine of the registry
+
+        If the option ``db_pool_metrics`` is filled, the statistics of the
+        pool are saved in ``engines_metrics``
+
+        :param name: name of the engine in the statistics
+        :param url: SqlAlchemy URL
+        :rtype: SqlAlchemy engine
+        """
+        metrics = None
+        if Configuration.get('db_pool_metrics'):
+            metrics = PoolMetrics(
+                name,
+                log_interval=Configuration.get('db_pool_metrics_log_interval'))
+            url = make_url(url)
+            poolclass = kwargs.get(
+                'poolclass', url.get_dialect().get_pool_class(url))
+            kwargs['poolclass'] = metrics.get_pool_class(poolclass)
+
+        engine = create_engine(url, **kwargs)
+        add_engine_pid_protection(engine)
+        if metrics:
+            metrics.listen(engine)
+            self.engines_metrics[name] = metrics
+
+        return engine
+
+    def pool_statistics(self):
+        """ Return the statistics of the pools of the engines, the option
+        ``db_pool_metrics`` must be filled::
+
+            {
+                'primary': {
+                    'size': 5, 'checkedout': 2, 'overflow': -3, ...
+                    'checkout': 2054, 'timeout': 0, 'invalidate': 1, ...
+                    'checkout_time_histogram': [(0.001, 2050), ...],
+                    'checkout_time_avg': 0.0001, ...
+                },
+                'replica 0': {...},
+            }
+
+        :rtype: dict
+        """
+        return {name: metrics.get_statistics()
+                for name, metrics in self.engines_metrics.items()}
+
+    def cache_statistics(self):
+        """ Return the statistics of the cached methods by namespace and
+        method, the statistics of the bases which define the same cached
+        method are summed::
+
+            {
+                ('Model.System.Model', '_fields_description'): {
+                    'hits': 2041, 'misses': 12, 'hit_ratio': 0.994,
+                    'currsize': 12, 'bytes': None,
+                },
+                ...
+            }
+
+        ``bytes`` is only measured by the caches with ``maxbytes``
+
+        :rtype: dict
+        """
+        report = {}
+        for namespace, methods in getattr(self, 'caches', {}).items():
+            for method, wrappers in methods.items():
+                values = dict(hits=0, misses=0, currsize=0, bytes=None)
+                for wrapper in wrappers:
+                    statistics = wrapper.cache_statistics()
+                    for key in ('hits', 'misses', 'currsize'):
+                        values[key] += statistics[key]
+
+                    if statistics.get('maxbytes'):
+                        values['bytes'] = ((values['bytes'] or 0) +
+                                           statistics['bytes'])
+
+                calls = values['hits'] + values['misses']
+                values['hit_ratio'] = values['hits'] / calls if calls else 0
+                report[(namespace, method)] = values
+
+        return report
+
+    def reset_pool_statistics(self):
+        """ Reset the counters of the statistics of the pools """
+        for metrics in self.engines_metrics.values():
+            metrics.reset()
+
+    @contextmanager
+    def profile_sql(self, slowest=10):
+        """ Profile the SQL statements executed by the current thread in
+        this context::
+
+            with registry.profile_sql() as profiler:
+                registry.Model.query().all()
+
+            report = profiler.get_report()
+
+        With the option ``db_sql_profiler`` all the statements executed by
+        the registry are profiled in ``registry.sql_profiler``
+
+        :param slowest: number of slowest statements kept in the report
+        :rtype: ``anyblok.metrics.SQLProfiler``
+        """
+        profiler = SQLProfiler(slowest=slowest, thread=get_ident())
+        for engine in self.engines:
+            profiler.listen(engine)
+
+        try:
+            yield profiler
+        finally:
+            profiler.remove()
 
     @property
     def engine(self):
         """property to get the engine"""
         return self.rw_engine
 
+    @property
+    def engines(self):
+        """property to get the engine and the read only engines"""
+        return [self.rw_engine] + self.ro_engines
+
+    def get_ro_engine(self):
+        """ Return the read only engine to use for a new transaction
+
+        The read only engines are used in turn, they are not used while the
+        registry is loading
+
+        :rtype: SqlAlchemy engine or None if no read only engine can be used
+        """
+        if not self.ro_engines or self.loading:
+            return None
+
+        index = next(self.ro_engines_counter) % len(self.ro_engines)
+        return self.ro_engines[index]
+
+    @contextmanager
+    def pin_primary(self):
+        """ Send all the queries of the session to the primary database
+        in this context, even if the transaction has not written yet::
+
+            with registry.pin_primary():
+                registry.Model.query().all()
+
+        """
+        session = self.session
+        pinned_to_primary = session.pinned_to_primary
+        session.pinned_to_primary = True
+        try:
+            yield session
+        finally:
+            session.pinned_to_primary = pinned_to_primary
+
     def ini_var(self):
         """ Initialize the var to load the registry """
         self.loaded_namespaces = {}
@@ -488,7 +1227,11 @@ class Registry:
         EnvironmentManager.set('_precommit_hook', [])
         EnvironmentManager.set('_postcommit_hook', [])
         self._sqlalchemy_known_events = []
+        self.dependent_caches_by_model = {}
         self.expire_attributes = {}
+        self.fingerprint_unchanged = False
+        self.cache_warm_up_pending = False
+        self.loading = True
 
     @classmethod
     def db_exists(cls, db_name=None):
@@ -892,6 +1635,19 @@ class Registry:
                 EnvironmentManager.scoped_function_for_session())
             self.nb_query_bases = len(self.loaded_cores['Query'])
             self.nb_session_bases = len(self.loaded_cores['Session'])
+            if (
+                self.cache_invalidation_interval is not None or
+                self.cache_invalidation_transport is not None
+            ):
+                event.listen(Session, 'after_begin',
+                             self.check_cache_invalidation)
+
+            event.listen(Session, 'after_flush',
+                         self.track_cache_dependencies)
+            event.listen(Session, 'after_bulk_update',
+                         self.track_bulk_cache_dependencies)
+            event.listen(Session, 'after_bulk_delete',
+                         self.track_bulk_cache_dependencies)
             self.apply_session_events()
         else:
             self.flush()
@@ -911,6 +1667,74 @@ class Registry:
 
         return False
 
+    def get_bloks_to_install_in_one_pass(self, toinstall):
+        """ Return the bloks to install in the same assembly and migration
+        pass
+
+        All the bloks are installed together, the dependencies are loaded
+        before the bloks which need them and the ``install`` / ``update``
+        method of the bloks are called in this order. With the option
+        ``test_blok_at_install``, the bloks are installed one by one, to
+        test each blok on the database state it expects
+
+        :param toinstall: list of the bloks to install
+        :rtype: list of blok's name
+        """
+        if Configuration.get('test_blok_at_install'):
+            return toinstall[:1]
+
+        return [blok for blok in toinstall if blok in BlokManager.bloks]
+
+    def load_bloks_to_install(self, toinstall, toload):
+        """ Load the bloks which are installed in this assembly pass
+
+        :param toinstall: list of the bloks to install
+        :param toload: list of the bloks already installed
+        :rtype: list of the name of the loaded bloks to install
+        """
+        if not toinstall or self.loadwithoutmigration:
+            return []
+
+        bloks2install = self.get_bloks_to_install_in_one_pass(toinstall)
+        for blok2install in bloks2install:
+            self.load_blok(blok2install, True, toload)
+
+        return bloks2install
+
+    def has_deferred_bloks_to_install(self, toinstall, bloks2install):
+        """ Return True if installable bloks are not installed by this
+        assembly pass (``test_blok_at_install``), the registry must be
+        reloaded to install them. The bloks unknown by the ``BlokManager``
+        can never be installed, they are logged and do not need a reload
+
+        :param toinstall: list of the bloks to install
+        :param bloks2install: list of the bloks installed by this pass
+        :rtype: boolean
+        """
+        deferred = [blok for blok in toinstall if blok not in bloks2install]
+        unknown = [blok for blok in deferred if blok not in BlokManager.bloks]
+        if unknown:
+            logger.warning("The bloks %r can not be installed, they are "
+                           "unknown by the BlokManager", unknown)
+
+        return len(deferred) > len(unknown)
+
+    def must_test_blok_at_install(self, blok2install):
+        """ Return True if the unittest of the installed blok must be run
+
+        :param blok2install: name of the blok installed
+        :rtype: boolean
+        """
+        if not blok2install or not Configuration.get('test_blok_at_install'):
+            return False
+
+        selected_bloks = return_list(Configuration.get('selected_bloks'))
+        if blok2install not in (selected_bloks or [blok2install]):
+            return False
+
+        unwanted_bloks = return_list(Configuration.get('unwanted_bloks'))
+        return blok2install not in (unwanted_bloks or [])
+
     @log(logger, level='debug')
     def load(self):
         """ Load all the namespaces of the registry
@@ -918,8 +1742,6 @@ class Registry:
         Create all the table, make the shema migration
         Update Blok, Model, Column rows
         """
-        mustreload = False
-        blok2install = None
         try:
             self.declarativebase = declarative_base(
                 metadata=MetaData(naming_convention=naming_convention),
@@ -933,9 +1755,7 @@ class Registry:
                 self.loadwithoutmigration = False
 
             self.load_bloks(toload, False, toload)
-            if toinstall and not self.loadwithoutmigration:
-                blok2install = toinstall[0]
-                self.load_blok(blok2install, True, toload)
+            bloks2install = self.load_bloks_to_install(toinstall, toload)
 
             instrumentedlist_base = [] + self.loaded_cores['InstrumentedList']
             instrumentedlist_base += [list]
@@ -943,34 +1763,130 @@ class Registry:
                 'InstrumentedList', tuple(instrumentedlist_base), {})
             self.assemble_entries()
             self.create_session_factory()
+            self.fingerprint_unchanged = self.check_fingerprint(toinstall)
 
-            mustreload = self.apply_model_schema_on_table(
-                blok2install) or mustreload
+            mustreload = self.apply_model_schema_on_table(bloks2install)
+            if not self.loadwithoutmigration:
+                mustreload |= self.has_deferred_bloks_to_install(
+                    toinstall, bloks2install)
 
         except Exception as e:
             self.close()
             raise e
 
-        test_blok = blok2install and Configuration.get(
-            'test_blok_at_install')
-        selected_bloks = return_list(Configuration.get('selected_bloks'))
-        in_selected_bloks = blok2install in (selected_bloks or [blok2install])
-        unwanted_bloks = return_list(Configuration.get('unwanted_bloks'))
-        not_in_unwanted_bloks = blok2install not in (unwanted_bloks or [])
-
-        if test_blok and in_selected_bloks and not_in_unwanted_bloks:
+        blok2install = bloks2install[0] if bloks2install else None
+        test_blok = self.must_test_blok_at_install(blok2install)
+        if test_blok:
             self.System.Blok.load_all()
             self.run_test(blok2install)
-            if len(toinstall) > 1 or mustreload:
-                self.reload()
 
-        else:
-            if len(toinstall) > 1 or mustreload:
-                self.reload()
-            else:
-                self.System.Blok.load_all()
+        if mustreload:
+            self.reload()
+        elif not test_blok:
+            self.System.Blok.load_all()
 
         self.loadwithoutmigration = False
+        self.loading = False
+        if not mustreload and Configuration.get('cache_warm_up'):
+            self.warm_up_caches_after_load()
+
+    def get_fingerprint(self):
+        """ Return the fingerprint of the assembled registry
+
+        The fingerprint is a hash of the available bloks with their version,
+        the loaded bloks, the assembled namespaces and the DDL of the tables,
+        plus the state of the database given by
+        ``get_database_fingerprint_values``
+
+        :rtype: str
+        """
+        fingerprint = sha256()
+
+        def update(value):
+            fingerprint.update((value + '\n').encode('utf-8'))
+
+        for blok in BlokManager.ordered_bloks:
+            update('%s %s' % (blok, BlokManager.bloks[blok].version))
+
+        update(' '.join(self.ordered_loaded_bloks))
+        update(' '.join(sorted(self.loaded_namespaces.keys())))
+        dialect = self.engine.dialect
+        for table in self.declarativebase.metadata.sorted_tables:
+            update(str(CreateTable(table).compile(dialect=dialect)))
+            for index in sorted(table.indexes, key=lambda x: x.name or ''):
+                update(str(CreateIndex(index).compile(dialect=dialect)))
+
+        for values in self.get_database_fingerprint_values():
+            update(' '.join(str(x) for x in values))
+
+        return fingerprint.hexdigest()
+
+    def get_database_fingerprint_values(self):
+        """ Return the values read in the database for the fingerprint
+
+        Two cheap queries: the state and the installed version of the bloks,
+        and the columns of the tables of the models in
+        ``information_schema``. A table modified outside AnyBlok (another
+        version of the code, a manual ``ALTER TABLE``) changes the
+        fingerprint, the constraints and the indexes are not read
+
+        :rtype: list of tuples
+        """
+        res = self.execute("""
+            SELECT system_blok.name, system_blok.state,
+                   system_blok.installed_version
+            FROM system_blok
+            ORDER BY system_blok.name""").fetchall()
+
+        tables = [table.name
+                  for table in self.declarativebase.metadata.sorted_tables]
+        if tables:
+            query = """
+                SELECT table_schema, table_name, column_name, data_type,
+                       is_nullable
+                FROM information_schema.columns
+                WHERE table_name in ('%s')
+                ORDER BY table_schema, table_name, column_name
+                """ % "', '".join(tables)
+            res.extend(self.execute(query).fetchall())
+
+        return [tuple(x) for x in res]
+
+    def check_fingerprint(self, toinstall):
+        """ Return True if the fingerprint saved in the database is the
+        same as the fingerprint of the assembled registry
+
+        Only used with the ``registry_fingerprint`` option, when no blok
+        have to be installed, updated or uninstalled
+
+        :param toinstall: list of the bloks to install
+        :rtype: boolean
+        """
+        if not Configuration.get('registry_fingerprint'):
+            return False
+
+        if toinstall or self.loadwithoutmigration:
+            return False
+
+        if self.get_bloks_by_states('toupdate', 'touninstall'):
+            return False
+
+        Parameter = self.System.Parameter
+        if not Parameter.is_exist(self.fingerprint_key):
+            return False
+
+        if Parameter.get(self.fingerprint_key) != self.get_fingerprint():
+            return False
+
+        logger.info('The fingerprint of the registry is unchanged, the '
+                    'migration and the refresh of the System models are '
+                    'skipped')
+        return True
+
+    def save_fingerprint(self):
+        """ Save the fingerprint of the assembled registry in the database
+        """
+        self.System.Parameter.set(self.fingerprint_key, self.get_fingerprint())
 
     def apply_session_events(self):
         """Add session events
@@ -1025,7 +1941,7 @@ class Registry:
                 logger.debug('Pre assemble %r entry' % entry)
                 RegistryManager.callback_pre_assemble_entries[entry](self)
 
-    def apply_model_schema_on_table(self, blok2install):
+    def apply_model_schema_on_table(self, bloks2install):
         # replace the engine by the session.connection for bind attribute
         # because session.connection is already the connection use
         # by blok, migration and all write on the data base
@@ -1034,18 +1950,42 @@ class Registry:
         # data in the session.connection, and risk of bad lock on the
         # tables
         if self.loadwithoutmigration:
-            return
+            return False
+
+        self.migration = Configuration.get('Migration', Migration)(self)
+        if not self.fingerprint_unchanged:
+            self.apply_migration(bloks2install)
 
+        self.listen_sqlalchemy_known_event()
+        mustreload = False
+        for entry in RegistryManager.declared_entries:
+            if entry in RegistryManager.callback_initialize_entries:
+                logger.debug('Initialize %r entry' % entry)
+                r = RegistryManager.callback_initialize_entries[entry](
+                    self)
+                mustreload = mustreload or r
+
+        if (Configuration.get('registry_fingerprint') and
+                not self.fingerprint_unchanged and not mustreload):
+            self.save_fingerprint()
+
+        return mustreload
+
+    def apply_migration(self, bloks2install):
+        """ Create the missing tables and apply the automatic migration
+
+        :param bloks2install: list of the bloks to install
+        """
         if not self.withoutautomigration:
             self.declarativebase.metadata.create_all(self.connection())
 
-        self.migration = Configuration.get('Migration', Migration)(self)
         query = """
             SELECT name, installed_version
             FROM system_blok
             WHERE
-                (state = 'toinstall' AND name = '%s')
-                OR state = 'toupdate'""" % blok2install
+                (state = 'toinstall' AND name in ('%s'))
+                OR state = 'toupdate'""" % "', '".join(
+            return_list(bloks2install) or [])
         res = self.execute(query).fetchall()
         if res:
             for blok, installed_version in res:
@@ -1060,17 +2000,6 @@ class Registry:
         else:
             self.migration.auto_upgrade_database()
 
-        self.listen_sqlalchemy_known_event()
-        mustreload = False
-        for entry in RegistryManager.declared_entries:
-            if entry in RegistryManager.callback_initialize_entries:
-                logger.debug('Initialize %r entry' % entry)
-                r = RegistryManager.callback_initialize_entries[entry](
-                    self)
-                mustreload = mustreload or r
-
-        return mustreload
-
     def expire(self, obj, attribute_names=None):
         """Expire object in session, you can define some attribute which are
         expired::
@@ -1090,7 +2019,7 @@ class Registry:
                 for x in attribute_names
             ]
 
-        self.session.expire(obj, attribute_names=attribute_names)
+        self.Session().expire(obj, attribute_names=attribute_names)
 
     def expire_all(self):
         """Expire all the objects in session
@@ -1132,6 +2061,8 @@ class Registry:
         self.session.rollback(*args, **kwargs)
         EnvironmentManager.set('_precommit_hook', [])
         EnvironmentManager.set('_postcommit_hook', [])
+        self.drop_cache_invalidations()
+        self.release_query_cache_tables(committed=False)
 
     def close_session(self):
         """ Close only the session, not the registry
@@ -1146,25 +2077,104 @@ class Registry:
             session = self.Session()
             session.rollback()
             session.expunge_all()
-            session.close_all()
+            # ``close_all`` would close the sessions of all the registries
+            # of the process, only close the session of this registry
+            self.Session.remove()
 
+        self.drop_cache_invalidations()
+        self.release_query_cache_tables(committed=False)
         if self.unittest_transaction:
             self.unittest_transaction.close()
             self.bind.close()
 
+    def is_in_use(self):
+        """ Return True if a connection of the registry is checked out
+
+        :rtype: boolean
+        """
+        for engine in self.engines:
+            checkedout = getattr(engine.pool, 'checkedout', None)
+            if checkedout is not None and checkedout():
+                return True
+
+        return False
+
     def close(self):
         """Release the session, connection and engine"""
         self.close_session()
-        self.engine.dispose()
-        if self.db_name in RegistryManager.registries:
-            del RegistryManager.registries[self.db_name]
+        for engine in self.engines:
+            engine.dispose()
+
+        if self.cache_invalidation_transport is not None:
+            self.cache_invalidation_transport.unsubscribe()
+
+        if self.shared_cache is not None:
+            self.shared_cache.close()
+            self.shared_cache = None
+
+        with RegistryManager.registries_lock:
+            if RegistryManager.registries.get(self.db_name) is self:
+                del RegistryManager.registries[self.db_name]
+
+    @property
+    def session(self):
+        """ Return the session of the current scope """
+        if self.Session is None:
+            raise AttributeError('session')
+
+        return self.Session()
+
+    query = session_proxy('query')
+    add = session_proxy('add')
+    add_all = session_proxy('add_all')
+    delete = session_proxy('delete')
+    merge = session_proxy('merge')
+    begin = session_proxy('begin')
+    begin_nested = session_proxy('begin_nested')
+    connection = session_proxy('connection')
+    expunge_all = session_proxy('expunge_all')
+
+    def before_fork(self):
+        """ Release the session and the connections of the pool, no
+        connection must be shared with a forked process
+
+        :exception: RegistryException
+        """
+        if self.unittest:
+            raise RegistryException(
+                "A registry in unittest mode can not be shared with forked "
+                "processes")
+
+        if self.Session:
+            self.Session.remove()
+
+        for engine in self.engines:
+            engine.dispose()
+
+    def after_fork(self):
+        """ Replace, in the child process, the session and the connection
+        pool copied from the parent process
+
+        The copied session and connections are dropped without being
+        closed, because their sockets still belong to the parent process
+        """
+        if self.Session:
+            self.Session.registry.clear()
+
+        for engine in self.engines:
+            engine.pool = engine.pool.recreate()
+
+        if self.cache_invalidation_transport is not None:
+            self.cache_invalidation_transport.after_fork()
+
+        EnvironmentManager.set('_precommit_hook', [])
+        EnvironmentManager.set('_postcommit_hook', [])
+        EnvironmentManager.set('_cache_invalidations', set())
 
     def __getattr__(self, attribute):
         # TODO safe the call of session for reload
         if self.Session:
             session = self.Session()
-            if attribute == 'session':
-                return session
             if hasattr(session, attribute):
                 return getattr(session, attribute)
 
@@ -1267,16 +2277,38 @@ class Registry:
             finally:
                 _postcommit_hook.remove(hook)
 
+    def apply_cache_invalidations(self):
+        """ Save the cache invalidations of the transaction, see
+        ``System.Cache.apply_invalidations``
+        """
+        Cache = self.loaded_namespaces.get('Model.System.Cache')
+        if Cache is None:
+            return
+
+        if (
+            getattr(self, 'caches_depends_on', None) or
+            self.has_cache_invalidation_check()
+        ):
+            # track the modifications which are not flushed yet
+            self.flush()
+
+        Cache.apply_invalidations()
+
     def commit(self, *args, **kwargs):
         """ Overload the commit method of the SqlAlchemy session """
         logger.debug('[COMMIT] with args=%r and kwargs = %r', args, kwargs)
         try:
             self.apply_precommit_hook()
+            self.apply_cache_invalidations()
             self.session_commit(*args, **kwargs)
+            self.release_query_cache_tables()
             try:
                 self.apply_postcommit_hook(withexception=False)
             except Exception as e:
                 logger.exception(str(e))
+
+            if self.cache_warm_up_pending:
+                self.warm_up_caches()
         except Exception as e:
             try:
                 self.apply_postcommit_hook(withexception=True)
@@ -1286,8 +2318,9 @@ class Registry:
             raise e
 
     def flush(self):
-        if not self.session._flushing:
-            self.session.flush()
+        session = self.Session()
+        if not session._flushing:
+            session.flush()
 
     def session_commit(self, *args, **kwargs):
         if self.Session:
@@ -1422,10 +2455,12 @@ class Registry:
 
             return wrap
 
-        upgrade_state_bloks('touninstall')(uninstall or [])
-        upgrade_state_bloks('toinstall')(install or [])
-        upgrade_state_bloks('toupdate')(update or [])
-        self.reload()
+        with self.pin_primary():
+            upgrade_state_bloks('touninstall')(uninstall or [])
+            upgrade_state_bloks('toinstall')(install or [])
+            upgrade_state_bloks('toupdate')(update or [])
+            self.reload()
+
         self.expire_all()
 
     @log(logger, level='debug')
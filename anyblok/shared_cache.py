@@ -0,0 +1,253 @@
+# This file is a part of the AnyBlok project
+#
+#    Copyright (C) 2018 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+""" Cache shared by the processes of the same host
+
+The results of the methods declared with ``classmethod_cache(shared=True)``
+are pickled in a file mapped in memory (``mmap``) by all the processes, when
+the option ``--cache-shared-slots`` is filled. The key of a result contains
+the id of the last invalidation of the method in **System.Cache**, so an
+invalidation makes the previous results unreachable for the processes which
+have read it
+
+The store is a hash table with a fixed number of slots of fixed size: a
+result replaces the result saved in its slot, a result bigger than a slot
+is not shared
+
+The store outlives the processes and the database: the keys and the name of
+the default file contain the incarnation of the database (an uuid saved in
+**System.Parameter** the first time), and the store is cleared if the last
+id of **System.Cache** goes backwards (restored database)
+"""
+import os
+import pickle
+import struct
+from hashlib import sha1
+from mmap import mmap
+from tempfile import gettempdir
+from threading import Lock
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    # not a unix system
+    fcntl = None
+
+
+class SharedCacheException(Exception):
+    """ Simple Exception for the shared cache """
+
+
+class SharedMemoryStore:
+    """ Hash table saved in a file mapped in memory
+
+    Each slot is locked (``fcntl.lockf``) while it is read or written, so
+    several processes can use the same file
+
+    :param path: path of the file, created if it does not exist
+    :param slots: number of slots
+    :param slot_size: size of one slot in bytes
+    :exception: SharedCacheException
+    """
+
+    header = struct.Struct('<20sI')
+    meta = struct.Struct('<Q')
+
+    def __init__(self, path, slots=1024, slot_size=65536):
+        if fcntl is None:
+            raise SharedCacheException(
+                "The shared cache needs fcntl, it is only available on the "
+                "unix systems")
+
+        if slot_size <= self.header.size:
+            raise SharedCacheException(
+                "The size of a slot must be greater than %d" %
+                self.header.size)
+
+        self.path = path
+        self.slots = slots
+        self.slot_size = slot_size
+        self.lock = Lock()
+        size = self.meta.size + slots * slot_size
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(self.fd).st_size < size:
+                    os.ftruncate(self.fd, size)
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN)
+
+            self.mmap = mmap(self.fd, size)
+        except Exception:
+            os.close(self.fd)
+            raise
+
+        self.hits = self.misses = self.sets = 0
+
+    @classmethod
+    def get_default_path(cls, db_name, incarnation, slots, slot_size):
+        """ Return a path in the shared memory file system if it exists,
+        the size of the store is in the name of the file to never map a
+        file created with another size, and the incarnation of the database
+        to never read the results of a dropped database
+        """
+        directory = '/dev/shm'
+        if not os.path.isdir(directory):
+            directory = gettempdir()
+
+        return os.path.join(directory, 'anyblok-cache-%s-%s-%dx%d' % (
+            db_name, incarnation, slots, slot_size))
+
+    def get_offset(self, digest):
+        index = int.from_bytes(digest[:8], 'little') % self.slots
+        return self.meta.size + index * self.slot_size
+
+    def check_version(self, version):
+        """ Save the greatest version (last id of **System.Cache**) known
+        by the store, and clear the store if the version goes backwards
+
+        :param version: the last id of **System.Cache**
+        :rtype: True if the store has been cleared
+        """
+        with self.lock:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX)
+            try:
+                known, = self.meta.unpack_from(self.mmap, 0)
+                cleared = version < known
+                if cleared:
+                    self.clear_slots()
+
+                if version != known:
+                    self.meta.pack_into(self.mmap, 0, version)
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN)
+
+        return cleared
+
+    def get(self, key):
+        """ Return a tuple (found, data)
+
+        :param key: bytes
+        """
+        digest = sha1(key).digest()
+        offset = self.get_offset(digest)
+        with self.lock:
+            fcntl.lockf(self.fd, fcntl.LOCK_SH, self.slot_size, offset)
+            try:
+                stored, length = self.header.unpack_from(self.mmap, offset)
+                data = None
+                if stored == digest and length:
+                    start = offset + self.header.size
+                    data = self.mmap[start:start + length]
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, self.slot_size, offset)
+
+            if data is None:
+                self.misses += 1
+                return False, None
+
+            self.hits += 1
+            return True, data
+
+    def set(self, key, data):
+        """ Save the data in the slot of the key
+
+        :param key: bytes
+        :param data: bytes
+        :rtype: False if the data is too big to be saved
+        """
+        if len(data) > self.slot_size - self.header.size:
+            return False
+
+        digest = sha1(key).digest()
+        offset = self.get_offset(digest)
+        with self.lock:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, self.slot_size, offset)
+            try:
+                start = offset + self.header.size
+                self.mmap[start:start + len(data)] = data
+                self.header.pack_into(self.mmap, offset, digest, len(data))
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, self.slot_size, offset)
+
+            self.sets += 1
+
+        return True
+
+    def clear(self):
+        """ Remove all the data of the store, for all the processes """
+        with self.lock:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX)
+            try:
+                self.clear_slots()
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN)
+
+    def clear_slots(self):
+        """ Empty all the slots, the store must be locked """
+        for offset in range(self.meta.size, len(self.mmap), self.slot_size):
+            self.header.pack_into(self.mmap, offset, bytes(20), 0)
+
+    def get_statistics(self):
+        """ Return the statistics of the current process """
+        return dict(hits=self.hits, misses=self.misses, sets=self.sets,
+                    slots=self.slots, slot_size=self.slot_size)
+
+    def close(self):
+        self.mmap.close()
+        os.close(self.fd)
+
+
+def shared_cache_method(method, registry, namespace, attr):
+    """ Wrap the cached classmethod to read and save its results in the
+    shared store of the registry
+
+    The store is not used while the registry is loading, nor while an
+    invalidation of the method done by this process is not committed and
+    read back from **System.Cache**. The results or the arguments which
+    can not be pickled are not shared. A method without invalidation in
+    **System.Cache** gets the version ``cache_version_floor``, never 0
+
+    :param method: the classmethod to wrap
+    :param registry: the registry which owns the shared store
+    :param namespace: namespace of the model
+    :param attr: name of the method
+    """
+    identity = (namespace, attr)
+
+    def wrapper(cls, *args, **kwargs):
+        store = registry.shared_cache
+        if (
+            store is None or registry.loading or
+            identity in registry.cache_bypass
+        ):
+            return method(cls, *args, **kwargs)
+
+        try:
+            key = pickle.dumps((
+                registry.db_name, registry.shared_cache_incarnation,
+                namespace, attr,
+                registry.cache_versions.get(
+                    identity, registry.cache_version_floor),
+                args, sorted(kwargs.items())))
+        except Exception:
+            return method(cls, *args, **kwargs)
+
+        found, data = store.get(key)
+        if found:
+            return pickle.loads(data)
+
+        value = method(cls, *args, **kwargs)
+        if identity not in registry.cache_bypass:
+            try:
+                store.set(key, pickle.dumps(value))
+            except Exception:
+                pass
+
+        return value
+
+    return wrapper
@@ -0,0 +1,170 @@
+# This file is a part of the AnyBlok project
+#
+#    Copyright (C) 2018 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+""" Tests of ``anyblok.aio``, imported by ``test_aio`` only with python
+>= 3.7 because of the ``async`` syntax
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from anyblok.tests.testcase import DBTestCase
+from anyblok.environment import (EnvironmentManager, ContextEnvironment,
+                                 ThreadEnvironment, EnvironmentException)
+from anyblok.aio import AsyncRegistry, AsyncQuery
+from anyblok.column import Integer, String
+
+
+def add_in_registry():
+
+    from anyblok import Declarations
+
+    @Declarations.register(Declarations.Model)
+    class Test:
+
+        id = Integer(primary_key=True)
+        name = String()
+
+        @classmethod
+        def hook(cls, name):
+            cls.insert(name=name)
+
+
+class TestAsyncRegistry(DBTestCase):
+
+    def setUp(self):
+        super(TestAsyncRegistry, self).setUp()
+        EnvironmentManager.define_environment_cls(ContextEnvironment)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+        self.executor.shutdown()
+        super(TestAsyncRegistry, self).tearDown()
+        EnvironmentManager.define_environment_cls(ThreadEnvironment)
+
+    def init_async_registry(self):
+        registry = self.init_registry(add_in_registry)
+        return AsyncRegistry(registry, executor=self.executor)
+
+    def run_coroutine(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def test_need_context_environment(self):
+        registry = self.init_registry(None)
+        EnvironmentManager.define_environment_cls(ThreadEnvironment)
+        with self.assertRaises(EnvironmentException):
+            AsyncRegistry(registry)
+
+    def test_insert_and_query(self):
+        async_registry = self.init_async_registry()
+
+        async def handler():
+            test = await async_registry.Test.insert(name='test')
+            query = async_registry.Test.query().filter_by(name='test')
+            self.assertIsInstance(query, AsyncQuery)
+            self.assertEqual(await query.count(), 1)
+            self.assertEqual(await query.all(), [test])
+            self.assertEqual(await async_registry.Test.query('name').dictone(),
+                             {'name': 'test'})
+            await async_registry.flush()
+
+        self.run_coroutine(handler())
+
+    def test_session_by_task(self):
+        async_registry = self.init_async_registry()
+        registry = async_registry.registry
+
+        async def get_session():
+            return await async_registry.run(lambda: registry.session)
+
+        async def handler():
+            session = await get_session()
+            self.assertIs(await get_session(), session)
+            sessions = await asyncio.gather(get_session(), get_session())
+            self.assertIsNot(sessions[0], session)
+            self.assertIsNot(sessions[1], session)
+            self.assertIsNot(sessions[0], sessions[1])
+
+        self.run_coroutine(handler())
+
+    def test_precommit_hook_by_task(self):
+        async_registry = self.init_async_registry()
+
+        async def add_hook(name):
+            await async_registry.Test.precommit_hook('hook', name)
+            return await async_registry.run(
+                EnvironmentManager.get, '_precommit_hook')
+
+        async def handler():
+            hooks = await asyncio.gather(add_hook('task 1'),
+                                         add_hook('task 2'))
+            self.assertEqual(hooks[0], [('Model.Test', 'hook', ('task 1',),
+                                         {})])
+            self.assertEqual(hooks[1], [('Model.Test', 'hook', ('task 2',),
+                                         {})])
+            await async_registry.Test.precommit_hook('hook', 'main')
+            await async_registry.apply_precommit_hook()
+            names = await async_registry.Test.query('name').all()
+            self.assertEqual(names, [('main',)])
+
+        self.run_coroutine(handler())
+
+    def test_release_the_scope_of_a_done_task(self):
+        async_registry = self.init_async_registry()
+        registry = async_registry.registry
+
+        async def task():
+            await async_registry.run(
+                EnvironmentManager.set, 'test', 'value')
+            return async_registry.ensure_scope()
+
+        async def handler():
+            scope = await asyncio.ensure_future(task())
+            # let the executor release the scope
+            await async_registry.run(lambda: None)
+            self.assertNotIn(scope, ContextEnvironment.values)
+            self.assertNotIn(scope, registry.Session.registry.registry)
+
+        self.run_coroutine(handler())
+
+    def test_max_sessions(self):
+        registry = self.init_registry(add_in_registry)
+        async_registry = AsyncRegistry(registry, executor=self.executor,
+                                       max_sessions=1)
+        events = []
+
+        async def task(name):
+            await async_registry.Test.query().count()
+            events.append(('begin', name))
+            await asyncio.sleep(0.01)
+            events.append(('end', name))
+            await async_registry.commit()
+
+        async def handler():
+            await asyncio.gather(task('task 1'), task('task 2'))
+
+        self.run_coroutine(handler())
+        self.assertEqual(events, [('begin', 'task 1'), ('end', 'task 1'),
+                                  ('begin', 'task 2'), ('end', 'task 2')])
+
+    def test_max_sessions_by_registry(self):
+        registry = self.init_registry(add_in_registry)
+        async_registries = [
+            AsyncRegistry(registry, executor=self.executor, max_sessions=1)
+            for i in range(2)]
+
+        async def task():
+            for async_registry in async_registries:
+                await async_registry.Test.query().count()
+
+        async def handler():
+            for i in range(2):
+                await asyncio.wait_for(asyncio.ensure_future(task()), 5)
+
+        self.run_coroutine(handler())
+        for async_registry in async_registries:
+            self.assertEqual(async_registry.tasks_with_session, set())
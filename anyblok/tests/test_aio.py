@@ -0,0 +1,21 @@
+# This file is a part of the AnyBlok project
+#
+#    Copyright (C) 2018 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from anyblok.tests.testcase import TestCase
+from unittest import skip
+import sys
+
+
+if sys.version_info >= (3, 7):
+    from anyblok.tests.asyncregistrycase import TestAsyncRegistry  # noqa
+else:
+
+    @skip("The asyncio registry needs python >= 3.7")
+    class TestAsyncRegistry(TestCase):
+
+        def test_async_registry(self):
+            pass
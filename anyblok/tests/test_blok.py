@@ -117,6 +117,16 @@ class TestBlok(DBTestCase):
         except RegistryException:
             pass
 
+    def test_has_deferred_bloks_to_install(self):
+        registry = self.init_registry(None)
+        self.assertFalse(registry.has_deferred_bloks_to_install(
+            ['test-blok1', 'test-blok2'], ['test-blok1', 'test-blok2']))
+        self.assertTrue(registry.has_deferred_bloks_to_install(
+            ['test-blok1', 'test-blok2'], ['test-blok1']))
+        # an unknown blok can never be installed, no reload for it
+        self.assertFalse(registry.has_deferred_bloks_to_install(
+            ['test-blok1', 'unknown-blok'], ['test-blok1']))
+
     def test_uninstall(self):
         registry = self.init_registry(None)
         registry.upgrade(install=('test-blok1',))
@@ -342,6 +352,24 @@ class TestBlokRequired2(DBTestCase):
         self.assertEqual(testblok3.version, '1.0.0')
         self.assertEqual(testblok3.installed_version, '1.0.0')
 
+    def test_install_in_one_pass(self):
+        registry = self.init_registry(None)
+        load = registry.load
+        loads = []
+
+        def wrapped_load():
+            loads.append(True)
+            return load()
+
+        registry.load = wrapped_load
+        registry.upgrade(install=('test-blok3',))
+        self.assertEqual(len(loads), 1)
+        Blok = registry.System.Blok
+        query = Blok.query().filter(Blok.name.in_(
+            ['test-blok1', 'test-blok2', 'test-blok3']))
+        self.assertEqual(query.all().state,
+                         ['installed', 'installed', 'installed'])
+
     def test_uninstall(self):
         registry = self.init_registry(None)
         registry.upgrade(install=('test-blok3',))
@@ -7,10 +7,15 @@
 # v. 2.0. If a copy of the MPL was not distributed with this file,You can
 # obtain one at http://mozilla.org/MPL/2.0/.
 from random import random
-from anyblok.tests.testcase import DBTestCase
+from time import sleep
+from anyblok.tests.testcase import TestCase, DBTestCase
 from anyblok.declarations import Declarations, cache, classmethod_cache
-from anyblok.bloks.anyblok_core.exceptions import CacheException
-from anyblok.column import Integer
+from anyblok.bloks.anyblok_core.exceptions import (
+    CacheException, QueryException)
+from anyblok.column import Integer, String
+from anyblok.cache_invalidation import LocalTransport
+from anyblok.common import ExpiringLRUCache, QueryCache, get_size
+from sqlalchemy import func
 register = Declarations.register
 Model = Declarations.Model
 Mixin = Declarations.Mixin
@@ -51,9 +56,13 @@ class TestCache(DBTestCase):
 
     def test_cache_invalidation(self):
         registry = self.init_registry(self.add_model_with_method_cached)
+        registry.commit()
         Cache = registry.System.Cache
         nb_invalidation = Cache.query().count()
         Cache.invalidate('Model.Test', 'method_cached')
+        Cache.invalidate('Model.Test', 'method_cached')
+        self.assertEqual(Cache.query().count(), nb_invalidation)
+        registry.commit()
         self.assertEqual(Cache.query().count(), nb_invalidation + 1)
 
     def test_invalid_cache_invalidation(self):
@@ -79,6 +88,719 @@ class TestCache(DBTestCase):
         self.assertEqual(cache.indentify, ('Model.Test', 'method_cached'))
 
 
+class TestCacheInvalidationCheck(DBTestCase):
+
+    def add_model_with_method_cached(self):
+
+        @register(Model)
+        class Test:
+
+            x = 0
+
+            @classmethod_cache()
+            def method_cached(cls):
+                cls.x += 1
+                return cls.x
+
+    def insert_invalidation_from_another_process(self, registry):
+        registry.System.Cache.insert(registry_name='Model.Test',
+                                     method='method_cached')
+
+    def test_check_invalidation(self):
+        registry = self.init_registry(self.add_model_with_method_cached)
+        Cache = registry.System.Cache
+        self.assertEqual(registry.Test.method_cached(), 1)
+        self.assertFalse(Cache.check_invalidation(registry.connection()))
+        self.insert_invalidation_from_another_process(registry)
+        self.assertEqual(registry.Test.method_cached(), 1)
+        self.assertTrue(Cache.check_invalidation(registry.connection()))
+        self.assertEqual(registry.Test.method_cached(), 2)
+        self.assertFalse(Cache.check_invalidation(registry.connection()))
+
+    def test_no_check_by_default(self):
+        registry = self.init_registry(self.add_model_with_method_cached)
+        self.assertEqual(registry.Test.method_cached(), 1)
+        self.insert_invalidation_from_another_process(registry)
+        registry.commit()
+        registry.System.Blok.query().count()
+        self.assertEqual(registry.Test.method_cached(), 1)
+
+    def test_check_at_the_beginning_of_the_transaction(self):
+        with DBTestCase.Configuration(cache_invalidation_interval=0):
+            registry = self.init_registry(self.add_model_with_method_cached)
+
+        self.assertEqual(registry.Test.method_cached(), 1)
+        self.insert_invalidation_from_another_process(registry)
+        registry.commit()
+        registry.System.Blok.query().count()
+        self.assertEqual(registry.Test.method_cached(), 2)
+
+    def test_check_interval(self):
+        with DBTestCase.Configuration(cache_invalidation_interval=3600):
+            registry = self.init_registry(self.add_model_with_method_cached)
+
+        self.assertEqual(registry.Test.method_cached(), 1)
+        self.insert_invalidation_from_another_process(registry)
+        registry.commit()
+        registry.System.Blok.query().count()
+        self.assertEqual(registry.Test.method_cached(), 1)
+        registry.request_cache_invalidation_check()
+        registry.commit()
+        registry.System.Blok.query().count()
+        self.assertEqual(registry.Test.method_cached(), 2)
+
+    def test_check_notified_by_transport(self):
+        with DBTestCase.Configuration(
+            CacheInvalidationTransport=LocalTransport
+        ):
+            registry = self.init_registry(self.add_model_with_method_cached)
+
+        self.assertFalse(registry.cache_invalidation_requested)
+        registry.System.Cache.invalidate('Model.Test', 'method_cached')
+        self.assertFalse(registry.cache_invalidation_requested)
+        registry.commit()
+        self.assertTrue(registry.cache_invalidation_requested)
+        registry.System.Blok.query().count()
+        self.assertFalse(registry.cache_invalidation_requested)
+
+
+class TestCacheInvalidationLog(DBTestCase):
+
+    def add_model_with_methods_cached(self):
+
+        @register(Model)
+        class Test:
+
+            @classmethod_cache()
+            def method_1(cls):
+                return random()
+
+            @classmethod_cache()
+            def method_2(cls):
+                return random()
+
+    def get_invalidations(self, registry):
+        Cache = registry.System.Cache
+        return Cache.query().filter(
+            Cache.registry_name == 'Model.Test').order_by(Cache.id).all()
+
+    def test_one_insert_at_the_commit(self):
+        registry = self.init_registry(self.add_model_with_methods_cached)
+        registry.commit()
+        Cache = registry.System.Cache
+        for i in range(3):
+            Cache.invalidate('Model.Test', 'method_1')
+            Cache.invalidate('Model.Test', 'method_2')
+
+        with registry.profile_sql() as profiler:
+            registry.commit()
+
+        inserts = [x for x in profiler.get_report()['slowest']
+                   if x['statement'].startswith('INSERT INTO system_cache')]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(
+            [(x.registry_name, x.method)
+             for x in self.get_invalidations(registry)],
+            [('Model.Test', 'method_1'), ('Model.Test', 'method_2')])
+
+    def test_no_invalidation_after_rollback(self):
+        registry = self.init_registry(self.add_model_with_methods_cached)
+        registry.System.Cache.invalidate('Model.Test', 'method_1')
+        registry.rollback()
+        registry.commit()
+        self.assertEqual(len(self.get_invalidations(registry)), 0)
+
+    def test_get_new_invalidations(self):
+        registry = self.init_registry(self.add_model_with_methods_cached)
+        Cache = registry.System.Cache
+        Cache.get_new_invalidations()
+        self.assertEqual(Cache.get_new_invalidations(), set())
+        Cache.insert(registry_name='Model.Test', method='method_1')
+        Cache.insert(registry_name='Model.Test', method='method_1')
+        with registry.profile_sql() as profiler:
+            invalidations = Cache.get_new_invalidations()
+
+        self.assertEqual(invalidations, {('Model.Test', 'method_1')})
+        self.assertEqual(profiler.get_report()['count'], 1)
+        self.assertEqual(Cache.last_cache_id, Cache.get_last_id())
+
+    def test_compact(self):
+        registry = self.init_registry(self.add_model_with_methods_cached)
+        Cache = registry.System.Cache
+        Cache.insert(registry_name='Model.Test', method='method_1')
+        Cache.insert(registry_name='Model.Test', method='method_2')
+        last = Cache.insert(registry_name='Model.Test', method='method_1')
+        Cache.compact()
+        self.assertEqual(
+            [(x.id, x.method) for x in self.get_invalidations(registry)],
+            [(last.id - 1, 'method_2'), (last.id, 'method_1')])
+        Cache.compact(consumed_id=last.id - 1)
+        self.assertEqual(self.get_invalidations(registry), [last])
+
+    def test_compact_before_a_process_has_read(self):
+        registry = self.init_registry(self.add_model_with_methods_cached)
+        Cache = registry.System.Cache
+        value = registry.Test.method_1()
+        self.assertEqual(registry.Test.method_1(), value)
+        # another process invalidates method_1 then compacts, as if all the
+        # processes had read the invalidations
+        lost = Cache.insert(registry_name='Model.Test', method='method_1')
+        Cache.insert(registry_name='Model.Test', method='method_2')
+        Cache.compact(consumed_id=lost.id + 1)
+        self.assertNotIn(lost, self.get_invalidations(registry))
+        self.assertTrue(Cache.check_invalidation(registry.connection()))
+        self.assertNotEqual(registry.Test.method_1(), value)
+        self.assertEqual(Cache.last_cache_id, Cache.get_last_id())
+
+    def test_compact_after_a_process_has_read(self):
+        registry = self.init_registry(self.add_model_with_methods_cached)
+        Cache = registry.System.Cache
+        Cache.insert(registry_name='Model.Test', method='method_1')
+        last = Cache.insert(registry_name='Model.Test', method='method_2')
+        Cache.get_new_invalidations()
+        value = registry.Test.method_1()
+        Cache.compact(consumed_id=last.id - 1)
+        self.assertFalse(Cache.check_invalidation(registry.connection()))
+        self.assertEqual(registry.Test.method_1(), value)
+
+
+class TestExpiringLRUCache(TestCase):
+
+    def test_get_and_set(self):
+        cache = ExpiringLRUCache()
+        self.assertEqual(cache.get('key'), (False, None))
+        cache.set('key', 'value')
+        self.assertEqual(cache.get('key'), (True, 'value'))
+        statistics = cache.statistics()
+        self.assertEqual(statistics['hits'], 1)
+        self.assertEqual(statistics['misses'], 1)
+        self.assertEqual(statistics['currsize'], 1)
+
+    def test_ttl(self):
+        cache = ExpiringLRUCache(ttl=0.01)
+        cache.set('key', 'value')
+        sleep(0.02)
+        self.assertEqual(cache.get('key'), (False, None))
+        self.assertEqual(cache.statistics()['expired'], 1)
+        self.assertEqual(cache.statistics()['currsize'], 0)
+
+    def test_maxsize(self):
+        cache = ExpiringLRUCache(maxsize=2)
+        cache.set(1, 1)
+        cache.set(2, 2)
+        cache.get(1)
+        cache.set(3, 3)
+        self.assertEqual(cache.get(2), (False, None))
+        self.assertEqual(cache.get(1), (True, 1))
+        self.assertEqual(cache.get(3), (True, 3))
+
+    def test_maxbytes(self):
+        value = 'x' * 100
+        size = get_size(value)
+        cache = ExpiringLRUCache(maxsize=None, maxbytes=size * 2)
+        cache.set(1, value)
+        cache.set(2, value + 'y')
+        self.assertEqual(cache.statistics()['currsize'], 1)
+        self.assertEqual(cache.get(1), (False, None))
+        cache.set(3, value * 3)
+        self.assertEqual(cache.get(3), (False, None))
+        self.assertEqual(cache.statistics()['bytes'], size + 1)
+
+    def test_clear(self):
+        cache = ExpiringLRUCache(ttl=10)
+        cache.set('key', 'value')
+        cache.clear()
+        self.assertEqual(cache.get('key'), (False, None))
+
+
+def add_model_with_cache_warm_up():
+
+    @register(Model)
+    class Test:
+
+        calls = 0
+        hook_calls = 0
+
+        @classmethod_cache(warm=True)
+        def get_value(cls):
+            cls.calls += 1
+            return cls.calls
+
+        @classmethod
+        def warm_up_cache(cls):
+            super(Test, cls).warm_up_cache()
+            cls.hook_calls += 1
+
+    @register(Model)
+    class Other:
+
+        @classmethod
+        def warm_up_cache(cls):
+            raise Exception('Warm-up failure')
+
+
+class TestCacheWarmUp(DBTestCase):
+
+    def test_caches_warm_up(self):
+        registry = self.init_registry(add_model_with_cache_warm_up)
+        self.assertEqual(registry.caches_warm_up['Model.Test'],
+                         {'get_value'})
+        self.assertEqual(registry.caches_warm_up['Model.System.Blok'],
+                         {'_fields_description',
+                          'get_hybrid_property_columns'})
+
+    def test_warm_up_caches(self):
+        registry = self.init_registry(add_model_with_cache_warm_up)
+        durations = registry.warm_up_caches()
+        self.assertIn(('Model.Test', 'get_value'), durations)
+        self.assertIn(('Model.Test', 'warm_up_cache'), durations)
+        self.assertIn(('Model.Other', 'warm_up_cache'), durations)
+        self.assertEqual(registry.Test.calls, 1)
+        self.assertEqual(registry.Test.hook_calls, 1)
+        self.assertEqual(registry.Test.get_value(), 1)
+        self.assertEqual(registry.Test.calls, 1)
+
+    def test_no_warm_up_at_load_by_default(self):
+        registry = self.init_registry(add_model_with_cache_warm_up)
+        registry.commit()
+        self.assertEqual(registry.Test.calls, 0)
+
+    def test_warm_up_at_load(self):
+        with DBTestCase.Configuration(cache_warm_up=True):
+            registry = self.init_registry(add_model_with_cache_warm_up)
+
+        # the load has invalidated the caches, they are read back after
+        # the commit
+        registry.commit()
+        self.assertFalse(registry.cache_warm_up_pending)
+        self.assertEqual(registry.Test.calls, 1)
+        self.assertEqual(registry.Test.get_value(), 1)
+
+
+class TestCacheOptions(DBTestCase):
+
+    def add_model_with_cache_options(self):
+
+        @register(Model)
+        class Test:
+
+            x = 0
+
+            @classmethod_cache(ttl=0.01)
+            def method_with_ttl(cls):
+                cls.x += 1
+                return cls.x
+
+            @classmethod_cache(maxsize=1)
+            def method_with_maxsize(cls, value):
+                cls.x += 1
+                return cls.x
+
+            @classmethod_cache(maxbytes=200)
+            def method_with_maxbytes(cls, length):
+                cls.x += 1
+                return 'x' * length
+
+    def test_ttl(self):
+        registry = self.init_registry(self.add_model_with_cache_options)
+        value = registry.Test.method_with_ttl()
+        self.assertEqual(registry.Test.method_with_ttl(), value)
+        sleep(0.02)
+        self.assertEqual(registry.Test.method_with_ttl(), value + 1)
+
+    def test_maxsize(self):
+        registry = self.init_registry(self.add_model_with_cache_options)
+        value = registry.Test.method_with_maxsize(1)
+        self.assertEqual(registry.Test.method_with_maxsize(1), value)
+        registry.Test.method_with_maxsize(2)
+        self.assertEqual(registry.Test.method_with_maxsize(1), value + 2)
+
+    def test_maxbytes(self):
+        registry = self.init_registry(self.add_model_with_cache_options)
+        registry.Test.method_with_maxbytes(10)
+        registry.Test.method_with_maxbytes(1000)
+        statistics = registry.cache_statistics()[
+            ('Model.Test', 'method_with_maxbytes')]
+        self.assertEqual(statistics['currsize'], 1)
+        self.assertEqual(statistics['bytes'], get_size('x' * 10))
+
+    def test_statistics(self):
+        registry = self.init_registry(self.add_model_with_cache_options)
+        wrapper = registry.caches['Model.Test']['method_with_maxsize'][0]
+        registry.Test.method_with_maxsize(1)
+        registry.Test.method_with_maxsize(1)
+        registry.Test.method_with_maxsize(1)
+        self.assertEqual(wrapper.cache_statistics(), dict(
+            hits=2, misses=1, maxsize=1, currsize=1))
+        statistics = registry.cache_statistics()[
+            ('Model.Test', 'method_with_maxsize')]
+        self.assertEqual(statistics, dict(
+            hits=2, misses=1, hit_ratio=2 / 3, currsize=1, bytes=None))
+        self.assertEqual(
+            registry.cache_statistics()[('Model.Test', 'method_with_ttl')],
+            dict(hits=0, misses=0, hit_ratio=0, currsize=0, bytes=None))
+
+    def test_invalidate(self):
+        registry = self.init_registry(self.add_model_with_cache_options)
+        value = registry.Test.method_with_maxbytes(10)
+        registry.System.Cache.invalidate('Model.Test', 'method_with_maxbytes')
+        self.assertEqual(registry.Test.method_with_maxbytes(10), value)
+        statistics = registry.cache_statistics()[
+            ('Model.Test', 'method_with_maxbytes')]
+        self.assertEqual(statistics['misses'], 1)
+
+
+def add_model_with_cache_depends_on():
+
+    @register(Model)
+    class Test:
+
+        id = Integer(primary_key=True)
+        name = String()
+
+    @register(Model)
+    class Other:
+
+        id = Integer(primary_key=True)
+
+    @register(Model)
+    class Reader:
+
+        calls = 0
+
+        @classmethod_cache(depends_on=['Model.Test'])
+        def get_names(cls):
+            cls.calls += 1
+            return cls.registry.Test.query('name').order_by('name').all().name
+
+
+class TestCacheDependsOn(DBTestCase):
+
+    def init_registry_with_names(self):
+        registry = self.init_registry(add_model_with_cache_depends_on)
+        registry.Test.insert(name='a')
+        registry.commit()
+        self.assertEqual(registry.Reader.get_names(), ['a'])
+        return registry
+
+    def test_caches_depends_on(self):
+        registry = self.init_registry(add_model_with_cache_depends_on)
+        self.assertEqual(registry.caches_depends_on['Model.Test'],
+                         {('Model.Reader', 'get_names')})
+
+    def test_invalidate_at_the_flush(self):
+        registry = self.init_registry_with_names()
+        nb_invalidations = registry.System.Cache.query().count()
+        registry.Test.insert(name='b')
+        # cleared at the flush in this process, saved at the commit
+        self.assertEqual(registry.Reader.get_names(), ['a', 'b'])
+        self.assertEqual(registry.System.Cache.query().count(),
+                         nb_invalidations)
+        registry.commit()
+        self.assertEqual(registry.System.Cache.query().count(),
+                         nb_invalidations + 1)
+
+    def test_invalidate_changes_not_flushed(self):
+        registry = self.init_registry_with_names()
+        registry.Test.query().one().name = 'b'
+        registry.commit()
+        self.assertEqual(registry.Reader.get_names(), ['b'])
+
+    def test_invalidate_after_delete(self):
+        registry = self.init_registry_with_names()
+        registry.Test.query().one().delete()
+        registry.commit()
+        self.assertEqual(registry.Reader.get_names(), [])
+
+    def test_invalidate_after_bulk_update(self):
+        registry = self.init_registry_with_names()
+        registry.Test.query().update({'name': 'b'})
+        registry.commit()
+        self.assertEqual(registry.Reader.get_names(), ['b'])
+
+    def test_no_invalidation_by_another_model(self):
+        registry = self.init_registry_with_names()
+        calls = registry.Reader.calls
+        registry.Other.insert()
+        registry.commit()
+        self.assertEqual(registry.Reader.get_names(), ['a'])
+        self.assertEqual(registry.Reader.calls, calls)
+
+
+def add_model_with_identity_cache(identity_cache=True):
+
+    @register(Model, identity_cache=identity_cache)
+    class Test:
+
+        id = Integer(primary_key=True)
+        name = String()
+
+
+class TestIdentityCache(DBTestCase):
+
+    def init_registry_with_entries(self, **kwargs):
+        registry = self.init_registry(add_model_with_identity_cache, **kwargs)
+        registry.Test.insert(id=1, name='a')
+        registry.Test.insert(id=2, name='b')
+        registry.commit()
+        registry.session.expunge_all()
+        return registry
+
+    def count_queries(self, registry, callback):
+        with registry.profile_sql() as profiler:
+            res = callback()
+
+        return profiler.get_report()['count'], res
+
+    def test_from_primary_keys(self):
+        registry = self.init_registry_with_entries()
+        self.assertEqual(registry.Test.from_primary_keys(id=1).name, 'a')
+        registry.session.expunge_all()
+        count, test = self.count_queries(
+            registry, lambda: registry.Test.from_primary_keys(id=1))
+        self.assertEqual(count, 0)
+        self.assertEqual(test.name, 'a')
+        self.assertIn(test, registry.session)
+        self.assertIs(registry.Test.from_primary_keys(id=1), test)
+        statistics = registry.cache_statistics()[
+            ('Model.Test', 'identity_cache')]
+        self.assertEqual(statistics['misses'], 1)
+        self.assertEqual(statistics['hits'], 2)
+        self.assertEqual(statistics['currsize'], 1)
+
+    def test_from_primary_keys_unknown(self):
+        registry = self.init_registry_with_entries()
+        self.assertIsNone(registry.Test.from_primary_keys(id=3))
+
+    def test_update_cached_instance(self):
+        registry = self.init_registry_with_entries()
+        registry.Test.from_primary_keys(id=1)
+        registry.session.expunge_all()
+        registry.Test.from_primary_keys(id=1).name = 'c'
+        registry.commit()
+        registry.session.expunge_all()
+        self.assertEqual(registry.Test.from_primary_keys(id=1).name, 'c')
+        self.assertEqual(registry.Test.query().get(1).name, 'c')
+
+    def test_invalidated_by_the_flush(self):
+        registry = self.init_registry_with_entries()
+        registry.Test.from_primary_keys(id=1).name = 'c'
+        registry.flush()
+        self.assertFalse(registry.identity_caches['Model.Test'].instances)
+        # not used until the invalidation is committed
+        self.assertIsNone(registry.Test.get_identity_cache())
+        registry.commit()
+        self.assertIsNotNone(registry.Test.get_identity_cache())
+
+    def test_invalidated_by_system_cache(self):
+        registry = self.init_registry_with_entries()
+        registry.Test.from_primary_keys(id=1)
+        registry.System.Cache.invalidate('Model.Test', 'identity_cache')
+        self.assertFalse(registry.identity_caches['Model.Test'].instances)
+
+    def test_cached_filter_by(self):
+        registry = self.init_registry_with_entries()
+        self.assertEqual(registry.Test.cached_filter_by(name='a').id, [1])
+        registry.session.expunge_all()
+        count, tests = self.count_queries(
+            registry, lambda: registry.Test.cached_filter_by(name='a'))
+        self.assertEqual(count, 0)
+        self.assertEqual(tests.id, [1])
+        registry.Test.insert(id=3, name='a')
+        registry.commit()
+        self.assertEqual(
+            sorted(registry.Test.cached_filter_by(name='a').id), [1, 3])
+
+    def test_cached_filter_by_sees_the_changes_not_flushed(self):
+        registry = self.init_registry_with_entries()
+        self.assertEqual(registry.Test.cached_filter_by(name='a').id, [1])
+        registry.Test.from_primary_keys(id=2).name = 'a'
+        self.assertEqual(
+            sorted(registry.Test.cached_filter_by(name='a').id), [1, 2])
+        registry.commit()
+
+    def test_maxsize(self):
+        registry = self.init_registry_with_entries(identity_cache=1)
+        registry.Test.from_primary_keys(id=1)
+        registry.Test.from_primary_keys(id=2)
+        self.assertEqual(
+            list(registry.identity_caches['Model.Test'].instances), [(2,)])
+
+    def test_without_identity_cache(self):
+        registry = self.init_registry_with_entries(identity_cache=False)
+        self.assertNotIn('Model.Test', registry.identity_caches)
+        self.assertEqual(registry.Test.cached_filter_by(name='b').id, [2])
+
+
+def add_model_with_query_cache():
+
+    @register(Model)
+    class Test:
+
+        id = Integer(primary_key=True)
+        name = String()
+        amount = Integer()
+
+    @register(Model)
+    class Other:
+
+        id = Integer(primary_key=True)
+
+
+class TestQueryCache(DBTestCase):
+
+    def init_registry_with_amounts(self, **kwargs):
+        registry = self.init_registry(add_model_with_query_cache, **kwargs)
+        registry.Test.multi_insert({'name': 'a', 'amount': 1},
+                                   {'name': 'b', 'amount': 2})
+        registry.commit()
+        return registry
+
+    def get_total(self, registry, ttl=None):
+        Test = registry.Test
+        return Test.query(func.sum(Test.amount)).cached(ttl=ttl).scalar()
+
+    def count_queries(self, registry, callback):
+        with registry.profile_sql() as profiler:
+            res = callback()
+
+        return profiler.get_report()['count'], res
+
+    def test_cached(self):
+        registry = self.init_registry_with_amounts()
+        self.assertEqual(self.get_total(registry), 3)
+        count, total = self.count_queries(
+            registry, lambda: self.get_total(registry))
+        self.assertEqual(count, 0)
+        self.assertEqual(total, 3)
+        statistics = registry.query_cache.statistics()
+        self.assertEqual(statistics['hits'], 1)
+        self.assertEqual(statistics['misses'], 1)
+        self.assertEqual(statistics['currsize'], 1)
+
+    def test_cached_by_parameters(self):
+        registry = self.init_registry_with_amounts()
+        Test = registry.Test
+        query = Test.query('amount').cached()
+        self.assertEqual(query.filter(Test.name == 'a').scalar(), 1)
+        self.assertEqual(query.filter(Test.name == 'b').scalar(), 2)
+        self.assertEqual(query.filter(Test.name == 'a').scalar(), 1)
+        self.assertEqual(registry.query_cache.statistics()['currsize'], 2)
+
+    def test_cached_count(self):
+        registry = self.init_registry_with_amounts()
+        self.assertEqual(registry.Test.query().cached().count(), 2)
+        count, res = self.count_queries(
+            registry, lambda: registry.Test.query().cached().count())
+        self.assertEqual(count, 0)
+        self.assertEqual(res, 2)
+
+    def test_cached_instances(self):
+        registry = self.init_registry_with_amounts()
+        with self.assertRaises(QueryException):
+            registry.Test.query().cached().all()
+
+    def test_invalidated_by_the_flush(self):
+        registry = self.init_registry_with_amounts()
+        self.assertEqual(self.get_total(registry), 3)
+        registry.Test.insert(name='c', amount=3)
+        self.assertEqual(self.get_total(registry), 6)
+        # not cached until the commit
+        self.assertEqual(registry.query_cache.statistics()['currsize'], 0)
+        registry.commit()
+        self.assertEqual(self.get_total(registry), 6)
+        self.assertEqual(registry.query_cache.statistics()['currsize'], 1)
+
+    def test_read_the_pending_changes(self):
+        registry = self.init_registry_with_amounts()
+        self.assertEqual(self.get_total(registry), 3)
+        test = registry.Test.query().filter_by(name='a').one()
+        test.amount = 10
+        # not flushed yet, the query autoflushes it
+        self.assertEqual(self.get_total(registry), 12)
+
+    def test_invalidated_by_bulk_update(self):
+        registry = self.init_registry_with_amounts()
+        self.assertEqual(self.get_total(registry), 3)
+        registry.Test.query().update({'amount': 5})
+        registry.commit()
+        self.assertEqual(self.get_total(registry), 10)
+
+    def test_not_invalidated_by_another_table(self):
+        registry = self.init_registry_with_amounts()
+        self.assertEqual(self.get_total(registry), 3)
+        registry.Other.insert()
+        registry.commit()
+        self.assertEqual(registry.query_cache.statistics()['currsize'], 1)
+
+    def update_from_another_process(self, registry):
+        # Core statement, this process does not see the modification
+        Test = registry.Test
+        registry.execute(Test.__table__.update().values(amount=5))
+        registry.System.Cache.insert(
+            registry_name='Model.Test',
+            method=registry.System.Cache.query_cache_method)
+        registry.commit()
+
+    def test_invalidated_by_another_process(self):
+        with DBTestCase.Configuration(cache_invalidation_interval=0):
+            registry = self.init_registry_with_amounts()
+
+        self.assertEqual(self.get_total(registry), 3)
+        self.update_from_another_process(registry)
+        self.assertEqual(self.get_total(registry), 10)
+
+    def test_invalidation_saved_for_the_other_processes(self):
+        with DBTestCase.Configuration(cache_invalidation_interval=0):
+            registry = self.init_registry_with_amounts()
+
+        Cache = registry.System.Cache
+        registry.Test.insert(name='c', amount=3)
+        registry.commit()
+        self.assertEqual(
+            Cache.query().filter_by(
+                registry_name='Model.Test',
+                method=Cache.query_cache_method).count(), 1)
+
+    def test_only_ttl_without_invalidation_check(self):
+        registry = self.init_registry_with_amounts()
+        Cache = registry.System.Cache
+        self.assertEqual(self.get_total(registry, ttl=0.05), 3)
+        self.update_from_another_process(registry)
+        self.assertEqual(self.get_total(registry, ttl=0.05), 3)
+        self.assertEqual(
+            Cache.query().filter_by(method=Cache.query_cache_method).count(),
+            1)
+        sleep(0.1)
+        self.assertEqual(self.get_total(registry, ttl=0.05), 10)
+
+    def test_ttl(self):
+        registry = self.init_registry_with_amounts()
+        self.assertEqual(self.get_total(registry, ttl=0.05), 3)
+        sleep(0.1)
+        self.assertEqual(self.get_total(registry, ttl=0.05), 3)
+        self.assertEqual(registry.query_cache.statistics()['expired'], 1)
+
+    def test_maxsize(self):
+        registry = self.init_registry_with_amounts()
+        registry.query_cache.maxsize = 1
+        Test = registry.Test
+        query = Test.query('amount').cached()
+        query.filter(Test.name == 'a').scalar()
+        query.filter(Test.name == 'b').scalar()
+        self.assertEqual(registry.query_cache.statistics()['currsize'], 1)
+        count, res = self.count_queries(
+            registry, lambda: query.filter(Test.name == 'b').scalar())
+        self.assertEqual(count, 0)
+
+    def test_not_saved_if_the_table_is_modified_meanwhile(self):
+        query_cache = QueryCache()
+        versions = query_cache.get_versions(('test',))
+        query_cache.invalidate_tables(['test'])
+        query_cache.set('key', [(1,)], ('test',), versions=versions)
+        self.assertEqual(query_cache.get('key'), (False, None))
+
+
 class TestSimpleCache(DBTestCase):
 
     def check_method_cached(self, Model, registry_name, value=1):
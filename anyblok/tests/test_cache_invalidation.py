@@ -0,0 +1,93 @@
+# This file is a part of the AnyBlok project
+#
+#    Copyright (C) 2018 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+import os
+from socket import socket, AF_UNIX, SOCK_DGRAM
+from tempfile import TemporaryDirectory
+from threading import Event
+from anyblok.tests.testcase import TestCase
+from anyblok.cache_invalidation import LocalTransport, SocketTransport
+
+
+class TestLocalTransport(TestCase):
+
+    def tearDown(self):
+        super(TestLocalTransport, self).tearDown()
+        LocalTransport.subscribers.clear()
+
+    def test_publish(self):
+        notifications = []
+        transport = LocalTransport()
+        transport.subscribe('db1', lambda: notifications.append('db1'))
+        transport.subscribe('db2', lambda: notifications.append('db2'))
+        LocalTransport().publish('db1')
+        self.assertEqual(notifications, ['db1'])
+
+    def test_unsubscribe(self):
+        notifications = []
+        transport = LocalTransport()
+        transport.subscribe('db1', lambda: notifications.append('db1'))
+        transport.unsubscribe()
+        LocalTransport().publish('db1')
+        self.assertEqual(notifications, [])
+
+
+class TestSocketTransport(TestCase):
+
+    def setUp(self):
+        super(TestSocketTransport, self).setUp()
+        self.directory = TemporaryDirectory()
+        self.transports = []
+
+    def tearDown(self):
+        for transport in self.transports:
+            transport.unsubscribe()
+
+        self.directory.cleanup()
+        super(TestSocketTransport, self).tearDown()
+
+    def get_transport(self):
+        transport = SocketTransport(directory=self.directory.name)
+        self.transports.append(transport)
+        return transport
+
+    def get_socket_files(self, db_name):
+        return os.listdir(os.path.join(self.directory.name, db_name))
+
+    def test_publish(self):
+        db1 = Event()
+        db2 = Event()
+        self.get_transport().subscribe('db1', db1.set)
+        self.get_transport().subscribe('db2', db2.set)
+        self.get_transport().publish('db1')
+        self.assertTrue(db1.wait(5))
+        self.assertFalse(db2.is_set())
+
+    def test_unsubscribe(self):
+        transport = self.get_transport()
+        transport.subscribe('db1', lambda: None)
+        self.assertEqual(len(self.get_socket_files('db1')), 1)
+        transport.unsubscribe()
+        self.assertEqual(self.get_socket_files('db1'), [])
+
+    def test_remove_the_socket_of_a_dead_process(self):
+        os.makedirs(os.path.join(self.directory.name, 'db1'))
+        path = os.path.join(self.directory.name, 'db1', 'dead.sock')
+        sock = socket(AF_UNIX, SOCK_DGRAM)
+        sock.bind(path)
+        sock.close()
+        self.get_transport().publish('db1')
+        self.assertEqual(self.get_socket_files('db1'), [])
+
+    def test_after_fork(self):
+        event = Event()
+        transport = self.get_transport()
+        transport.subscribe('db1', event.set)
+        transport.after_fork()
+        self.assertEqual(len(self.get_socket_files('db1')), 2)
+        self.get_transport().publish('db1')
+        self.assertTrue(event.wait(5))
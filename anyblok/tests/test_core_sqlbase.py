@@ -7,10 +7,12 @@
 # v. 2.0. If a copy of the MPL was not distributed with this file,You can
 # obtain one at http://mozilla.org/MPL/2.0/.
 from anyblok.tests.testcase import DBTestCase
-from anyblok.column import Integer, String, Selection
+from anyblok.column import Integer, String, Selection, Sequence
 from anyblok.relationship import Many2One, One2One, Many2Many, One2Many
 from anyblok.declarations import Declarations
 from anyblok.bloks.anyblok_core.exceptions import SqlBaseException
+from anyblok.common import anyblok_column_prefix
+from sqlalchemy import inspect
 
 
 Model = Declarations.Model
@@ -117,6 +119,482 @@ class TestCoreSQLBase(DBTestCase):
         self.assertEqual(t.to_primary_keys(), {'id': t.id})
         self.assertEqual(registry.Test.from_primary_keys(id=t.id), t)
 
+    def count_queries(self, registry, callback):
+        with registry.profile_sql() as profiler:
+            res = callback()
+
+        return profiler.get_report()['count'], res
+
+    def test_from_primary_keys_in_the_session(self):
+        registry = self.init_registry(self.declare_model)
+        t = registry.Test.insert(id2=1)
+        count, res = self.count_queries(
+            registry, lambda: registry.Test.from_primary_keys(id=t.id))
+        self.assertEqual(count, 0)
+        self.assertIs(res, t)
+
+    def test_from_primary_keys_with_one_query(self):
+        registry = self.init_registry(self.declare_model)
+        t = registry.Test.insert(id2=1)
+        registry.flush()
+        registry.session.expunge_all()
+        count, res = self.count_queries(
+            registry, lambda: registry.Test.from_primary_keys(id=t.id))
+        self.assertEqual(count, 1)
+        self.assertEqual(res.id2, 1)
+        count, res = self.count_queries(
+            registry, lambda: registry.Test.from_primary_keys(id=t.id + 1))
+        self.assertEqual(count, 1)
+        self.assertIsNone(res)
+
+    def test_from_primary_keys_with_pending_delete(self):
+        registry = self.init_registry(self.declare_model)
+        t = registry.Test.insert(id2=1)
+        registry.session.delete(t)
+        self.assertIsNone(registry.Test.from_primary_keys(id=t.id))
+        self.assertEqual(
+            registry.Test.from_primary_keys_many([{'id': t.id}]), [None])
+
+    def test_from_primary_keys_with_pending_primary_key_change(self):
+        registry = self.init_registry(self.declare_model)
+        t = registry.Test.insert(id=1, id2=1)
+        t.id = 2
+        self.assertIsNone(registry.Test.from_primary_keys(id=1))
+        self.assertIs(registry.Test.from_primary_keys(id=2), t)
+        self.assertEqual(
+            registry.Test.from_primary_keys_many([{'id': 1}, {'id': 2}]),
+            [None, t])
+
+    def test_from_primary_keys_without_primary_key(self):
+        registry = self.init_registry(self.declare_model)
+        with self.assertRaises(SqlBaseException):
+            registry.Test.from_primary_keys(id2=1)
+
+    def test_from_primary_keys_many(self):
+        registry = self.init_registry(self.declare_model)
+        t1 = registry.Test.insert(id2=1)
+        t2 = registry.Test.insert(id2=2)
+        t3 = registry.Test.insert(id2=3)
+        registry.flush()
+        registry.session.expunge(t2)
+        registry.session.expunge(t3)
+        count, res = self.count_queries(
+            registry, lambda: registry.Test.from_primary_keys_many([
+                {'id': t3.id}, {'id': t1.id}, {'id': 1000}, {'id': t2.id},
+                {'id': t3.id}]))
+        self.assertEqual(count, 1)
+        self.assertEqual([x and x.id2 for x in res], [3, 1, None, 2, 3])
+        self.assertIs(res[1], t1)
+        self.assertIs(res[0], res[4])
+
+    def test_from_primary_keys_many_in_the_session(self):
+        registry = self.init_registry(self.declare_model)
+        t1 = registry.Test.insert(id2=1)
+        count, res = self.count_queries(
+            registry, lambda: registry.Test.from_primary_keys_many(
+                [{'id': t1.id}]))
+        self.assertEqual(count, 0)
+        self.assertEqual(res, [t1])
+
+    def test_from_primary_keys_many_without_primary_key(self):
+        registry = self.init_registry(self.declare_model)
+        with self.assertRaises(SqlBaseException):
+            registry.Test.from_primary_keys_many([{'id2': 1}])
+
+    def test_from_primary_keys_many_with_multi_primary_keys(self):
+
+        def add_in_registry():
+
+            @register(Model)
+            class Test:
+                id = Integer(primary_key=True)
+                code = String(primary_key=True)
+                name = String()
+
+        registry = self.init_registry(add_in_registry)
+        registry.Test.insert(id=1, code='a', name='1a')
+        registry.Test.insert(id=1, code='b', name='1b')
+        registry.Test.insert(id=2, code='a', name='2a')
+        registry.flush()
+        registry.session.expunge_all()
+        res = registry.Test.from_primary_keys_many([
+            {'id': 2, 'code': 'a'}, {'id': 1, 'code': 'b'},
+            {'id': 2, 'code': 'b'}])
+        self.assertEqual([x and x.name for x in res], ['2a', '1b', None])
+
+    def declare_model_for_bulk_insert(self):
+
+        @register(Model)
+        class Test:
+            id = Integer(primary_key=True)
+            id2 = Integer()
+            name = String(default='default')
+            code = String(default='get_code')
+            number = Sequence()
+
+            @classmethod
+            def get_code(cls):
+                return 'code'
+
+    def test_bulk_insert(self):
+        registry = self.init_registry(self.declare_model_for_bulk_insert)
+        count, res = self.count_queries(
+            registry, lambda: registry.Test.bulk_insert(
+                [{'id2': x} for x in range(3)], orm_events=False))
+        # two queries for the sequence and one for the insert
+        self.assertEqual(count, 3)
+        tests = registry.Test.query().order_by(registry.Test.id).all()
+        self.assertEqual(res, [{'id': x.id} for x in tests])
+        self.assertEqual(tests.id2, [0, 1, 2])
+        self.assertEqual(tests.name, ['default'] * 3)
+        self.assertEqual(tests.code, ['code'] * 3)
+        self.assertEqual(tests.number, ['1', '2', '3'])
+        self.assertEqual(registry.Test.insert().number, '4')
+
+    def test_bulk_insert_with_values(self):
+        registry = self.init_registry(self.declare_model_for_bulk_insert)
+        registry.Test.bulk_insert([
+            {'id2': 1, 'name': 'one', 'number': 'n1'},
+            {'id2': 2, 'name': 'two', 'number': 'n2'},
+            {'id2': 3},
+        ])
+        tests = registry.Test.query().order_by(registry.Test.id).all()
+        self.assertEqual(tests.name, ['one', 'two', 'default'])
+        self.assertEqual(tests.number, ['n1', 'n2', '1'])
+
+    def test_bulk_insert_return_instances(self):
+        registry = self.init_registry(self.declare_model_for_bulk_insert)
+        res = registry.Test.bulk_insert(
+            [{'id2': x} for x in range(3)], return_instances=True)
+        self.assertEqual(res.id2, [0, 1, 2])
+        self.assertEqual(res, registry.Test.query().order_by(
+            registry.Test.id).all())
+
+    def test_bulk_insert_by_chunk(self):
+        registry = self.init_registry(self.declare_model)
+        count, res = self.count_queries(
+            registry, lambda: registry.Test.bulk_insert(
+                [{'id2': x} for x in range(5)], chunk_size=2))
+        self.assertEqual(count, 3)
+        self.assertEqual(len(res), 5)
+        self.assertEqual(registry.Test.query().count(), 5)
+
+    def test_bulk_insert_with_unknown_column(self):
+        registry = self.init_registry(self.declare_model)
+        with self.assertRaises(SqlBaseException):
+            registry.Test.bulk_insert([{'id2': 1, 'wrong': 1}])
+
+    def test_bulk_insert_with_orm_events(self):
+
+        def add_in_registry():
+
+            @register(Model)
+            class Test:
+                id = Integer(primary_key=True)
+                name = String()
+
+                @classmethod
+                def before_insert_orm_event(cls, mapper, connection, target):
+                    target.name = 'by event'
+
+        registry = self.init_registry(add_in_registry)
+        registry.Test.bulk_insert([{'name': 'by orm'}])
+        registry.Test.bulk_insert([{'name': 'by bulk'}], orm_events=False)
+        self.assertEqual(
+            registry.Test.query().order_by(registry.Test.id).all().name,
+            ['by event', 'by bulk'])
+
+    def test_bulk_insert_versus_multi_insert(self):
+        registry = self.init_registry(self.declare_model)
+        rows = [{'id2': x} for x in range(100)]
+        multi_insert_count, res = self.count_queries(
+            registry, lambda: registry.Test.multi_insert(*rows))
+        bulk_insert_count, res = self.count_queries(
+            registry, lambda: registry.Test.bulk_insert(rows))
+        self.assertEqual(bulk_insert_count, 1)
+        self.assertGreater(multi_insert_count, bulk_insert_count)
+        self.assertEqual(registry.Test.query().count(), 200)
+
+    def test_bulk_update(self):
+        registry = self.init_registry(self.declare_model_for_bulk_insert)
+        pks = registry.Test.bulk_insert([{'id2': x} for x in range(4)])
+        registry.flush()
+        count, res = self.count_queries(
+            registry, lambda: registry.Test.bulk_update([
+                dict(pks[0], id2=10, name='t0'),
+                dict(pks[1], id2=11),
+                dict(pks[2], id2=12, name='t2'),
+                dict(pks[3]),
+                {'id': -1, 'id2': 13},
+            ]))
+        # one executemany by set of updated columns
+        self.assertEqual(count, 2)
+        self.assertEqual(res, 3)
+        tests = registry.Test.query().order_by(registry.Test.id).all()
+        self.assertEqual(tests.id2, [10, 11, 12, 3])
+        self.assertEqual(tests.name, ['t0', 'default', 't2', 'default'])
+
+    def test_bulk_update_expire_only_the_updated_columns(self):
+        registry = self.init_registry(self.declare_model_for_bulk_insert)
+        t1 = registry.Test.insert(id2=1)
+        t2 = registry.Test.insert(id2=2)
+        registry.Test.bulk_update([{'id': t1.id, 'id2': 10}])
+        self.assertEqual(inspect(t1).expired_attributes,
+                         {anyblok_column_prefix + 'id2'})
+        self.assertFalse(inspect(t2).expired_attributes)
+        self.assertEqual(t1.id2, 10)
+        self.assertEqual(t2.id2, 2)
+
+    def test_bulk_update_many2one(self):
+        registry = self.init_registry(self.add_in_registry_m2o)
+        t1 = registry.Test.insert(name='t1')
+        t2 = registry.Test.insert(name='t2')
+        t3 = registry.Test2.insert(name='t3', test=t1)
+        self.assertEqual(t1.test2, [t3])
+        registry.Test2.bulk_update([{'id': t3.id, 'test_id': t2.id}])
+        self.assertIs(t3.test, t2)
+        self.assertEqual(t1.test2, [])
+        self.assertEqual(t2.test2, [t3])
+
+    def test_bulk_update_without_primary_key(self):
+        registry = self.init_registry(self.declare_model)
+        with self.assertRaises(SqlBaseException):
+            registry.Test.bulk_update([{'id2': 1}])
+
+    def test_bulk_update_with_orm_events(self):
+        updated = []
+
+        def add_in_registry():
+
+            @register(Model)
+            class Test:
+                id = Integer(primary_key=True)
+                name = String()
+
+                @classmethod
+                def before_update_orm_event(cls, mapper, connection, target):
+                    updated.append(target.name)
+
+        registry = self.init_registry(add_in_registry)
+        t1 = registry.Test.insert(name='t1')
+        t2 = registry.Test.insert(name='t2')
+        self.assertEqual(registry.Test.bulk_update([
+            {'id': t1.id, 'name': 'orm'}]), 1)
+        self.assertEqual(registry.Test.bulk_update([
+            {'id': t2.id, 'name': 'bulk'}], orm_events=False), 1)
+        self.assertEqual([t1.name, t2.name], ['orm', 'bulk'])
+        self.assertEqual(updated, ['orm'])
+
+    def declare_model_for_upsert(self):
+
+        @register(Model)
+        class Test:
+            id = Integer(primary_key=True)
+            code = String(unique=True, nullable=False)
+            name = String()
+            description = String(default='default')
+
+    def test_upsert(self):
+        registry = self.init_registry(self.declare_model_for_upsert)
+        t1 = registry.Test.insert(code='t1', name='t1')
+        registry.Test.insert(code='t2', name='t2')
+        count, res = self.count_queries(
+            registry, lambda: registry.Test.upsert([
+                {'id': t1.id, 'code': 't1', 'name': 'new t1'},
+                {'id': 10, 'code': 't10', 'name': 't10'},
+            ]))
+        self.assertEqual(count, 1)
+        self.assertEqual(res, [{'id': t1.id}, {'id': 10}])
+        self.assertEqual(t1.name, 'new t1')
+        tests = registry.Test.query().order_by(registry.Test.id).all()
+        self.assertEqual(tests.name, ['new t1', 't2', 't10'])
+        self.assertEqual(tests.description, ['default'] * 3)
+
+    def test_upsert_apply_onupdate(self):
+
+        def add_in_registry():
+
+            @register(Model)
+            class Test:
+                id = Integer(primary_key=True)
+                code = String(unique=True, nullable=False)
+                name = String()
+                version = Integer(default=0, onupdate=1)
+
+        registry = self.init_registry(add_in_registry)
+        t1 = registry.Test.insert(code='t1', name='t1')
+        registry.Test.upsert([{'code': 't1', 'name': 'new t1'},
+                              {'code': 't2', 'name': 't2'}],
+                             conflict_fields=['code'])
+        tests = registry.Test.query().order_by(registry.Test.id).all()
+        self.assertEqual(tests.name, ['new t1', 't2'])
+        self.assertEqual(tests.version, [1, 0])
+        self.assertIs(tests[0], t1)
+
+    def test_upsert_does_not_draw_sequence_for_updated_entries(self):
+
+        def add_in_registry():
+
+            @register(Model)
+            class Test:
+                id = Integer(primary_key=True)
+                code = String(unique=True, nullable=False)
+                name = String()
+                number = Sequence()
+
+        registry = self.init_registry(add_in_registry)
+        t1 = registry.Test.insert(code='t1', name='t1')
+        res = registry.Test.upsert([{'code': 't1', 'name': 'new t1'},
+                                    {'code': 't2', 'name': 't2'}],
+                                   conflict_fields=['code'])
+        self.assertEqual(res[0], {'id': t1.id})
+        t2 = registry.Test.from_primary_keys(**res[1])
+        self.assertEqual(t1.name, 'new t1')
+        self.assertEqual(int(t2.number), int(t1.number) + 1)
+
+    def test_upsert_group_the_rows_by_columns(self):
+        registry = self.init_registry(self.declare_model_for_upsert)
+        count, res = self.count_queries(
+            registry, lambda: registry.Test.upsert([
+                {'id': 1, 'code': 't1', 'name': 't1'},
+                {'id': 2, 'code': 't2'},
+                {'id': 3, 'code': 't3', 'name': 't3'},
+            ]))
+        self.assertEqual(count, 2)
+        self.assertEqual(res, [{'id': 1}, {'id': 2}, {'id': 3}])
+
+    def test_group_bulk_rows(self):
+        registry = self.init_registry(self.declare_model)
+        self.assertEqual(
+            registry.Test.group_bulk_rows(
+                [{'id2': 1}, {'id': 2, 'id2': 2}, {'id2': 3}]),
+            [([0, 2], [{'id2': 1}, {'id2': 3}]),
+             ([1], [{'id': 2, 'id2': 2}])])
+
+    def test_upsert_with_conflict_fields(self):
+        registry = self.init_registry(self.declare_model_for_upsert)
+        t1 = registry.Test.insert(code='t1', name='t1', description='t1')
+        res = registry.Test.upsert([
+            {'code': 't1', 'name': 'new t1', 'description': 'new t1'},
+            {'code': 't2', 'name': 't2'},
+        ], conflict_fields=['code'], update_fields=['name'],
+            return_instances=True)
+        self.assertIs(res[0], t1)
+        self.assertEqual(res.name, ['new t1', 't2'])
+        self.assertEqual(res.description, ['t1', 'default'])
+
+    def test_upsert_by_query(self):
+        registry = self.init_registry(self.declare_model_for_upsert)
+        t1 = registry.Test.insert(code='t1', name='t1', description='t1')
+        count, res = self.count_queries(
+            registry, lambda: registry.Test.upsert_by_query([
+                {'code': 't1', 'name': 'new t1', 'description': 'new t1'},
+                {'code': 't2', 'name': 't2'},
+            ], ['code'], ['name'], 1000, True))
+        # the existing entries, the update and the insert
+        self.assertEqual(count, 3)
+        self.assertEqual(res[0], {'id': t1.id})
+        tests = registry.Test.query().order_by(registry.Test.id).all()
+        self.assertEqual(tests.name, ['new t1', 't2'])
+        self.assertEqual(tests.description, ['t1', 'default'])
+
+    def test_upsert_without_conflict_fields(self):
+        registry = self.init_registry(self.declare_model_for_upsert)
+        with self.assertRaises(SqlBaseException):
+            registry.Test.upsert_by_query(
+                [{'name': 't1'}], ['code'], None, 1000, True)
+
+    def test_bulk_delete_by_primary_keys(self):
+        registry = self.init_registry(self.declare_model_for_bulk_insert)
+        pks = registry.Test.bulk_insert([{'id2': x} for x in range(4)])
+        t0 = registry.Test.from_primary_keys(**pks[0])
+        count, res = self.count_queries(
+            registry, lambda: registry.Test.bulk_delete(
+                [pks[0], pks[2], pks[0]], return_primary_keys=True))
+        self.assertEqual(count, 1)
+        self.assertEqual(res, [pks[0], pks[2]])
+        self.assertNotIn(t0, registry.session)
+        self.assertEqual(
+            registry.Test.query().order_by(registry.Test.id).all().id2,
+            [1, 3])
+
+    def test_bulk_delete_by_query(self):
+        registry = self.init_registry(self.declare_model_for_bulk_insert)
+        registry.Test.bulk_insert([{'id2': x} for x in range(4)])
+        query = registry.Test.query().filter(registry.Test.id2 >= 2)
+        count, res = self.count_queries(
+            registry, lambda: registry.Test.bulk_delete(query))
+        self.assertEqual(count, 1)
+        self.assertEqual(res, 2)
+        self.assertEqual(
+            registry.Test.query().order_by(registry.Test.id).all().id2,
+            [0, 1])
+
+    def test_bulk_delete_many2one(self):
+        registry = self.init_registry(self.add_in_registry_m2o)
+        t1 = registry.Test.insert(name='t1')
+        t2 = registry.Test2.insert(name='t2', test=t1)
+        t3 = registry.Test2.insert(name='t3', test=t1)
+        self.assertEqual(t1.test2, [t2, t3])
+        registry.Test2.bulk_delete([t2.to_primary_keys()])
+        self.assertEqual(t1.test2, [t3])
+
+    def test_bulk_delete_without_returning(self):
+        registry = self.init_registry(self.declare_model_for_bulk_insert)
+        pks = registry.Test.bulk_insert([{'id2': x} for x in range(4)])
+        dialect = registry.engine.dialect
+        self.addCleanup(setattr, dialect, 'implicit_returning',
+                        dialect.implicit_returning)
+        dialect.implicit_returning = False
+        query = registry.Test.query().filter(registry.Test.id2 >= 2)
+        count, res = self.count_queries(
+            registry, lambda: registry.Test.bulk_delete(
+                query, return_primary_keys=True))
+        self.assertEqual(count, 2)
+        self.assertEqual(sorted(x['id'] for x in res),
+                         [pks[2]['id'], pks[3]['id']])
+        self.assertEqual(
+            registry.Test.query().order_by(registry.Test.id).all().id2,
+            [0, 1])
+
+    def test_bulk_delete_does_not_load_the_relationships(self):
+        registry = self.init_registry(self.add_in_registry_m2o)
+        t1 = registry.Test.insert(name='t1')
+        registry.Test2.multi_insert(
+            *[dict(name='t%d' % x, test=t1) for x in range(3)])
+        registry.expire_all()
+        tests2 = registry.Test2.query().all()
+        count, res = self.count_queries(
+            registry, lambda: registry.Test2.bulk_delete(
+                [x.to_primary_keys() for x in tests2]))
+        self.assertEqual(count, 1)
+        self.assertEqual(res, 3)
+
+    def test_bulk_delete_with_orm_events(self):
+        deleted = []
+
+        def add_in_registry():
+
+            @register(Model)
+            class Test:
+                id = Integer(primary_key=True)
+                name = String()
+
+                @classmethod
+                def before_delete_orm_event(cls, mapper, connection, target):
+                    deleted.append(target.name)
+
+        registry = self.init_registry(add_in_registry)
+        t1 = registry.Test.insert(name='t1')
+        t2 = registry.Test.insert(name='t2')
+        self.assertEqual(
+            registry.Test.bulk_delete([t1.to_primary_keys()]), 1)
+        self.assertEqual(
+            registry.Test.bulk_delete([t2.to_primary_keys()],
+                                      orm_events=False), 1)
+        self.assertEqual(deleted, ['t1'])
+        self.assertEqual(registry.Test.query().count(), 0)
+
     def add_in_registry_m2o(self):
 
         @register(Model)
@@ -350,6 +828,81 @@ class TestCoreSQLBase(DBTestCase):
         with self.assertRaises(SqlBaseException):
             t2.to_dict('name', ())
 
+    def test_to_dict_plan_is_compiled_one_time(self):
+        registry = self.init_registry(self.add_in_registry_m2o)
+        plan = registry.Test2.get_to_dict_plan(('name', ('test', ('name',))))
+        self.assertEqual(plan, (('name', None, None),
+                                ('test', ('name',), False)))
+        self.assertIs(
+            registry.Test2.get_to_dict_plan(('name', ('test', ('name',)))),
+            plan)
+
+    def test_to_dict_with_list(self):
+        registry = self.init_registry(self.add_in_registry_m2o)
+        t1 = registry.Test.insert(name='t1')
+        t2 = registry.Test2.insert(name='t2', test=t1)
+        self.assertEqual(t2.to_dict('name', ['test', ['name']]),
+                         {'name': 't2', 'test': {'name': 't1'}})
+
+    def test_to_dicts(self):
+        registry = self.init_registry(self.add_in_registry_m2o)
+        t1 = registry.Test.insert(name='t1')
+        registry.Test2.multi_insert(
+            *[{'name': 't%d' % x, 'test': t1} for x in range(10)])
+        tests = registry.Test2.query().all()
+        fields = ('name', ('test', ('name', ('test2', ('name',)))))
+        self.assertEqual(tests.to_dicts(*fields),
+                         [x.to_dict(*fields) for x in tests])
+
+    def test_to_dicts_without_query_for_the_primary_keys(self):
+        registry = self.init_registry(self.add_in_registry_m2o)
+        t1 = registry.Test.insert(name='t1')
+        registry.Test2.multi_insert(
+            *[{'name': 't%d' % x, 'test': t1} for x in range(10)])
+        tests = registry.Test2.query().order_by(registry.Test2.id).all()
+        tests.to_dicts('name', 'test')
+        count, res = self.count_queries(
+            registry, lambda: tests.to_dicts('name', 'test'))
+        self.assertEqual(count, 0)
+        self.assertEqual(res[0], {'name': 't0', 'test': {'id': t1.id}})
+
+    def test_to_dicts_load_the_relationships_by_level(self):
+        registry = self.init_registry(self.add_in_registry_m2o)
+        for x in range(3):
+            t1 = registry.Test.insert(name='t%d' % x)
+            registry.Test2.multi_insert(
+                *[{'name': 't%d-%d' % (x, y), 'test': t1} for y in range(3)])
+
+        registry.expire_all()
+        tests = registry.Test2.query().order_by(registry.Test2.id).all()
+        fields = ('name', ('test', ('name', ('test2', ('name',)))))
+        count, res = self.count_queries(
+            registry, lambda: tests.to_dicts(*fields))
+        # one query for the Many2One and one for the One2Many
+        self.assertEqual(count, 2)
+        self.assertEqual(res[0], {
+            'name': 't0-0',
+            'test': {'name': 't0', 'test2': [
+                {'name': 't0-0'}, {'name': 't0-1'}, {'name': 't0-2'}]}})
+        self.assertEqual(res, [x.to_dict(*fields) for x in tests])
+
+    def test_to_dicts_load_many2many(self):
+        registry = self.init_registry(self.add_in_registry_m2m)
+        t2 = registry.Test2.insert(name='t2')
+        tests = registry.Test.multi_insert(
+            *[{'name': 't%d' % x} for x in range(3)])
+        for test in tests:
+            test.test2.append(t2)
+
+        registry.flush()
+        registry.expire_all()
+        tests = registry.Test.query().order_by(registry.Test.id).all()
+        count, res = self.count_queries(
+            registry, lambda: tests.to_dicts('name', ('test2', ('name',))))
+        self.assertEqual(count, 1)
+        self.assertEqual(res, [{'name': 't%d' % x, 'test2': [{'name': 't2'}]}
+                               for x in range(3)])
+
     def test_refresh_update_m2o(self):
         registry = self.init_registry(self.add_in_registry_m2o)
         t1 = registry.Test.insert(name='t1')
@@ -8,7 +8,16 @@
 from anyblok.tests.testcase import TestCase
 from anyblok.environment import (EnvironmentManager,
                                  ThreadEnvironment,
+                                 ContextEnvironment,
                                  EnvironmentException)
+from threading import get_ident
+from unittest import skipIf
+import sys
+try:
+    from contextvars import copy_context
+except ImportError:
+    # contextvars is only in python >= 3.7
+    copy_context = None
 
 
 class MockEnvironment:
@@ -164,3 +173,38 @@ class TestThreadEnvironment(TestCase):
     def test_scoped_function_session(self):
         self.assertEqual(EnvironmentManager.scoped_function_for_session(),
                          None)
+
+
+@skipIf(sys.version_info < (3, 7), "contextvars needs python >= 3.7")
+class TestContextEnvironment(TestCase):
+
+    def setUp(self):
+        super(TestContextEnvironment, self).setUp()
+        EnvironmentManager.define_environment_cls(ContextEnvironment)
+
+    def tearDown(self):
+        super(TestContextEnvironment, self).tearDown()
+        EnvironmentManager.define_environment_cls(ThreadEnvironment)
+
+    def test_scoped_function_session_without_scope(self):
+        self.assertEqual(EnvironmentManager.scoped_function_for_session()(),
+                         get_ident())
+
+    def test_set_and_get_variable_by_scope(self):
+        EnvironmentManager.set('db_name', 'thread db name')
+
+        def in_new_scope():
+            scope = ContextEnvironment.new_scope()
+            self.assertEqual(
+                EnvironmentManager.scoped_function_for_session()(), scope)
+            self.assertIsNone(EnvironmentManager.get('db_name'))
+            EnvironmentManager.set('db_name', 'scope db name')
+            self.assertEqual(EnvironmentManager.get('db_name'),
+                             'scope db name')
+            return scope
+
+        scope = copy_context().run(in_new_scope)
+        self.assertEqual(EnvironmentManager.get('db_name'), 'thread db name')
+        self.assertIn(scope, ContextEnvironment.values)
+        ContextEnvironment.release_scope(scope)
+        self.assertNotIn(scope, ContextEnvironment.values)
@@ -7,12 +7,15 @@
 # v. 2.0. If a copy of the MPL was not distributed with this file,You can
 # obtain one at http://mozilla.org/MPL/2.0/.
 from anyblok.tests.testcase import TestCase, DBTestCase, LogCapture
-from anyblok.registry import RegistryManager
-from anyblok.config import Configuration
+from anyblok.registry import RegistryManager, Registry, RegistryException
+from anyblok.config import Configuration, get_url
 from anyblok.blok import BlokManager, Blok
+from anyblok.metrics import SQLProfiler
 from anyblok.column import Integer
 from threading import Thread
-from logging import ERROR
+from sqlalchemy import create_engine, select
+from logging import ERROR, INFO
+import os
 
 
 class Test:
@@ -153,6 +156,63 @@ class TestRegistry(DBTestCase):
         registry.add_in_registry('Declarations.Test', Test)
         self.check_added_in_regisry(registry)
 
+    def test_session_of_the_current_scope(self):
+        registry = self.init_registry(None)
+        self.assertIs(registry.session, registry.Session())
+
+    def test_session_proxy(self):
+        registry = self.init_registry(None)
+        Blok = registry.System.Blok
+        query = registry.query(Blok)
+        self.assertIsInstance(query, registry.session._query_cls)
+        blok = Blok(name='test-proxy', version='0.0.0')
+        registry.add(blok)
+        self.assertIn(blok, registry.session)
+        registry.expunge(blok)
+        self.assertNotIn(blok, registry.session)
+
+    def test_registry_fingerprint(self):
+        with DBTestCase.Configuration(registry_fingerprint=True):
+            registry = self.init_registry(None)
+            self.assertFalse(registry.fingerprint_unchanged)
+            Parameter = registry.System.Parameter
+            self.assertEqual(Parameter.get(registry.fingerprint_key),
+                             registry.get_fingerprint())
+            registry.reload()
+            self.assertTrue(registry.fingerprint_unchanged)
+
+    def test_registry_fingerprint_changed(self):
+        with DBTestCase.Configuration(registry_fingerprint=True):
+            registry = self.init_registry(None)
+            Parameter = registry.System.Parameter
+            Parameter.set(registry.fingerprint_key, 'other fingerprint')
+            registry.reload()
+            self.assertFalse(registry.fingerprint_unchanged)
+            self.assertEqual(Parameter.get(registry.fingerprint_key),
+                             registry.get_fingerprint())
+
+    def test_registry_fingerprint_read_the_database(self):
+        registry = self.init_registry(None)
+        fingerprint = registry.get_fingerprint()
+        self.assertEqual(registry.get_fingerprint(), fingerprint)
+        registry.execute(
+            "ALTER TABLE system_parameter ADD COLUMN other integer")
+        self.assertNotEqual(registry.get_fingerprint(), fingerprint)
+
+    def test_registry_without_fingerprint(self):
+        registry = self.init_registry(None)
+        registry.reload()
+        self.assertFalse(registry.fingerprint_unchanged)
+        self.assertFalse(registry.System.Parameter.is_exist(
+            registry.fingerprint_key))
+
+    def test_no_replica_in_unittest_mode(self):
+        url = str(Configuration.get('get_url', get_url)())
+        with DBTestCase.Configuration(db_ro_urls=[url]):
+            registry = self.init_registry(None)
+
+        self.assertEqual(registry.ro_engines, [])
+
     def test_registry_db_exist(self):
         self.assertTrue(Configuration.get('Registry').db_exists(
             db_name=Configuration.get('db_name')))
@@ -640,3 +700,271 @@ class TestRegistry2(DBTestCase):
             messages = logs.get_error_messages()
             message = messages[0]
             self.assertIn('Here one exception', message)
+
+
+class TestRegistryFork(DBTestCase):
+
+    @classmethod
+    def additional_setting(cls):
+        return dict()
+
+    def test_before_fork_with_unittest_registry(self):
+        with self.assertRaises(RegistryException):
+            Registry.before_fork(
+                type('Registry', (), {'unittest': True})())
+
+    def test_after_fork(self):
+        called = []
+
+        def callback(registry):
+            called.append(registry)
+
+        registry = self.init_registry(None)
+        RegistryManager.declare_post_fork_callback(callback)
+        self.addCleanup(RegistryManager.undeclare_post_fork_callback,
+                        callback)
+        RegistryManager.before_fork()
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover
+            status = 1
+            try:
+                RegistryManager.after_fork()
+                if called == [registry]:
+                    if registry.execute('SELECT 1').fetchone() == (1,):
+                        status = 0
+            finally:
+                os._exit(status)
+
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+        self.assertEqual(called, [])
+        self.assertEqual(registry.execute('SELECT 1').fetchone(), (1,))
+
+
+class TestRegistryReadReplica(DBTestCase):
+
+    @classmethod
+    def additional_setting(cls):
+        return dict()
+
+    def init_registry_with_replica(self):
+        # the primary database is also used as replica
+        url = str(Configuration.get('get_url', get_url)())
+        with DBTestCase.Configuration(db_ro_urls=[url]):
+            registry = self.init_registry(None)
+
+        # the replica can only see the committed tables
+        registry.commit()
+        return registry
+
+    def get_engine(self, registry, clause):
+        return registry.session.get_bind(clause=clause)
+
+    def test_without_replica(self):
+        registry = self.init_registry(None)
+        self.assertEqual(registry.ro_engines, [])
+        self.assertIsNone(registry.get_ro_engine())
+        self.assertIs(self.get_engine(registry, select([1])), registry.engine)
+
+    def test_read_on_replica(self):
+        registry = self.init_registry_with_replica()
+        self.assertEqual(len(registry.ro_engines), 1)
+        ro_engine = registry.ro_engines[0]
+        self.assertIs(self.get_engine(registry, select([1])), ro_engine)
+        Blok = registry.System.Blok
+        self.assertEqual(Blok.query().get('anyblok-core').state, 'installed')
+        self.assertIn(ro_engine, registry.session.transaction._connections)
+        self.assertIsNot(registry.session.connection().engine, ro_engine)
+
+    def test_connection_does_not_leave_the_replica(self):
+        registry = self.init_registry_with_replica()
+        ro_engine = registry.ro_engines[0]
+        self.assertIs(self.get_engine(registry, None), registry.engine)
+        self.assertIs(self.get_engine(registry, select([1])), ro_engine)
+
+    def test_cached_query_on_replica(self):
+        registry = self.init_registry_with_replica()
+        ro_engine = registry.ro_engines[0]
+        Blok = registry.System.Blok
+        query = Blok.query('state').filter_by(name='anyblok-core').cached()
+        self.assertEqual(query.all(), [('installed',)])
+        self.assertEqual(query.all(), [('installed',)])
+        self.assertIn(ro_engine, registry.session.transaction._connections)
+        self.assertIs(self.get_engine(registry, select([1])), ro_engine)
+
+    def test_select_for_update_on_primary(self):
+        registry = self.init_registry_with_replica()
+        query = select([1]).with_for_update()
+        self.assertIs(self.get_engine(registry, query), registry.engine)
+
+    def test_stay_on_primary_after_write(self):
+        registry = self.init_registry_with_replica()
+        ro_engine = registry.ro_engines[0]
+        registry.System.Parameter.insert(key='test-replica',
+                                         value={'value': 1})
+        self.assertIs(self.get_engine(registry, select([1])), registry.engine)
+        self.assertEqual(registry.System.Parameter.get('test-replica'), 1)
+        registry.rollback()
+        self.assertIs(self.get_engine(registry, select([1])), ro_engine)
+
+    def test_pin_primary(self):
+        registry = self.init_registry_with_replica()
+        ro_engine = registry.ro_engines[0]
+        with registry.pin_primary():
+            self.assertIs(self.get_engine(registry, select([1])),
+                          registry.engine)
+
+        self.assertIs(self.get_engine(registry, select([1])), ro_engine)
+
+    def test_replicas_used_in_turn(self):
+        registry = self.init_registry_with_replica()
+        ro_engine = registry.ro_engines[0]
+        other_ro_engine = create_engine(ro_engine.url)
+        registry.ro_engines.append(other_ro_engine)
+        engines = [self.get_engine(registry, select([1]))]
+        registry.rollback()
+        engines.append(self.get_engine(registry, select([1])))
+        self.assertEqual(set(engines), {ro_engine, other_ro_engine})
+
+
+class TestRegistryPoolMetrics(DBTestCase):
+
+    @classmethod
+    def additional_setting(cls):
+        return dict()
+
+    def init_registry_with_metrics(self, **kwargs):
+        with DBTestCase.Configuration(db_pool_metrics=True, **kwargs):
+            return self.init_registry(None)
+
+    def test_without_metrics(self):
+        registry = self.init_registry(None)
+        self.assertEqual(registry.pool_statistics(), {})
+
+    def test_pool_statistics(self):
+        registry = self.init_registry_with_metrics()
+        statistics = registry.pool_statistics()
+        self.assertEqual(list(statistics.keys()), ['primary'])
+        statistics = statistics['primary']
+        self.assertEqual(statistics['size'], 5)
+        self.assertEqual(statistics['checkedout'], 1)
+        self.assertGreater(statistics['connect'], 0)
+        self.assertEqual(statistics['timeout'], 0)
+        self.assertGreater(statistics['checkout'], 0)
+        self.assertEqual(
+            sum(x[1] for x in statistics['checkout_time_histogram']),
+            statistics['checkout'])
+        self.assertIsNone(statistics['checkout_time_histogram'][-1][0])
+
+    def test_pool_statistics_invalidate(self):
+        registry = self.init_registry_with_metrics()
+        registry.reset_pool_statistics()
+        connection = registry.engine.connect()
+        connection.invalidate()
+        connection.close()
+        statistics = registry.pool_statistics()['primary']
+        self.assertEqual(statistics['checkout'], 1)
+        self.assertEqual(statistics['invalidate'], 1)
+        self.assertEqual(statistics['close'], 1)
+        self.assertGreater(statistics['lifetime_max'], 0)
+
+    def test_pool_statistics_in_log(self):
+        registry = self.init_registry_with_metrics(
+            db_pool_metrics_log_interval=60)
+        metrics = registry.engines_metrics['primary']
+        metrics.last_log = 0
+        with LogCapture('anyblok.metrics', level=INFO) as logs:
+            registry.engine.connect().close()
+            registry.engine.connect().close()
+            messages = logs.get_info_messages()
+
+        self.assertEqual(len(messages), 1)
+        self.assertIn("Pool statistics of 'primary'", messages[0])
+
+
+def add_model_to_profile():
+
+    from anyblok import Declarations
+
+    @Declarations.register(Declarations.Model)
+    class Test:
+
+        id = Integer(primary_key=True)
+
+        @classmethod
+        def count_all(cls):
+            return cls.query().count()
+
+
+class TestRegistrySQLProfiler(DBTestCase):
+
+    def test_profile_sql(self):
+        registry = self.init_registry(add_model_to_profile)
+        with registry.profile_sql(slowest=2) as profiler:
+            for i in range(3):
+                registry.Test.count_all()
+
+            registry.execute('SELECT 1')
+
+        report = profiler.get_report()
+        self.assertEqual(report['count'], 4)
+        self.assertEqual(report['rows'], 4)
+        methods = {(x['namespace'], x['method']): x['count']
+                   for x in report['methods']}
+        self.assertEqual(methods, {('Model.Test', 'count_all'): 3,
+                                   (None, None): 1})
+        self.assertEqual(len(report['slowest']), 2)
+        self.assertEqual(len(report['repeated']), 1)
+        self.assertEqual(report['repeated'][0]['count'], 3)
+        self.assertEqual(report['repeated'][0]['namespace'], 'Model.Test')
+
+    def test_profile_sql_only_in_context(self):
+        registry = self.init_registry(add_model_to_profile)
+        with registry.profile_sql() as profiler:
+            pass
+
+        registry.Test.count_all()
+        self.assertEqual(profiler.get_report()['count'], 0)
+
+    def test_profile_sql_only_current_thread(self):
+        registry = self.init_registry(add_model_to_profile)
+
+        def execute():
+            conn = registry.engine.connect()
+            conn.execute('SELECT 1')
+            conn.close()
+
+        with registry.profile_sql() as profiler:
+            thread = Thread(target=execute)
+            thread.start()
+            thread.join()
+
+        self.assertEqual(profiler.get_report()['count'], 0)
+
+    def test_without_sql_profiler(self):
+        registry = self.init_registry(None)
+        self.assertIsNone(registry.sql_profiler)
+
+    def test_sql_profiler(self):
+        with DBTestCase.Configuration(db_sql_profiler=True):
+            registry = self.init_registry(add_model_to_profile)
+
+        registry.sql_profiler.reset()
+        registry.Test.count_all()
+        report = registry.sql_profiler.get_report()
+        self.assertEqual(report['count'], 1)
+        self.assertEqual(report['methods'][0]['method'], 'count_all')
+        self.assertEqual(report['slowest'][0]['rows'], 1)
+
+    def test_sql_profiler_max_statements(self):
+        profiler = SQLProfiler(max_statements=2)
+        for statement in ('SELECT 1', 'SELECT 2', 'SELECT 1', 'SELECT 3'):
+            profiler.add_statement('Model.Test', 'test', statement, (),
+                                   0.1, 1)
+
+        self.assertEqual(profiler.count, 4)
+        self.assertEqual(
+            list(profiler.statements),
+            [('Model.Test', 'test', 'SELECT 1'),
+             ('Model.Test', 'test', 'SELECT 3')])
+        self.assertEqual(len(profiler.get_report()['repeated']), 1)
@@ -11,6 +11,8 @@ from anyblok.registry import RegistryManager
 from anyblok.blok import BlokManager
 from anyblok.model import Model
 from anyblok.environment import EnvironmentManager
+from threading import Thread
+from time import sleep
 
 
 class TestRegistryManager(TestCase):
@@ -164,3 +166,120 @@ class TestRegistryManager(TestCase):
                              False)
         finally:
             EnvironmentManager.set('current_blok', oldblok)
+
+
+class MockRegistry:
+
+    loaded = []
+
+    def __init__(self, db_name, loadwithoutmigration=False, **kwargs):
+        self.db_name = db_name
+        self.closed = False
+        self.in_use = False
+        sleep(0.05)
+        self.loaded.append(db_name)
+
+    def is_in_use(self):
+        return self.in_use
+
+    def close(self):
+        self.closed = True
+        with RegistryManager.registries_lock:
+            if RegistryManager.registries.get(self.db_name) is self:
+                del RegistryManager.registries[self.db_name]
+
+
+class TestRegistryManagerPool(TestCase):
+
+    def setUp(self):
+        super(TestRegistryManagerPool, self).setUp()
+        MockRegistry.loaded = []
+        RegistryManager.reset_statistics()
+
+    def tearDown(self):
+        RegistryManager.clear()
+        RegistryManager.reset_statistics()
+        super(TestRegistryManagerPool, self).tearDown()
+
+    def test_get_without_max_size(self):
+        with TestCase.Configuration(Registry=MockRegistry,
+                                    registries_max_size=None):
+            registries = [RegistryManager.get('db%d' % i) for i in range(3)]
+            self.assertIs(RegistryManager.get('db0'), registries[0])
+
+        self.assertEqual(MockRegistry.loaded, ['db0', 'db1', 'db2'])
+        self.assertFalse(any(registry.closed for registry in registries))
+        self.assertEqual(RegistryManager.get_statistics(), dict(
+            size=3, max_size=None, hit=1, miss=3, eviction=0))
+
+    def test_evict_the_least_recently_used(self):
+        with TestCase.Configuration(Registry=MockRegistry,
+                                    registries_max_size=2):
+            db0 = RegistryManager.get('db0')
+            db1 = RegistryManager.get('db1')
+            RegistryManager.get('db0')
+            db2 = RegistryManager.get('db2')
+            self.assertEqual(list(RegistryManager.registries), ['db0', 'db2'])
+            self.assertTrue(db1.closed)
+            self.assertFalse(db0.closed)
+            self.assertFalse(db2.closed)
+            self.assertIsNot(RegistryManager.get('db1'), db1)
+            self.assertTrue(db0.closed)
+            self.assertEqual(RegistryManager.get_statistics(), dict(
+                size=2, max_size=2, hit=1, miss=4, eviction=2))
+
+    def test_close_the_evicted_registry_once_released(self):
+        with TestCase.Configuration(Registry=MockRegistry,
+                                    registries_max_size=1):
+            db0 = RegistryManager.get('db0')
+            db0.in_use = True
+            RegistryManager.get('db1')
+            self.assertEqual(list(RegistryManager.registries), ['db1'])
+            self.assertFalse(db0.closed)
+            self.assertEqual(RegistryManager.evicted_registries, [db0])
+            db0.in_use = False
+            RegistryManager.get('db2')
+            self.assertTrue(db0.closed)
+            self.assertEqual(RegistryManager.evicted_registries, [])
+
+    def test_load_only_once_by_concurrent_threads(self):
+        registries = []
+
+        def get():
+            registries.append(RegistryManager.get('db0'))
+
+        with TestCase.Configuration(Registry=MockRegistry):
+            threads = [Thread(target=get) for i in range(5)]
+            for thread in threads:
+                thread.start()
+
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(MockRegistry.loaded, ['db0'])
+        self.assertEqual(len(set(registries)), 1)
+        statistics = RegistryManager.get_statistics()
+        self.assertEqual(statistics['miss'], 1)
+        self.assertEqual(statistics['hit'], 4)
+
+    def test_loading_locks_are_forgotten(self):
+        with TestCase.Configuration(Registry=MockRegistry,
+                                    registries_max_size=1):
+            for i in range(3):
+                RegistryManager.get('db%d' % i)
+
+        self.assertEqual(len(RegistryManager.registries_loading_locks), 0)
+
+    def test_loading_lock_shared_while_referenced(self):
+        lock = RegistryManager.get_loading_lock('db0')
+        self.assertIs(RegistryManager.get_loading_lock('db0'), lock)
+        self.assertIsNot(RegistryManager.get_loading_lock('db1'), lock)
+
+    def test_get_registries_is_a_snapshot(self):
+        with TestCase.Configuration(Registry=MockRegistry):
+            db0 = RegistryManager.get('db0')
+            registries = RegistryManager.get_registries()
+            db1 = RegistryManager.get('db1')
+
+        self.assertEqual(registries, [db0])
+        self.assertEqual(RegistryManager.get_registries(), [db0, db1])
@@ -0,0 +1,184 @@
+# This file is a part of the AnyBlok project
+#
+#    Copyright (C) 2018 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+import os
+from tempfile import TemporaryDirectory
+from anyblok.tests.testcase import TestCase, DBTestCase
+from anyblok.declarations import Declarations, classmethod_cache
+from anyblok.shared_cache import SharedMemoryStore, SharedCacheException
+
+
+class TestSharedMemoryStore(TestCase):
+
+    def setUp(self):
+        super(TestSharedMemoryStore, self).setUp()
+        self.directory = TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'cache')
+        self.stores = []
+
+    def tearDown(self):
+        for store in self.stores:
+            store.close()
+
+        self.directory.cleanup()
+        super(TestSharedMemoryStore, self).tearDown()
+
+    def get_store(self, **kwargs):
+        kwargs.setdefault('slots', 16)
+        kwargs.setdefault('slot_size', 128)
+        store = SharedMemoryStore(self.path, **kwargs)
+        self.stores.append(store)
+        return store
+
+    def test_get_and_set(self):
+        store = self.get_store()
+        self.assertEqual(store.get(b'key'), (False, None))
+        self.assertTrue(store.set(b'key', b'value'))
+        self.assertEqual(store.get(b'key'), (True, b'value'))
+        self.assertEqual(store.get_statistics(), dict(
+            hits=1, misses=1, sets=1, slots=16, slot_size=128))
+
+    def test_too_big(self):
+        store = self.get_store()
+        self.assertFalse(store.set(b'key', b'x' * 128))
+        self.assertEqual(store.get(b'key'), (False, None))
+
+    def test_slot_too_small(self):
+        with self.assertRaises(SharedCacheException):
+            self.get_store(slot_size=10)
+
+    def test_replace_the_entry_of_the_slot(self):
+        store = self.get_store(slots=1)
+        store.set(b'key1', b'value1')
+        store.set(b'key2', b'value2')
+        self.assertEqual(store.get(b'key1'), (False, None))
+        self.assertEqual(store.get(b'key2'), (True, b'value2'))
+
+    def test_shared_by_the_stores_of_the_file(self):
+        store1 = self.get_store()
+        store2 = self.get_store()
+        store1.set(b'key', b'value')
+        self.assertEqual(store2.get(b'key'), (True, b'value'))
+        store2.clear()
+        self.assertEqual(store1.get(b'key'), (False, None))
+
+    def test_check_version(self):
+        store = self.get_store()
+        self.assertFalse(store.check_version(10))
+        store.set(b'key', b'value')
+        self.assertFalse(store.check_version(12))
+        self.assertEqual(store.get(b'key'), (True, b'value'))
+        # the database has been restored
+        self.assertTrue(store.check_version(5))
+        self.assertEqual(store.get(b'key'), (False, None))
+
+    def test_default_path_contains_the_incarnation(self):
+        self.assertNotEqual(
+            SharedMemoryStore.get_default_path('db', 'uuid1', 16, 128),
+            SharedMemoryStore.get_default_path('db', 'uuid2', 16, 128))
+
+    def test_shared_with_a_forked_process(self):
+        store = self.get_store()
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover
+            store.set(b'key', b'value')
+            os._exit(0)
+
+        os.waitpid(pid, 0)
+        self.assertEqual(store.get(b'key'), (True, b'value'))
+
+
+def add_model_with_shared_cache():
+
+    @Declarations.register(Declarations.Model)
+    class Test:
+
+        calls = 0
+
+        @classmethod_cache(shared=True)
+        def get_value(cls, value):
+            cls.calls += 1
+            return {'value': value}
+
+
+class TestSharedCache(DBTestCase):
+
+    def setUp(self):
+        super(TestSharedCache, self).setUp()
+        self.directory = TemporaryDirectory()
+
+    def tearDown(self):
+        super(TestSharedCache, self).tearDown()
+        self.directory.cleanup()
+
+    def init_registry_with_shared_cache(self):
+        path = os.path.join(self.directory.name, 'cache')
+        with DBTestCase.Configuration(cache_shared_slots=16,
+                                      cache_shared_slot_size=1024,
+                                      cache_shared_path=path):
+            return self.init_registry(add_model_with_shared_cache)
+
+    def clear_local_cache(self, registry):
+        # as in a process which has not computed the value yet
+        for cache in registry.caches['Model.Test']['get_value']:
+            cache.cache_clear()
+
+    def test_without_shared_cache(self):
+        registry = self.init_registry(add_model_with_shared_cache)
+        self.assertIsNone(registry.shared_cache)
+        registry.Test.get_value(1)
+        self.clear_local_cache(registry)
+        registry.Test.get_value(1)
+        self.assertEqual(registry.Test.calls, 2)
+
+    def test_shared_cache(self):
+        registry = self.init_registry_with_shared_cache()
+        self.assertEqual(registry.Test.get_value(1), {'value': 1})
+        self.clear_local_cache(registry)
+        self.assertEqual(registry.Test.get_value(1), {'value': 1})
+        self.assertEqual(registry.Test.calls, 1)
+        registry.Test.get_value(2)
+        self.assertEqual(registry.Test.calls, 2)
+
+    def test_invalidation(self):
+        registry = self.init_registry_with_shared_cache()
+        registry.Test.get_value(1)
+        registry.System.Cache.invalidate('Model.Test', 'get_value')
+        self.assertIn(('Model.Test', 'get_value'), registry.cache_bypass)
+        registry.Test.get_value(1)
+        self.assertEqual(registry.Test.calls, 2)
+        registry.commit()
+        self.assertNotIn(('Model.Test', 'get_value'), registry.cache_bypass)
+        version = registry.cache_versions[('Model.Test', 'get_value')]
+        self.assertEqual(version, registry.System.Cache.get_last_id())
+        # the new version is not in the shared cache yet
+        self.clear_local_cache(registry)
+        registry.Test.get_value(1)
+        self.assertEqual(registry.Test.calls, 3)
+        self.clear_local_cache(registry)
+        registry.Test.get_value(1)
+        self.assertEqual(registry.Test.calls, 3)
+
+    def test_invalidation_rolled_back(self):
+        registry = self.init_registry_with_shared_cache()
+        registry.System.Cache.invalidate('Model.Test', 'get_value')
+        self.assertIn(('Model.Test', 'get_value'), registry.cache_bypass)
+        registry.drop_cache_invalidations()
+        self.assertNotIn(('Model.Test', 'get_value'), registry.cache_bypass)
+
+    def test_incarnation(self):
+        registry = self.init_registry_with_shared_cache()
+        incarnation = registry.shared_cache_incarnation
+        self.assertIsNotNone(incarnation)
+        self.assertEqual(
+            registry.System.Cache.get_database_incarnation(), incarnation)
+
+    def test_version_of_a_method_without_invalidation(self):
+        registry = self.init_registry_with_shared_cache()
+        self.assertNotIn(('Model.Test', 'get_value'), registry.cache_versions)
+        self.assertEqual(registry.cache_version_floor,
+                         registry.System.Cache.get_last_id())
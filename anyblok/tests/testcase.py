@@ -157,7 +157,9 @@ class TestCase(unittest.TestCase):
         :param \**values: values to update
         """
         try:
-            old_configuration = Configuration.configuration.copy()
+            old_configuration = {
+                key: copy(option)
+                for key, option in Configuration.configuration.items()}
             Configuration.update(**values)
             yield
         finally:
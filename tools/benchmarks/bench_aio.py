@@ -0,0 +1,117 @@
+# This file is a part of the AnyBlok project
+#
+#    Copyright (C) 2018 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+""" Throughput of concurrent requests in an asyncio application
+
+Each request executes two queries and commits, the requests are executed
+with at most ``--concurrency`` requests in progress:
+
+* ``thread pool``: the whole request is a function executed by the
+  executor, as without ``anyblok.aio``
+* ``AsyncRegistry.run``: the whole request is a function executed by
+  ``AsyncRegistry.run``, in the scope of the task
+* ``AsyncRegistry``: each call of the request is awaited, one executor
+  round trip by call
+
+``--await-ms`` adds a non database await to each request, as a call to
+another service. Needs python >= 3.7::
+
+    python tools/benchmarks/bench_aio.py --db-name bench -- \\
+        --requests 2000 --concurrency 50 --threads 10
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from anyblok.environment import EnvironmentManager, ContextEnvironment
+from anyblok.aio import AsyncRegistry
+from common import start
+
+
+def sync_request(registry):
+    Blok = registry.System.Blok
+    Blok.query().filter_by(name='anyblok-core').count()
+    Blok.query('state').filter_by(name='anyblok-core').all()
+    registry.commit()
+
+
+async def thread_pool_request(registry, executor, await_ms):
+    loop = asyncio.get_event_loop()
+    await loop.run_in_executor(executor, sync_request, registry)
+    if await_ms:
+        await asyncio.sleep(await_ms / 1000)
+
+
+async def async_registry_run_request(async_registry, await_ms):
+    await async_registry.run(sync_request, async_registry.registry)
+    if await_ms:
+        await asyncio.sleep(await_ms / 1000)
+
+
+async def async_registry_request(async_registry, await_ms):
+    Blok = async_registry.System.Blok
+    await Blok.query().filter_by(name='anyblok-core').count()
+    await Blok.query('state').filter_by(name='anyblok-core').all()
+    if await_ms:
+        await asyncio.sleep(await_ms / 1000)
+
+    await async_registry.commit()
+
+
+def measure(loop, request, requests, concurrency):
+    """ Return the number of requests by second """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited():
+        async with semaphore:
+            await request()
+
+    async def run():
+        await asyncio.gather(*[limited() for i in range(requests)])
+
+    started = perf_counter()
+    loop.run_until_complete(run())
+    return requests / (perf_counter() - started)
+
+
+def main():
+    EnvironmentManager.define_environment_cls(ContextEnvironment)
+    registry, options = start(
+        "Throughput of concurrent requests in an asyncio application",
+        [(('--requests',), dict(type=int, default=2000,
+                                help="Number of requests")),
+         (('--concurrency',), dict(type=int, default=50,
+                                   help="Requests in progress at most")),
+         (('--threads',), dict(type=int, default=10,
+                               help="Threads of the executor")),
+         (('--await-ms',), dict(type=float, default=0,
+                                help="Non database await by request"))])
+    registry.commit()
+    executor = ThreadPoolExecutor(max_workers=options.threads)
+    async_registry = AsyncRegistry(registry, executor=executor)
+    loop = asyncio.get_event_loop()
+    modes = [
+        ('thread pool', lambda: thread_pool_request(
+            registry, executor, options.await_ms)),
+        ('AsyncRegistry.run', lambda: async_registry_run_request(
+            async_registry, options.await_ms)),
+        ('AsyncRegistry', lambda: async_registry_request(
+            async_registry, options.await_ms)),
+    ]
+    print('Requests by second (%d requests, %d concurrent, %d threads, '
+          '%s ms await)' % (options.requests, options.concurrency,
+                            options.threads, options.await_ms))
+    for label, request in modes:
+        # warm up the connections and the threads
+        measure(loop, request, options.concurrency, options.concurrency)
+        print('  %s  %8.1f' % (label.ljust(17), measure(
+            loop, request, options.requests, options.concurrency)))
+
+    executor.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+# This file is a part of the AnyBlok project
+#
+#    Copyright (C) 2018 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+""" Time to insert rows with ``multi_insert`` (before) and with
+``bulk_insert`` (after)
+
+The rows are inserted in **System.Cache** (integer primary key filled by
+the database), each insert is rolled back::
+
+    python tools/benchmarks/bench_bulk_insert.py --db-name bench -- \\
+        --rows 1000 10000 --chunk-size 1000
+"""
+from time import perf_counter
+from common import start, print_results
+
+
+def measure(registry, function, repeat):
+    """ Return the best time of the function, rolled back each time """
+    times = []
+    for i in range(repeat):
+        started = perf_counter()
+        function()
+        registry.flush()
+        times.append(perf_counter() - started)
+        registry.rollback()
+
+    return min(times)
+
+
+def main():
+    registry, options = start(
+        "Time to insert rows with multi_insert and with bulk_insert",
+        [(('--rows',), dict(type=int, nargs='+', default=[1000, 10000],
+                            help="Numbers of rows to insert")),
+         (('--chunk-size',), dict(type=int, default=1000,
+                                  help="Rows by query of bulk_insert")),
+         (('--repeat',), dict(type=int, default=3,
+                              help="Number of measures"))])
+    Cache = registry.System.Cache
+    results = []
+    for count in options.rows:
+        rows = [dict(registry_name='Model.Benchmark', method='method%d' % i)
+                for i in range(count)]
+        results.append((
+            '%d rows' % count,
+            measure(registry, lambda: Cache.multi_insert(*rows),
+                    options.repeat),
+            measure(registry, lambda: Cache.bulk_insert(
+                rows, chunk_size=options.chunk_size), options.repeat)))
+
+    print_results('Insert, multi_insert -> bulk_insert', results, unit='ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+# This file is a part of the AnyBlok project
+#
+#    Copyright (C) 2018 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+""" Startup time and memory of the workers of a prefork server
+
+``before``: each worker is a new process which loads its own registry.
+``after``: the registry is loaded by the master, the workers are forked
+with ``RegistryManager.before_fork`` and ``RegistryManager.after_fork``.
+
+A worker is ready when it has executed a query. The memory is the RSS and
+the PSS (the shared pages are divided between the processes sharing them)
+of each worker, measured while all the workers are alive (Linux only)::
+
+    python tools/benchmarks/bench_preload_fork.py --db-name bench -- \\
+        --workers 4
+"""
+import json
+import os
+import subprocess
+import sys
+from time import time
+from anyblok.registry import RegistryManager
+from common import start, print_results
+
+
+def get_memory():
+    """ Return the RSS and the PSS of the current process, in bytes """
+    memory = {}
+    try:
+        with open('/proc/self/smaps_rollup') as smaps:
+            for line in smaps:
+                key, value = line.split(':', 1)
+                if key in ('Rss', 'Pss'):
+                    memory[key.lower()] = int(value.split()[0]) * 1024
+    except OSError:  # pragma: no cover
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    memory['rss'] = memory['pss'] = int(
+                        line.split()[1]) * 1024
+
+    return memory
+
+
+def report_and_wait(registry, started, output, wait):
+    """ Write the measures of the worker then wait the end of the
+    benchmark, so the pages stay shared with the other workers
+    """
+    registry.execute('SELECT 1')
+    result = dict(ready=time() - started, **get_memory())
+    output.write(json.dumps(result) + '\n')
+    output.flush()
+    wait()
+
+
+def cold_workers(argv, count):
+    """ Start workers which load their own registry """
+    anyblok_argv = argv[1:argv.index('--')] if '--' in argv else argv[1:]
+    workers = []
+    for i in range(count):
+        command = [sys.executable, argv[0]] + anyblok_argv + [
+            '--', '--cold-worker', '--started', repr(time())]
+        workers.append(subprocess.Popen(
+            command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            universal_newlines=True))
+
+    results = [json.loads(worker.stdout.readline()) for worker in workers]
+    for worker in workers:
+        worker.stdin.close()
+        worker.wait()
+
+    return results
+
+
+def preloaded_workers(registry, count):
+    """ Fork workers which share the registry of this process """
+    RegistryManager.before_fork()
+    release_read, release_write = os.pipe()
+    workers = []
+    for i in range(count):
+        result_read, result_write = os.pipe()
+        started = time()
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover
+            os.close(release_write)
+            os.close(result_read)
+            try:
+                RegistryManager.after_fork()
+                report_and_wait(
+                    registry, started, os.fdopen(result_write, 'w'),
+                    lambda: os.read(release_read, 1))
+            finally:
+                os._exit(0)
+
+        os.close(result_write)
+        workers.append((pid, os.fdopen(result_read)))
+
+    os.close(release_read)
+    results = [json.loads(output.readline()) for pid, output in workers]
+    os.close(release_write)
+    for pid, output in workers:
+        output.close()
+        os.waitpid(pid, 0)
+
+    return results
+
+
+def average(results, key):
+    return sum(x[key] for x in results) / len(results)
+
+
+def main():
+    argv = list(sys.argv)
+    registry, options = start(
+        "Startup time and memory of the workers of a prefork server",
+        [(('--workers',), dict(type=int, default=4,
+                               help="Number of workers")),
+         (('--cold-worker',), dict(action='store_true',
+                                   help="Internal, run as a cold worker")),
+         (('--started',), dict(type=float, help="Internal"))])
+    if options.cold_worker:
+        report_and_wait(registry, options.started, sys.stdout,
+                        sys.stdin.read)
+        return
+
+    registry.commit()
+    cold = cold_workers(argv, options.workers)
+    preloaded = preloaded_workers(registry, options.workers)
+    print_results('Worker ready (%d workers), own registry -> preloaded' %
+                  options.workers,
+                  [('ready', average(cold, 'ready'),
+                    average(preloaded, 'ready'))], unit='ms')
+    results = [(key, average(cold, key), average(preloaded, key))
+               for key in ('rss', 'pss')]
+    print('Memory by worker (MiB), own registry -> preloaded')
+    for key, before, after in results:
+        print('  %s  %8.1f -> %8.1f' % (key, before / 2 ** 20,
+                                        after / 2 ** 20))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+# This file is a part of the AnyBlok project
+#
+#    Copyright (C) 2018 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+""" Cost of one access to the session through the registry
+
+``before`` is the generic ``Registry.__getattr__`` (scoped session lookup
+and ``hasattr`` on the session), ``after`` is the direct proxy::
+
+    python tools/benchmarks/bench_session_proxy.py --db-name bench -- \\
+        --number 200000
+"""
+from anyblok.registry import Registry
+from common import start, best_time, print_results
+
+
+def main():
+    registry, options = start(
+        "Cost of the session proxies of the registry",
+        [(('--number',), dict(type=int, default=200000,
+                              help="Number of calls by measure"))])
+    number = options.number
+    Blok = registry.System.Blok
+    results = []
+    for name in ('query', 'add', 'add_all', 'delete', 'merge',
+                 'connection', 'expunge_all'):
+        results.append((
+            'registry.%s' % name,
+            best_time(lambda: Registry.__getattr__(registry, name), number),
+            best_time(lambda: getattr(registry, name), number)))
+
+    results.append((
+        'registry.session',
+        best_time(lambda: Registry.__getattr__(registry, 'query').__self__,
+                  number),
+        best_time(lambda: registry.session, number)))
+    results.append((
+        'Blok.query()',
+        best_time(lambda: Registry.__getattr__(registry, 'query')(Blok),
+                  number // 10),
+        best_time(lambda: Blok.query(), number // 10)))
+    print_results('Session access, __getattr__ -> proxy', results)
+    registry.rollback()
+
+
+if __name__ == '__main__':
+    main()
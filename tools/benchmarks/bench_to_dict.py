@@ -0,0 +1,72 @@
+# This file is a part of the AnyBlok project
+#
+#    Copyright (C) 2018 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+""" Time to serialize records with ``to_dict`` and ``to_dicts``, for flat
+and nested fields
+
+The records are exporters and fields of exporter of the blok
+``anyblok-io-csv``, created then rolled back. The records and their
+relationships are loaded before the measures, only the serialization is
+measured. To compare before and after the compiled plans of ``to_dict``,
+run this script on a checkout of each version (``to_dicts`` only exists
+after)::
+
+    anyblok_createdb --db-name bench --install-bloks anyblok-io-csv
+    python tools/benchmarks/bench_to_dict.py --db-name bench -- \\
+        --exporters 100 --fields 50
+"""
+from common import start, best_time
+
+SPECS = [
+    ('Model.IO.Exporter.Field', ('id', 'name', 'mode')),
+    ('Model.IO.Exporter.Field', ('id', 'name', ('exporter', ('id',
+                                                             'model')))),
+    ('Model.IO.Exporter', ('id', 'model', ('fields_to_export', ('id',
+                                                                'name')))),
+]
+
+
+def main():
+    registry, options = start(
+        "Time to serialize records with to_dict and to_dicts",
+        [(('--exporters',), dict(type=int, default=100,
+                                 help="Number of exporters")),
+         (('--fields',), dict(type=int, default=50,
+                              help="Number of fields by exporter")),
+         (('--number',), dict(type=int, default=5,
+                              help="Serializations by measure"))])
+    Exporter = registry.IO.Exporter
+    exporters = Exporter.multi_insert(*[
+        dict(mode='Model.IO.Exporter.CSV', model='Model.System.Blok')
+        for i in range(options.exporters)])
+    Exporter.Field.multi_insert(*[
+        dict(exporter=exporter, name='name')
+        for exporter in exporters for i in range(options.fields)])
+
+    print('Serialization time by record (us)')
+    for namespace, spec in SPECS:
+        records = registry.get(namespace).query().all()
+        for record in records:
+            # load the relationships before measuring
+            record.to_dict(*spec)
+
+        per_record = 1e6 / len(records)
+        line = '  %s %r\n    to_dict  %8.2f' % (
+            namespace, spec, per_record * best_time(
+                lambda: [x.to_dict(*spec) for x in records],
+                options.number))
+        if hasattr(records, 'to_dicts'):
+            line += '    to_dicts  %8.2f' % (per_record * best_time(
+                lambda: records.to_dicts(*spec), options.number))
+
+        print(line)
+
+    registry.rollback()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+# This file is a part of the AnyBlok project
+#
+#    Copyright (C) 2018 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+""" Helpers of the benchmark scripts
+
+The scripts use an existing database, created with the blok
+``anyblok-core``. The options of AnyBlok come first, the options of the
+script come after ``--``::
+
+    anyblok_createdb --db-name bench --db-driver-name postgresql
+    python tools/benchmarks/bench_bulk_insert.py --db-name bench \\
+        --db-driver-name postgresql -- --rows 10000
+
+The entries created by a script are rolled back at its end
+"""
+import argparse
+from timeit import Timer
+import anyblok
+
+
+def start(description, arguments=()):
+    """ Load the registry and parse the options of the script
+
+    :param description: description of the script
+    :param arguments: list of (args, kwargs) given to ``add_argument``
+    :rtype: (registry, options)
+    """
+    registry = anyblok.start('benchmark', useseparator=True,
+                             loadwithoutmigration=True)
+    if registry is None:
+        raise SystemExit("No database selected, use --db-name")
+
+    parser = argparse.ArgumentParser(description=description)
+    for args, kwargs in arguments:
+        parser.add_argument(*args, **kwargs)
+
+    return registry, parser.parse_args()
+
+
+def best_time(function, number, repeat=5):
+    """ Return the best time of one call of the function, in seconds
+
+    :param function: function called without argument
+    :param number: number of calls by measure
+    :param repeat: number of measures
+    :rtype: float
+    """
+    return min(Timer(function).repeat(repeat=repeat, number=number)) / number
+
+
+def print_results(title, results, unit='us'):
+    """ Print the results as a table
+
+    :param title: title of the table
+    :param results: list of (label, before, after), in seconds
+    :param unit: ``us`` or ``ms``
+    """
+    factor = {'us': 1e6, 'ms': 1e3}[unit]
+    width = max(len(x[0]) for x in results)
+    print(title)
+    for label, before, after in results:
+        print('  %s  %10.2f %s -> %10.2f %s  (x%.1f)' % (
+            label.ljust(width), before * factor, unit, after * factor, unit,
+            before / after if after else float('inf')))